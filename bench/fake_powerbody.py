@@ -0,0 +1,233 @@
+"""Локальная замена SOAP API PowerBody для бенчмарка синхронизации.
+
+Отдаёт WSDL и обслуживает login / call / endSession. В call поддержаны dropshipping.getProductList
+и dropshipping.getProductInfo; ответы — строки JSON, как у настоящего API.
+WSDL упрощён до document/literal: zeep вызывает его теми же client.service.login/call/endSession.
+
+Задержка ответа, доля ошибок 403/503 (только для getProductInfo — getProductList клиент не повторяет)
+и время жизни сессии задаются параметрами. Счётчики вызовов: GET /_stats, сброс — POST /_stats/reset.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+NAMESPACE = "urn:PowerBodyBench"
+SOAP_ENV = "http://schemas.xmlsoap.org/soap/envelope/"
+
+WSDL_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+             xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:tns="{ns}"
+             targetNamespace="{ns}" name="PowerBodyBench">
+  <types>
+    <xsd:schema targetNamespace="{ns}" elementFormDefault="qualified">
+      <xsd:element name="login"><xsd:complexType><xsd:sequence>
+        <xsd:element name="username" type="xsd:string"/>
+        <xsd:element name="apiKey" type="xsd:string"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+      <xsd:element name="loginResponse"><xsd:complexType><xsd:sequence>
+        <xsd:element name="loginReturn" type="xsd:string"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+      <xsd:element name="call"><xsd:complexType><xsd:sequence>
+        <xsd:element name="sessionId" type="xsd:string"/>
+        <xsd:element name="resourcePath" type="xsd:string"/>
+        <xsd:element name="args" type="xsd:anyType" minOccurs="0" nillable="true"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+      <xsd:element name="callResponse"><xsd:complexType><xsd:sequence>
+        <xsd:element name="callReturn" type="xsd:string"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+      <xsd:element name="endSession"><xsd:complexType><xsd:sequence>
+        <xsd:element name="sessionId" type="xsd:string"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+      <xsd:element name="endSessionResponse"><xsd:complexType><xsd:sequence>
+        <xsd:element name="endSessionReturn" type="xsd:boolean"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+    </xsd:schema>
+  </types>
+  <message name="loginRequest"><part name="parameters" element="tns:login"/></message>
+  <message name="loginResponse"><part name="parameters" element="tns:loginResponse"/></message>
+  <message name="callRequest"><part name="parameters" element="tns:call"/></message>
+  <message name="callResponse"><part name="parameters" element="tns:callResponse"/></message>
+  <message name="endSessionRequest"><part name="parameters" element="tns:endSession"/></message>
+  <message name="endSessionResponse"><part name="parameters" element="tns:endSessionResponse"/></message>
+  <portType name="PowerBodyPortType">
+    <operation name="login"><input message="tns:loginRequest"/><output message="tns:loginResponse"/></operation>
+    <operation name="call"><input message="tns:callRequest"/><output message="tns:callResponse"/></operation>
+    <operation name="endSession">
+      <input message="tns:endSessionRequest"/><output message="tns:endSessionResponse"/>
+    </operation>
+  </portType>
+  <binding name="PowerBodyBinding" type="tns:PowerBodyPortType">
+    <soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <operation name="login"><soap:operation soapAction="{ns}#login"/>
+      <input><soap:body use="literal"/></input><output><soap:body use="literal"/></output></operation>
+    <operation name="call"><soap:operation soapAction="{ns}#call"/>
+      <input><soap:body use="literal"/></input><output><soap:body use="literal"/></output></operation>
+    <operation name="endSession"><soap:operation soapAction="{ns}#endSession"/>
+      <input><soap:body use="literal"/></input><output><soap:body use="literal"/></output></operation>
+  </binding>
+  <service name="PowerBodyService">
+    <port name="PowerBodyPort" binding="tns:PowerBodyBinding"><soap:address location="{location}"/></port>
+  </service>
+</definitions>
+"""
+
+
+class SoapFault(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class FakePowerBody:
+    """Состояние поддельного API: каталог, сессии, счётчики"""
+
+    def __init__(self, products, product_info, username, password, latency=0.0, error_rate=0.0,
+                 session_ttl=None, seed=0):
+        self.product_list = json.dumps(products)
+        self.product_info = {str(pid): json.dumps(info) for pid, info in product_info.items()}
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.error_rate = error_rate
+        self.session_ttl = session_ttl
+        self.random = random.Random(seed)
+        self.sessions = {}  # session_id → время логина
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def injected_error(self):
+        with self.lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                return self.random.choice((403, 503))
+        return None
+
+    def login(self, username, api_key):
+        if (username, api_key) != (self.username, self.password):
+            raise SoapFault("2", "Access denied.")
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = time.monotonic()
+        return session_id
+
+    def end_session(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def check_session(self, session_id):
+        with self.lock:
+            created = self.sessions.get(session_id)
+            if created is not None and self.session_ttl and time.monotonic() - created > self.session_ttl:
+                del self.sessions[session_id]
+                created = None
+        if created is None:
+            raise SoapFault("5", "Session expired. Try to relogin.")
+
+    def call(self, session_id, method, args):
+        self.check_session(session_id)
+        if method == "dropshipping.getProductList":
+            return self.product_list
+        if method == "dropshipping.getProductInfo":
+            try:
+                product_id = str(json.loads(args or "{}").get("id"))
+            except (ValueError, AttributeError):
+                raise SoapFault("101", "Invalid arguments.")
+            info = self.product_info.get(product_id)
+            if info is None:
+                raise SoapFault("101", "Product not exists.")
+            return info
+        raise SoapFault("3", f"Invalid api path: {method}")
+
+
+def envelope(body):
+    return (f'<?xml version="1.0" encoding="UTF-8"?><soap-env:Envelope xmlns:soap-env="{SOAP_ENV}">'
+            f"<soap-env:Body>{body}</soap-env:Body></soap-env:Envelope>").encode("utf-8")
+
+
+def local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего сервера
+        disable_nagle_algorithm = True  # Иначе заголовки и тело ответа ждут delayed ACK (~40 мс)
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_body(self, status, body, content_type="text/xml; charset=utf-8"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/_stats":
+                with api.lock:
+                    body = json.dumps(api.stats).encode()
+                return self.send_body(200, body, "application/json")
+            location = f"http://{self.headers['Host']}/soap"
+            self.send_body(200, WSDL_TEMPLATE.format(ns=NAMESPACE, location=location).encode("utf-8"))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path == "/_stats/reset":
+                with api.lock:
+                    api.stats.clear()
+                return self.send_body(204, b"")
+
+            if api.latency:
+                time.sleep(api.latency)
+            request = next(iter(ElementTree.fromstring(body).find(f"{{{SOAP_ENV}}}Body")))
+            operation = local_name(request.tag)
+            fields = {local_name(child.tag): child.text for child in request}
+
+            try:
+                if operation == "login":
+                    api.count("login")
+                    result = api.login(fields.get("username"), fields.get("apiKey"))
+                elif operation == "endSession":
+                    api.count("endSession")
+                    result = "true" if api.end_session(fields.get("sessionId")) else "false"
+                elif operation == "call":
+                    method = fields.get("resourcePath")
+                    api.count(f"call:{method}")
+                    status = api.injected_error() if method == "dropshipping.getProductInfo" else None
+                    if status:
+                        api.count(f"http_{status}")
+                        return self.send_body(status, b"Service temporarily unavailable", "text/html")
+                    result = api.call(fields.get("sessionId"), method, fields.get("args"))
+                else:
+                    raise SoapFault("Client", f"Unknown operation {operation}")
+            except SoapFault as fault:
+                api.count("faults")
+                return self.send_body(500, envelope(
+                    f"<soap-env:Fault><faultcode>{escape(fault.code)}</faultcode>"
+                    f"<faultstring>{escape(fault.message)}</faultstring></soap-env:Fault>"))
+
+            self.send_body(200, envelope(
+                f'<tns:{operation}Response xmlns:tns="{NAMESPACE}">'
+                f"<tns:{operation}Return>{escape(result)}</tns:{operation}Return></tns:{operation}Response>"))
+
+    return Handler
+
+
+def serve(ready, products, product_info, username, password, **options):
+    """Цель для multiprocessing: поднимает сервер на свободном порту и сообщает адрес WSDL через ready"""
+    api = FakePowerBody(products, product_info, username, password, **options)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(api))
+    server.daemon_threads = True
+    ready.send(f"http://127.0.0.1:{server.server_address[1]}/soap?wsdl")
+    ready.close()
+    server.serve_forever()
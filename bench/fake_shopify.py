@@ -0,0 +1,275 @@
+"""Локальная замена Shopify Admin API для бенчмарка синхронизации.
+
+Поддержано то, что использует синхронизация:
+    GET  /admin/api/<версия>/products.json     — страницы по limit, следующая — в заголовке Link (page_info)
+    POST /admin/api/<версия>/graphql.json      — productVariantsBulkUpdate, inventorySetQuantities,
+                                                  bulkOperationRunQuery и currentBulkOperation
+    GET  /_bulk/<id>.jsonl                     — результат bulk-экспорта
+Лимиты как у Shopify: REST — leaky bucket (40 запросов, утекает 2/с, переполнение → 429 с Retry-After,
+уровень в X-Shopify-Shop-Api-Call-Limit), GraphQL — бюджет баллов (1000, +50/с, нехватка → THROTTLED,
+состояние в extensions.cost.throttleStatus). Счётчики вызовов: GET /_stats, сброс — POST /_stats/reset.
+"""
+import base64
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+MUTATION_COST = 10  # Баллов за одну мутацию
+QUERY_COST = 1
+
+
+def gid(kind, object_id):
+    return f"gid://shopify/{kind}/{object_id}"
+
+
+def gid_id(value):
+    return int(str(value).rsplit("/", 1)[-1])
+
+
+class LeakyBucket:
+    """Корзина, из которой запросы «утекают» с постоянной скоростью"""
+
+    def __init__(self, capacity, leak_rate):
+        self.capacity = capacity
+        self.leak_rate = leak_rate
+        self.level = 0.0
+        self.updated = time.monotonic()
+
+    def leak(self):
+        now = time.monotonic()
+        self.level = max(0.0, self.level - (now - self.updated) * self.leak_rate)
+        self.updated = now
+
+    def try_fill(self, amount):
+        """Добавляет amount, если помещается. Иначе возвращает, сколько секунд ждать"""
+        self.leak()
+        overflow = self.level + amount - self.capacity
+        if overflow > 0:
+            return overflow / self.leak_rate
+        self.level += amount
+        return 0.0
+
+    @property
+    def available(self):
+        self.leak()
+        return self.capacity - self.level
+
+
+class FakeShopify:
+    """Состояние поддельного магазина: варианты, лимиты, bulk-операции, счётчики"""
+
+    def __init__(self, variants, access_token, rest_capacity=40, rest_leak_rate=2.0,
+                 graphql_maximum=1000.0, graphql_restore_rate=50.0, bulk_seconds=1.0):
+        self.variants = {v["id"]: dict(v) for v in variants}
+        self.by_inventory_item = {v["inventory_item_id"]: v["id"] for v in variants}
+        self.products = {}
+        for v in variants:
+            self.products.setdefault(v["product_id"], []).append(v["id"])
+        self.product_ids = list(self.products)
+        self.access_token = access_token
+        self.rest_bucket = LeakyBucket(rest_capacity, rest_leak_rate)
+        self.graphql_bucket = LeakyBucket(graphql_maximum, graphql_restore_rate)
+        self.bulk_seconds = bulk_seconds
+        self.bulk_operations = {}  # id → время запуска
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        self.stats[name] = self.stats.get(name, 0) + amount
+
+    def throttle_status(self):
+        bucket = self.graphql_bucket
+        return {"maximumAvailable": bucket.capacity, "currentlyAvailable": int(bucket.available),
+                "restoreRate": bucket.leak_rate}
+
+    # REST
+
+    def products_page(self, page_info, limit):
+        start = int(base64.urlsafe_b64decode(page_info).decode()) if page_info else 0
+        limit = max(1, min(int(limit or 50), 250))
+        products = [{"id": pid, "variants": [self.variants[vid] for vid in self.products[pid]]}
+                    for pid in self.product_ids[start:start + limit]]
+        next_page = start + limit if start + limit < len(self.product_ids) else None
+        return products, base64.urlsafe_b64encode(str(next_page).encode()).decode() if next_page else None
+
+    # GraphQL
+
+    def requested_cost(self, query):
+        if "bulkOperationRunQuery" in query:
+            return MUTATION_COST
+        mutations = query.count("productVariantsBulkUpdate(") + query.count("inventorySetQuantities(")
+        return mutations * MUTATION_COST if mutations else QUERY_COST
+
+    def run_graphql(self, query, variables, base_url):
+        if "bulkOperationRunQuery" in query:
+            self.count("graphql:bulkOperationRunQuery")
+            operation_id = gid("BulkOperation", len(self.bulk_operations) + 1)
+            self.bulk_operations[operation_id] = time.monotonic()
+            return {"bulkOperationRunQuery": {"bulkOperation": {"id": operation_id, "status": "CREATED"},
+                                              "userErrors": []}}
+        if "currentBulkOperation" in query:
+            self.count("graphql:currentBulkOperation")
+            if not self.bulk_operations:
+                return {"currentBulkOperation": None}
+            operation_id = list(self.bulk_operations)[-1]
+            done = time.monotonic() - self.bulk_operations[operation_id] >= self.bulk_seconds
+            return {"currentBulkOperation": {
+                "id": operation_id, "status": "COMPLETED" if done else "RUNNING", "errorCode": None,
+                "objectCount": str(len(self.variants)) if done else "0",
+                "url": f"{base_url}/_bulk/{gid_id(operation_id)}.jsonl" if done else None,
+            }}
+        if "inventorySetQuantities(" in query:
+            self.count("graphql:inventorySetQuantities")
+            self.count("mutations:inventorySetQuantities", len(variables["input"]["quantities"]))
+            return {"inventorySetQuantities": {"userErrors": self.set_quantities(variables["input"]["quantities"])}}
+
+        self.count("graphql:productVariantsBulkUpdate")
+        data = {}
+        for alias in re.findall(r"(\w+)\s*:\s*productVariantsBulkUpdate\(", query):
+            self.count("mutations:productVariantsBulkUpdate")
+            number = alias[1:]
+            data[alias] = {"userErrors": self.update_prices(variables[f"p{number}"], variables[f"v{number}"])}
+        return data
+
+    def update_prices(self, product_gid, variants):
+        variant_ids = self.products.get(gid_id(product_gid))
+        if variant_ids is None:
+            return [{"field": ["productId"], "message": "Product does not exist"}]
+        errors = []
+        for i, variant in enumerate(variants):
+            variant_id = gid_id(variant["id"])
+            if variant_id not in variant_ids:
+                errors.append({"field": ["variants", str(i), "id"], "message": "Product variant does not exist"})
+                continue
+            self.variants[variant_id]["price"] = variant["price"]
+        return errors
+
+    def set_quantities(self, quantities):
+        errors = []
+        for i, item in enumerate(quantities):
+            variant_id = self.by_inventory_item.get(gid_id(item["inventoryItemId"]))
+            if variant_id is None:
+                errors.append({"field": ["input", "quantities", str(i), "inventoryItemId"],
+                               "message": "The specified inventory item could not be found."})
+                continue
+            self.variants[variant_id]["inventory_quantity"] = item["quantity"]
+        return errors
+
+    def bulk_lines(self):
+        for variant in self.variants.values():
+            yield json.dumps({
+                "id": gid("ProductVariant", variant["id"]),
+                "sku": variant["sku"],
+                "price": variant["price"],
+                "inventoryQuantity": variant["inventory_quantity"],
+                "product": {"id": gid("Product", variant["product_id"])},
+                "inventoryItem": {"id": gid("InventoryItem", variant["inventory_item_id"])},
+            }) + "\n"
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # Иначе заголовки и тело ответа ждут delayed ACK (~40 мс)
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def authorized(self):
+            if self.headers.get("X-Shopify-Access-Token") == api.access_token:
+                return True
+            self.send_json(401, {"errors": "[API] Invalid API key or access token "
+                                           "(unrecognized login or wrong password)"})
+            return False
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/_stats":
+                with api.lock:
+                    return self.send_json(200, api.stats)
+
+            if url.path.startswith("/_bulk/"):
+                with api.lock:
+                    api.count("bulk_download")
+                    body = "".join(api.bulk_lines()).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/jsonl")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                return self.wfile.write(body)
+
+            if not url.path.endswith("/products.json"):
+                return self.send_json(404, {"errors": "Not Found"})
+            if not self.authorized():
+                return
+            query = {name: values[0] for name, values in parse_qs(url.query).items()}
+            with api.lock:
+                api.count("rest:products")
+                wait = api.rest_bucket.try_fill(1)
+                level = f"{math.ceil(api.rest_bucket.level)}/{api.rest_bucket.capacity}"
+                if wait:
+                    api.count("rest_429")
+                    return self.send_json(429, {"errors": "Exceeded 2 calls per second for api client. "
+                                                          "Reduce request rates to resume uninterrupted service."},
+                                          {"Retry-After": f"{max(wait, 0.1):.1f}", "X-Shopify-Shop-Api-Call-Limit": level})
+                products, next_page = api.products_page(query.get("page_info"), query.get("limit"))
+            headers = {"X-Shopify-Shop-Api-Call-Limit": level}
+            if next_page:
+                base = f"http://{self.headers['Host']}{url.path}"
+                headers["Link"] = f'<{base}?limit={query.get("limit", 50)}&page_info={next_page}>; rel="next"'
+            self.send_json(200, {"products": products}, headers)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            url = urlsplit(self.path)
+            if url.path == "/_stats/reset":
+                with api.lock:
+                    api.stats.clear()
+                return self.send_json(200, {})
+
+            if not url.path.endswith("/graphql.json"):
+                return self.send_json(404, {"errors": "Not Found"})
+            if not self.authorized():
+                return
+            request = json.loads(body)
+            query, variables = request["query"], request.get("variables") or {}
+
+            with api.lock:
+                cost = api.requested_cost(query)
+                if api.graphql_bucket.available < cost:
+                    api.count("graphql_throttled")
+                    return self.send_json(200, {
+                        "errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}],
+                        "extensions": {"cost": {"requestedQueryCost": cost, "throttleStatus": api.throttle_status()}},
+                    })
+                api.graphql_bucket.try_fill(cost)
+                data = api.run_graphql(query, variables, f"http://{self.headers['Host']}")
+                extensions = {"cost": {"requestedQueryCost": cost, "actualQueryCost": cost,
+                                       "throttleStatus": api.throttle_status()}}
+            self.send_json(200, {"data": data, "extensions": extensions})
+
+    return Handler
+
+
+def serve(ready, variants, access_token, **options):
+    """Цель для multiprocessing: поднимает сервер на свободном порту и сообщает его адрес через ready"""
+    api = FakeShopify(variants, access_token, **options)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(api))
+    server.daemon_threads = True
+    ready.send(f"http://127.0.0.1:{server.server_address[1]}")
+    ready.close()
+    server.serve_forever()
@@ -0,0 +1,70 @@
+"""Микробенчмарк и сверка extract_flavor_advanced с эталоном.
+
+Эталон (flavor_golden.json) — синтетические названия в стиле PowerBody (бренд, продукт, фасовка, вкус),
+собранные из списка вкусов, а не выгрузка реального каталога; ожидаемый результат получен прежней
+реализацией, до перехода на FlavorMatcher. Названия с не-ASCII символами в конце файла проверяют запасной
+путь FlavorMatcher.candidates(), который перебирает все вкусы. Реальные названия из getProductList стоит
+добавлять в эталон, когда они расходятся с разбором.
+Запуск из корня проекта: python bench/flavor_bench.py [--rounds N]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flavor_golden.json")
+
+# index.py читает настройки из окружения при импорте; для бенчмарка сеть не нужна
+os.environ.setdefault("REDIS_HOST", "localhost")
+os.environ.setdefault("REDIS_PORT", "6379")
+os.environ.setdefault("SCHEDULER_ENABLED", "0")  # Бенчмарку не нужен планировщик
+sys.path.insert(0, ROOT)
+
+import index  # noqa: E402
+
+
+def check_golden(golden):
+    mismatches = []
+    for name, flavor, item_name in golden:
+        result = index.extract_flavor_advanced.__wrapped__(name)
+        if result != (flavor, item_name):
+            mismatches.append((name, (flavor, item_name), result))
+    return mismatches
+
+
+def bench(names, rounds, func):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for name in names:
+            func(name)
+    elapsed = time.perf_counter() - start
+    return elapsed / (rounds * len(names)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    with open(GOLDEN_FILE, encoding="utf-8") as file:
+        golden = json.load(file)
+
+    mismatches = check_golden(golden)
+    for name, expected, actual in mismatches:
+        print(f"❌ {name!r}: ожидалось {expected}, получено {actual}")
+    print(f"{'✅' if not mismatches else '❌'} Сверка с эталоном: {len(golden) - len(mismatches)}/{len(golden)}")
+
+    names = [row[0] for row in golden]
+    index.extract_flavor_advanced.cache_clear()
+    uncached = bench(names, args.rounds, index.extract_flavor_advanced.__wrapped__)
+    cached = bench(names, args.rounds, index.extract_flavor_advanced)
+    print(f"⏱ Без кэша: {uncached:.1f} мкс/название")
+    print(f"⏱ С LRU-кэшем: {cached:.2f} мкс/название")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""Сквозной бенчмарк полной синхронизации (sync_products) без обращения к настоящим API.
+
+Для каждого размера каталога поднимаются локальные заменители PowerBody (fake_powerbody.py) и
+Shopify Admin API (fake_shopify.py) с одинаковым для всех прогонов набором товаров, после чего
+sync_products запускается в отдельном процессе дважды:
+    cold — пустой Redis: каталог, getProductInfo и SKU-карта Shopify загружаются с нуля;
+    warm — повторный прогон: каталог и снимок уже есть, изменений почти нет.
+По каждому прогону печатаются SKU/сек, вызовы API на SKU (PowerBody и Shopify, включая отбитые 429/THROTTLED)
+и пиковая память процесса синхронизации.
+
+Нужен Redis, который не жалко очистить: по умолчанию запускается свой redis-server на свободном порту;
+--redis-port подключает уже запущенный экземпляр — его база будет очищена (FLUSHALL).
+
+Запуск из корня проекта:
+    python bench/sync_bench.py                                  # 1k / 10k / 50k
+    python bench/sync_bench.py --sizes 1000 --json bench.json   # сохранить результат
+    python bench/sync_bench.py --compare bench.json             # код 1, если стало хуже больше допуска
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import redis
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fake_powerbody  # noqa: E402
+import fake_shopify  # noqa: E402
+
+SHOP = "bench-shop.myshopify.com"
+ACCESS_TOKEN = "shpat_bench"
+POWERBODY_USERNAME = "bench"
+POWERBODY_PASSWORD = "bench-api-key"
+LOCATION_ID = 1
+PASSES = ("cold", "warm")
+GOLDEN_FILE = os.path.join(BENCH_DIR, "flavor_golden.json")
+
+
+def make_catalog(size, seed):
+    """Каталог PowerBody: список getProductList и ответы getProductInfo по product_id.
+    Названия берутся из эталона разбора вкусов, чтобы extract_flavor_advanced работал на настоящих строках."""
+    rng = random.Random(seed)
+    with open(GOLDEN_FILE, encoding="utf-8") as file:
+        names = [row[0] for row in json.load(file)]
+
+    products, product_info = [], {}
+    for i in range(size):
+        product_id = 100000 + i
+        name = names[i % len(names)]
+        products.append({
+            "sku": f"PB-{product_id}",
+            "product_id": str(product_id),
+            "name": name,
+            "price": f"{rng.uniform(3, 60):.2f}",
+            "qty": f"{rng.randint(0, 200)}.0000",
+            "updated_at": "2024-01-01 00:00:00",
+        })
+        product_info[product_id] = {
+            "product_id": str(product_id),
+            "sku": f"PB-{product_id}",
+            "name": name,
+            "manufacturer": (name.split() or ["PowerBody"])[0],
+            "weight": rng.choice(["0.25", "0.5", "1", "2.27"]),
+            "ean": f"50{product_id:011d}",
+            "description": "x" * 400,  # Поля, которые синхронизация отбрасывает, тоже занимают трафик
+        }
+    return products, product_info
+
+
+def make_shop(products, coverage, changed_ratio, seed):
+    """Варианты магазина Shopify: coverage товаров каталога, по 3 варианта на товар.
+    У changed_ratio из них цена и/или остаток расходятся с PowerBody, остальные уже совпадают."""
+    import index  # Цена считается той же формулой и с теми же настройками по умолчанию, что и в синхронизации
+
+    rng = random.Random(seed + 1)
+    settings = index.DEFAULT_SETTINGS
+    variants = []
+    for product in products:
+        if rng.random() >= coverage:
+            continue
+        number = int(product["product_id"])
+        final_price = index.calculate_final_price(float(product["price"]), settings["vat"], settings["paypal_fees"],
+                                                  settings["second_paypal_fees"], settings["profit"])
+        quantity = int(float(product["qty"]))
+        price = f"{final_price:.2f}"
+        if rng.random() < changed_ratio:
+            change = rng.choice(("price", "quantity", "both"))
+            if change != "quantity":
+                price = f"{final_price * 0.9:.2f}"
+            if change != "price":
+                quantity += rng.randint(1, 20)
+        variants.append({
+            "id": 40000000 + number,
+            "product_id": 7000000 + (len(variants) // 3),
+            "sku": product["sku"],
+            "price": price,
+            "inventory_item_id": 50000000 + number,
+            "inventory_quantity": quantity,
+        })
+    return variants
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_redis(args):
+    """Свой redis-server без сохранения на диск, либо уже запущенный экземпляр из --redis-port"""
+    if args.redis_port:
+        print(f"⚠️ Redis {args.redis_host}:{args.redis_port} будет очищен перед каждым размером каталога")
+        return None, args.redis_host, args.redis_port
+
+    server = shutil.which("redis-server")
+    if not server:
+        sys.exit("❌ redis-server не найден. Установите Redis или укажите --redis-port запущенного экземпляра.")
+    port = free_port()
+    process = subprocess.Popen([server, "--port", str(port), "--save", "", "--appendonly", "no"],
+                               stdout=subprocess.DEVNULL)
+    client = redis.Redis(port=port)
+    for _ in range(50):
+        try:
+            client.ping()
+            break
+        except redis.ConnectionError:
+            time.sleep(0.1)
+    return process, "127.0.0.1", port
+
+
+def start_fake(target, *args, **options):
+    """Запускает заменитель API в отдельном процессе, чтобы он не делил GIL и память с синхронизацией"""
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=target, args=(sender, *args), kwargs=options, daemon=True)
+    process.start()
+    url = receiver.recv()
+    return process, url
+
+
+def stats_url(url):
+    return url.split("/soap")[0] + "/_stats"
+
+
+def run_sync(env, log_path):
+    """Один прогон sync_products в отдельном процессе: память меряется только у синхронизации"""
+    with open(log_path, "a") as log:
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], env=env, cwd=ROOT,
+                                   stdout=subprocess.PIPE, stderr=log, text=True)
+    if completed.returncode != 0 or not completed.stdout.strip():
+        sys.exit(f"❌ Прогон синхронизации завершился с кодом {completed.returncode}, журнал: {log_path}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def child():
+    """Выполняется в дочернем процессе: окружение уже указывает на заменители и на бенчмарочный Redis"""
+    sys.path.insert(0, ROOT)
+    import index
+
+    import_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # Интерпретатор и зависимости, до синхронизации
+
+    index.save_token(SHOP, ACCESS_TOKEN)
+    index.save_settings(SHOP, index.DEFAULT_SETTINGS)  # Те же, по которым make_shop считал цены магазина
+    started = time.perf_counter()
+    report = index.sync_products(SHOP)
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        "seconds": elapsed,
+        "report": report,
+        "import_rss_mb": import_kb / 1024,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def bench_size(size, args, redis_host, redis_port, workdir):
+    products, product_info = make_catalog(size, args.seed)
+    variants = make_shop(products, args.coverage, args.changed_ratio, args.seed)
+
+    redis.Redis(host=redis_host, port=redis_port).flushall()
+    powerbody_process, wsdl_url = start_fake(
+        fake_powerbody.serve, products, product_info, POWERBODY_USERNAME, POWERBODY_PASSWORD,
+        latency=args.powerbody_latency, error_rate=args.error_rate, seed=args.seed)
+    shopify_process, shopify_url = start_fake(
+        fake_shopify.serve, variants, ACCESS_TOKEN, rest_leak_rate=args.rest_leak_rate,
+        graphql_maximum=args.graphql_maximum, graphql_restore_rate=args.graphql_restore_rate)
+    del products, product_info, variants
+
+    env = dict(os.environ,
+               REDIS_HOST=redis_host, REDIS_PORT=str(redis_port), REDIS_USERNAME="", REDIS_PASSWORD="",
+               URL=wsdl_url, USERNAME=POWERBODY_USERNAME, PASSWORD=POWERBODY_PASSWORD,
+               POWERBODY_WSDL_CACHE=os.path.join(workdir, "wsdl_cache.db"),
+               POWERBODY_RETRY_DELAY=str(args.retry_delay),
+               SHOPIFY_ADMIN_URL=shopify_url, SHOPIFY_FETCH_MODE=args.fetch_mode,
+               SHOPIFY_REST_LEAK_RATE=str(args.rest_leak_rate), SHOPIFY_LOCATION_ID=str(LOCATION_ID),
+               CSV_DIR=os.path.join(workdir, "reports"), SCHEDULER_ENABLED="0", LOG_LEVEL=args.log_level)
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)  # Метрики прогона — в памяти процесса
+
+    results = []
+    try:
+        for name in PASSES:
+            for url in (wsdl_url, shopify_url):
+                requests.post(stats_url(url) + "/reset", timeout=10)
+            run = run_sync(env, os.path.join(workdir, f"sync_{size}.log"))
+            powerbody_stats = requests.get(stats_url(wsdl_url), timeout=10).json()
+            shopify_stats = requests.get(stats_url(shopify_url), timeout=10).json()
+            powerbody_calls = sum(v for k, v in powerbody_stats.items() if k in ("login", "endSession")
+                                  or k.startswith("call:"))
+            shopify_calls = sum(v for k, v in shopify_stats.items() if k.startswith(("rest:", "graphql:", "bulk_"))
+                                or k == "graphql_throttled")
+            results.append({
+                "size": size,
+                "pass": name,
+                "seconds": round(run["seconds"], 2),
+                "skus_per_second": round(size / run["seconds"], 1),
+                "powerbody_calls": powerbody_calls,
+                "shopify_calls": shopify_calls,
+                "calls_per_sku": round((powerbody_calls + shopify_calls) / size, 3),
+                "throttled": shopify_stats.get("rest_429", 0) + shopify_stats.get("graphql_throttled", 0),
+                "powerbody_errors": powerbody_stats.get("http_403", 0) + powerbody_stats.get("http_503", 0),
+                "peak_rss_mb": round(run["peak_rss_mb"], 1),
+                "import_rss_mb": round(run["import_rss_mb"], 1),
+                "powerbody": powerbody_stats,
+                "shopify": shopify_stats,
+            })
+            print_row(results[-1])
+    finally:
+        for process in (powerbody_process, shopify_process):
+            process.terminate()
+            process.join()
+    return results
+
+
+def print_header():
+    print(f"{'SKU':>7} {'прогон':<6} {'сек':>8} {'SKU/сек':>9} {'PowerBody':>10} {'Shopify':>8} "
+          f"{'вызовов/SKU':>11} {'429/THR':>8} {'403/503':>8} {'пик RSS, МБ':>12}")
+
+
+def print_row(row):
+    print(f"{row['size']:>7} {row['pass']:<6} {row['seconds']:>8.2f} {row['skus_per_second']:>9.1f} "
+          f"{row['powerbody_calls']:>10} {row['shopify_calls']:>8} {row['calls_per_sku']:>11.3f} "
+          f"{row['throttled']:>8} {row['powerbody_errors']:>8} {row['peak_rss_mb']:>12.1f}", flush=True)
+
+
+def compare(results, baseline_file, tolerance):
+    """Сравнивает с сохранённым прогоном; возвращает список ухудшений больше допуска"""
+    with open(baseline_file, encoding="utf-8") as file:
+        baseline = {(row["size"], row["pass"]): row for row in json.load(file)["results"]}
+
+    regressions = []
+    for row in results:
+        before = baseline.get((row["size"], row["pass"]))
+        if not before:
+            continue
+        # (метрика, поле, направление ухудшения: -1 — хуже, когда меньше)
+        for metric, field, direction in (("SKU/сек", "skus_per_second", -1), ("вызовов/SKU", "calls_per_sku", 1),
+                                         ("пик RSS", "peak_rss_mb", 1)):
+            old, new = before[field], row[field]
+            if (new - old) * direction > abs(old) * tolerance:
+                regressions.append(f"{row['size']} {row['pass']}: {metric} {old} → {new}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк sync_products на локальных заменителях PowerBody и Shopify")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--sizes", default="1000,10000,50000", help="Размеры каталога через запятую")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--coverage", type=float, default=0.9, help="Доля товаров PowerBody, которые есть в магазине")
+    parser.add_argument("--changed-ratio", type=float, default=0.02,
+                        help="Доля вариантов магазина с расходящейся ценой или остатком")
+    parser.add_argument("--powerbody-latency", type=float, default=0.01, help="Задержка ответа PowerBody, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля getProductInfo, отвечающих 403/503")
+    parser.add_argument("--retry-delay", type=float, default=0.5, help="POWERBODY_RETRY_DELAY для прогонов, сек")
+    parser.add_argument("--fetch-mode", choices=("rest", "bulk"), default="rest",
+                        help="Как загружать SKU-карту Shopify (rest — страницы с Link)")
+    parser.add_argument("--rest-leak-rate", type=float, default=2.0, help="REST: запросов в секунду")
+    parser.add_argument("--graphql-maximum", type=float, default=1000.0, help="GraphQL: размер бюджета, баллов")
+    parser.add_argument("--graphql-restore-rate", type=float, default=50.0, help="GraphQL: баллов в секунду")
+    parser.add_argument("--redis-host", default="127.0.0.1")
+    parser.add_argument("--redis-port", type=int, help="Запущенный Redis для бенчмарка (будет очищен)")
+    parser.add_argument("--log-level", default="WARNING", help="LOG_LEVEL синхронизации (журнал — в рабочей папке)")
+    parser.add_argument("--json", help="Сохранить результаты в файл")
+    parser.add_argument("--compare", help="Файл прошлого прогона (--json) для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимое ухудшение при --compare")
+    args = parser.parse_args()
+
+    if args.child:
+        return child()
+
+    redis_process, redis_host, redis_port = start_redis(args)
+    workdir = tempfile.mkdtemp(prefix="sync_bench_")
+    os.environ.update(REDIS_HOST=redis_host, REDIS_PORT=str(redis_port), SCHEDULER_ENABLED="0",
+                      CSV_DIR=os.path.join(workdir, "reports"), LOG_LEVEL="WARNING")
+    sys.path.insert(0, ROOT)
+    print(f"📂 Рабочая папка (журналы и отчёты): {workdir}")
+
+    results = []
+    print_header()
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            results.extend(bench_size(size, args, redis_host, redis_port, workdir))
+    finally:
+        if redis_process:
+            redis_process.terminate()
+            redis_process.wait()
+
+    if args.json:
+        options = {k: v for k, v in vars(args).items() if k not in ("child", "json", "compare")}
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({"options": options, "results": results}, file, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены: {args.json}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"❌ {regression}")
+        print("✅ Ухудшений нет" if not regressions else f"❌ Ухудшений: {len(regressions)}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,45 @@
-from flask import Flask, jsonify, render_template_string, request, redirect, session, make_response
+from flask import Flask, jsonify, request, redirect, session, make_response, send_from_directory
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
 from zeep import Client
+from zeep.cache import SqliteCache
+from zeep.exceptions import Fault
+from zeep.transports import Transport
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor
 from flask_cors import CORS
 from flask_session import Session
 import time
 import csv
+import gzip
+import io
 from datetime import datetime
-from flask import send_file
+from flask import send_file, Response
 import redis
 import re
-
-CSV_DIR = "./csv_reports"  # Папка для хранения CSV-файлов
+import threading
+import queue
+import atexit
+import hashlib
+import concurrent.futures
+import functools
+import uuid
+import logging
+import logging.handlers
+import itertools
+import hmac
+import base64
+from typing import Any, Optional, Union
+import msgspec
+import numpy as np
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from msgspec import UNSET, UnsetType
+
+CSV_DIR = os.getenv("CSV_DIR", "./csv_reports")  # Папка для хранения CSV-файлов (общая для веба и воркеров)
+SYNC_REPORTS_KEEP = int(os.getenv("SYNC_REPORTS_KEEP", 10))  # Сколько последних отчётов хранить на магазин
 os.makedirs(CSV_DIR, exist_ok=True)  # Создаём папку, если её нет
 
 # 🔹 PowerBody API (SOAP)
@@ -23,6 +48,131 @@ os.makedirs(CSV_DIR, exist_ok=True)  # Создаём папку, если её
 USERNAME = os.getenv('USERNAME')
 PASSWORD = os.getenv('PASSWORD')
 WSDL_URL = os.getenv('URL')
+POWERBODY_WSDL_CACHE = os.getenv("POWERBODY_WSDL_CACHE", "./wsdl_cache.db")  # Кэш WSDL на диске
+POWERBODY_WSDL_CACHE_TTL = int(os.getenv("POWERBODY_WSDL_CACHE_TTL", 86400))  # 1 день
+POWERBODY_POOL_SIZE = int(os.getenv("POWERBODY_POOL_SIZE", 4))  # Максимум одновременных сессий
+POWERBODY_SESSION_TTL = int(os.getenv("POWERBODY_SESSION_TTL", 1800))  # Перелогин раньше, чем сессия истечёт
+POWERBODY_CONCURRENCY = int(os.getenv("POWERBODY_CONCURRENCY", POWERBODY_POOL_SIZE))  # Параллельные getProductInfo
+POWERBODY_RETRY_DELAY = float(os.getenv("POWERBODY_RETRY_DELAY", 15))  # Первая пауза после 403/503, дальше удваивается
+FLAVOR_CACHE_SIZE = int(os.getenv("FLAVOR_CACHE_SIZE", 16384))  # LRU-кэш разбора названий
+PRODUCT_INFO_CACHE_TTL = int(os.getenv("PRODUCT_INFO_CACHE_TTL", 604800))  # 7 дней
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", 60))  # Сколько токен живёт в памяти процесса, сек
+SETTINGS_CACHE_TTL = int(os.getenv("SETTINGS_CACHE_TTL", 300))  # Настройки магазина в памяти процесса, сек
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text или json (по строке JSON на запись)
+LOG_SKU_DEBUG = os.getenv("LOG_SKU_DEBUG", "0") == "1"  # Построчные логи по каждому SKU (по умолчанию выключены)
+LOG_SKU_SAMPLE_EVERY = int(os.getenv("LOG_SKU_SAMPLE_EVERY", 1))  # Из построчных логов пишем каждый N-й
+
+
+# 🔹 Логирование: запись в очередь не блокирует поток синхронизации, вывод — в отдельном потоке
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class StructuredFormatter(logging.Formatter):
+    """Текст с полями key=value из extra, либо одна строка JSON на запись"""
+
+    def __init__(self, json_lines=False):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = {k: v for k, v in vars(record).items() if k not in _LOG_RECORD_FIELDS}
+        if self.json_lines:
+            payload = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                       "message": record.getMessage(), **fields}
+            if record.exc_info:
+                payload["exc_info"] = self.formatException(record.exc_info)
+            return json.dumps(payload, ensure_ascii=False, default=str)
+        line = super().format(record)
+        if fields:
+            line += " | " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждую N-ю DEBUG-запись; предупреждения и ошибки — всегда"""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, every)
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or next(self._counter) % self.every == 0
+
+
+def configure_logging():
+    """Логгер приложения пишет в очередь; QueueListener форматирует и выводит записи в stdout"""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(StructuredFormatter(json_lines=LOG_FORMAT == "json"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    app_logger = logging.getLogger("powerbody_sync")
+    app_logger.setLevel(LOG_LEVEL)
+    app_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    app_logger.propagate = False
+
+    # Построчные логи по SKU — отдельный дочерний логгер: выключены по умолчанию, при включении — с выборкой
+    per_sku_logger = app_logger.getChild("sku")
+    per_sku_logger.setLevel(logging.DEBUG if LOG_SKU_DEBUG else logging.WARNING)
+    per_sku_logger.addFilter(SamplingFilter(LOG_SKU_SAMPLE_EVERY))
+    return app_logger, per_sku_logger
+
+
+logger, sku_logger = configure_logging()
+
+
+# 🔹 Метрики Prometheus (/metrics). Под gunicorn с PROMETHEUS_MULTIPROC_DIR значения собираются со всех воркеров.
+# Метрики синхронизаций пишутся в процессе worker.py — он отдаёт их на своём порту (WORKER_METRICS_PORT)
+SYNC_STAGE_SECONDS = Histogram(
+    "sync_stage_seconds", "Время этапа синхронизации за один прогон", ["stage"],
+    buckets=(0.05, 0.25, 1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 14400, float("inf")),
+)
+SHOPIFY_THROTTLED_TOTAL = Counter("shopify_throttled_total", "Ответы Shopify 429 / THROTTLED", ["api"])
+POWERBODY_RETRIES_TOTAL = Counter("powerbody_retries_total", "Повторы getProductInfo после 403/503", ["status"])
+BACKOFF_SLEEP_SECONDS_TOTAL = Counter("backoff_sleep_seconds_total", "Суммарное ожидание лимитов и повторов",
+                                      ["api"])
+SYNC_SKUS = Gauge("sync_skus", "SKU в последней синхронизации магазина", ["shop", "state"],
+                  multiprocess_mode="mostrecent")
+for _api in ("rest", "graphql"):
+    SHOPIFY_THROTTLED_TOTAL.labels(_api)
+for _status in ("403", "503"):
+    POWERBODY_RETRIES_TOTAL.labels(_status)
+for _api in ("shopify_rest", "shopify_graphql", "powerbody"):
+    BACKOFF_SLEEP_SECONDS_TOTAL.labels(_api)  # Нулевые серии видны в /metrics до первого события
+
+
+class StageTimer:
+    """Копит время этапов, перемежающихся внутри цикла по SKU, и отдаёт в гистограмму по одному значению
+    на этап за прогон: with timer.stage("pricing"): ..."""
+
+    class _Stage:
+        __slots__ = ("totals", "name", "started")
+
+        def __init__(self, totals, name):
+            self.totals = totals
+            self.name = name
+
+        def __enter__(self):
+            self.started = time.perf_counter()
+
+        def __exit__(self, *exc):
+            self.totals[self.name] += time.perf_counter() - self.started
+
+    def __init__(self, *names):
+        self.totals = dict.fromkeys(names, 0.0)
+        self._stages = {name: self._Stage(self.totals, name) for name in names}
+
+    def stage(self, name):
+        return self._stages[name]
+
+    def observe(self):
+        for name, seconds in self.totals.items():
+            SYNC_STAGE_SECONDS.labels(name).observe(seconds)
+
 
 app = Flask(__name__)
 CORS(app)
@@ -31,14 +181,18 @@ REDIS_PORT = int(os.getenv("REDIS_PORT"))
 REDIS_USERNAME = os.getenv("REDIS_USERNAME")
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
 
-# Подключение к Redis Cloud
-redis_client = redis.StrictRedis(
+# Подключение к Redis Cloud — один пул соединений на процесс для данных
+redis_pool = redis.ConnectionPool(
     host=REDIS_HOST,
     port=REDIS_PORT,
     username=REDIS_USERNAME,
     password=REDIS_PASSWORD,
     decode_responses=True
 )
+redis_client = redis.StrictRedis(connection_pool=redis_pool)
+# Flask-Session хранит сессии в msgpack (байты) — ему нужен клиент без decode_responses
+session_redis_client = redis.StrictRedis(connection_pool=redis.ConnectionPool(
+    host=REDIS_HOST, port=REDIS_PORT, username=REDIS_USERNAME, password=REDIS_PASSWORD))
 
 # 🔹 Shopify API настройки
 SHOPIFY_CLIENT_ID = os.getenv('CLIENT_ID')
@@ -46,48 +200,194 @@ SHOPIFY_API_SECRET = os.getenv('API_SECRET')
 SHOPIFY_SCOPES = "read_products,write_products,write_inventory"
 APP_URL = os.getenv('APP_URL')  # ⚠️ Указать свой URL от ngrok
 REDIRECT_URI = f"{APP_URL}/auth/callback"
+SHOPIFY_API_VERSION = "2024-01"
+SHOPIFY_ADMIN_URL = os.getenv("SHOPIFY_ADMIN_URL", "https://{shop}")  # Адрес Admin API; бенчмарк подставляет локальный
+SHOPIFY_FETCH_MODE = os.getenv("SHOPIFY_FETCH_MODE", "bulk")  # bulk — GraphQL bulk-операция, rest — постранично products.json
+SHOPIFY_BULK_POLL_TIMEOUT = int(os.getenv("SHOPIFY_BULK_POLL_TIMEOUT", 1800))  # Максимум ожидания экспорта, сек
+SHOPIFY_REST_LEAK_RATE = float(os.getenv("SHOPIFY_REST_LEAK_RATE", 2))  # Запросов в секунду (Plus-магазины: 20)
+SHOPIFY_MAX_RETRIES = int(os.getenv("SHOPIFY_MAX_RETRIES", 5))
+SHOPIFY_HTTP_TIMEOUT = float(os.getenv("SHOPIFY_HTTP_TIMEOUT", 30))  # Таймаут по умолчанию для запросов, сек
+SHOPIFY_HTTP_POOL_SIZE = int(os.getenv("SHOPIFY_HTTP_POOL_SIZE", 16))  # keep-alive соединений на хост
+SHOPIFY_LOCATION_ID = int(os.getenv("SHOPIFY_LOCATION_ID", 85726363936))
+SHOPIFY_MUTATION_COST = 10  # Стоимость одной мутации в GraphQL-баллах
+SHOPIFY_MAX_MUTATIONS_PER_CALL = int(os.getenv("SHOPIFY_MAX_MUTATIONS_PER_CALL", 50))  # productVariantsBulkUpdate в одном запросе
+SHOPIFY_MAX_INVENTORY_PER_CALL = 250  # Лимит quantities в inventorySetQuantities
+SHOPIFY_WEBHOOK_TOPICS = ("products/create", "products/update", "products/delete", "inventory_levels/update")
+SHOPIFY_MIRROR_RECONCILE_MINUTES = int(os.getenv("SHOPIFY_MIRROR_RECONCILE_MINUTES", 1440))  # Полная сверка зеркала
 
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", os.urandom(24).hex())  # Используем .env или генерируем новый
 app.config["SESSION_TYPE"] = "redis"
 app.config["SESSION_PERMANENT"] = False
 app.config["SESSION_USE_SIGNER"] = True
 app.config["SESSION_KEY_PREFIX"] = "session:"
-app.config["SESSION_REDIS"] = redis.StrictRedis(
-    host=REDIS_HOST,
-    port=REDIS_PORT,
-    username=REDIS_USERNAME,
-    password=REDIS_PASSWORD,
-    decode_responses=True
-)
+app.config["SESSION_REDIS"] = session_redis_client
 
 # Настраиваем сессии
 Session(app)
 
-SETTINGS_FILE = "settings.json"
+SETTINGS_FILE = "settings.json"  # Старые общие настройки: только для переноса в Redis
+SETTINGS_KEY = "shop_settings:{}"  # Hash с настройками цен магазина
+DEFAULT_SETTINGS = {"vat": 20.0, "paypal_fees": 3.0, "second_paypal_fees": 0.20, "profit": 30.0}
 
 # 🔹 Планировщик задач
-executors = {'default': ThreadPoolExecutor(max_workers=10)}
+SYNC_INTERVAL_MINUTES = int(os.getenv("SYNC_INTERVAL_MINUTES", 600))  # Полная синхронизация
+STOCK_SYNC_INTERVAL_MINUTES = int(os.getenv("STOCK_SYNC_INTERVAL_MINUTES", 5))  # Только остатки
+SYNC_CHECKPOINT_EVERY = int(os.getenv("SYNC_CHECKPOINT_EVERY", 500))  # SKU между чекпоинтами полной синхронизации
+CATALOG_REFRESH_MINUTES = int(os.getenv("CATALOG_REFRESH_MINUTES", SYNC_INTERVAL_MINUTES))  # Общий каталог PowerBody
+# Старее — синхронизация магазина обновит каталог сама. С запасом сверх интервала планового обновления,
+# иначе между плановыми обновлениями каталог каждый раз перестраивала бы первая синхронизация магазина
+CATALOG_MAX_AGE_MINUTES = int(os.getenv("CATALOG_MAX_AGE_MINUTES", CATALOG_REFRESH_MINUTES + 60))
+STOCK_LIST_CACHE_SECONDS = int(os.getenv("STOCK_LIST_CACHE_SECONDS", 120))  # getProductList общий для всех магазинов
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1") == "1"  # 0 — процесс не участвует в выборе лидера
+SCHEDULER_LEASE_SECONDS = int(os.getenv("SCHEDULER_LEASE_SECONDS", 30))  # Аренда лидерства; продлевается каждые 1/3
+SHOP_DISCOVERY_MINUTES = int(os.getenv("SHOP_DISCOVERY_MINUTES", 1))  # Как часто лидер подхватывает новые магазины
+SYNC_WORKER_HEARTBEAT_SECONDS = int(os.getenv("SYNC_WORKER_HEARTBEAT_SECONDS", 10))  # Пульс живёт 3 интервала
+# Аренда блокировки синхронизации магазина. Должна истекать раньше, чем пропадёт пульс убитого воркера
+# (не позже 2 интервалов после смерти), иначе возвращённое в очередь задание застанет его блокировку
+SYNC_LOCK_SECONDS = int(os.getenv("SYNC_LOCK_SECONDS", 15))
+executors = {'default': ThreadPoolExecutor(max_workers=2)}  # Задачи только ставят задания в очередь воркеров
 scheduler = BackgroundScheduler(executors=executors)
-scheduler.start()
+scheduler.start(paused=True)  # Задачи выполняет только лидер (см. SchedulerLeader)
 
 
 @app.before_request
 def log_request():
-    print(f"📥 Входящий запрос: {request.method} {request.url} | IP: {request.remote_addr}")
+    logger.debug("📥 Входящий запрос: %s %s | IP: %s", request.method, request.url, request.remote_addr)
+
+
+class LocalCache:
+    """Небольшой in-process кэш с TTL. Записи сбрасываются сообщениями Redis pub/sub из других процессов."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Возвращает (найдено, значение)"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return False, None
+            value, expires_at = item
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                return False, None
+            return True, value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (ttl if ttl is not None else self.ttl))
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
 
 
-def save_token(shop, access_token):
-    """Сохраняет токен магазина в Redis Cloud с TTL"""
-    token_key = f"shopify_token:{shop}"
-    redis_client.set(token_key, access_token, ex=2592000)  # 30 дней TTL
+SHOPS_KEY = "shopify_shops"  # Множество магазинов, для которых сохранён токен
+SHOPS_MIGRATED_KEY = "shopify_shops:migrated"  # Реестр уже заполнялся из токенов — повторный SCAN не нужен
+
+
+class RedisLease:
+    """Блокировка Redis с арендой: берётся без ожидания и продлевается фоновым потоком, пока её держат.
+    Если процесс умер, ключ освобождается сам через ttl секунд."""
 
-    stored_token = redis_client.get(token_key)
-    ttl = redis_client.ttl(token_key)
+    def __init__(self, name, ttl, on_lost=None):
+        self.name = name
+        self.ttl = ttl
+        self.on_lost = on_lost
+        self._lock = redis_client.lock(name, timeout=ttl, thread_local=False)
+        self._stop = threading.Event()
+        self._thread = None
 
-    if stored_token:
-        print(f"✅ Токен сохранён в Redis: {shop} → {stored_token[:8]}*** (TTL: {ttl} сек)")
+    @property
+    def held(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def acquire(self):
+        if not self._lock.acquire(blocking=False):
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._renew, name=f"lease:{self.name}", daemon=True)
+        self._thread.start()
+        return True
+
+    def _renew(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self._lock.reacquire()
+            except redis.exceptions.LockError:
+                logger.error(f"❌ Аренда {self.name} потеряна")
+                if self.on_lost:
+                    self.on_lost()
+                return
+            except redis.RedisError as e:
+                logger.warning(f"⚠️ Не удалось продлить аренду {self.name}: {e}")  # Повторим на следующем шаге
+
+    def release(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            self._lock.release()
+        except redis.exceptions.LockError:
+            pass  # Уже истекла или перехвачена
+
+
+# 🔹 Сброс локальных кэшей во всех процессах через Redis pub/sub: канал → кэш
+TOKEN_UPDATES_CHANNEL = "shopify_token_updates"
+SETTINGS_UPDATES_CHANNEL = "shop_settings_updates"
+token_cache = LocalCache(TOKEN_CACHE_TTL)
+settings_cache = LocalCache(SETTINGS_CACHE_TTL)
+_invalidation_caches = {TOKEN_UPDATES_CHANNEL: token_cache, SETTINGS_UPDATES_CHANNEL: settings_cache}
+_invalidation_thread = None
+_invalidation_lock = threading.Lock()
+
+
+def _handle_invalidation(message):
+    cache = _invalidation_caches.get(message["channel"])
+    if cache is not None:
+        cache.invalidate(message["data"] or None)
+
+
+def _invalidation_error(error, pubsub, thread):
+    logger.warning(f"⚠️ Ошибка подписки на сброс кэшей: {error}")
+    for cache in _invalidation_caches.values():
+        cache.invalidate()  # Пока подписка не работает, могли пропустить сообщения
+    time.sleep(1)
+
+
+def ensure_invalidation_listener():
+    """Запускает (один раз на процесс) фоновую подписку на каналы сброса кэшей"""
+    global _invalidation_thread
+    if _invalidation_thread is not None:
+        return
+    with _invalidation_lock:
+        if _invalidation_thread is None:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{channel: _handle_invalidation for channel in _invalidation_caches})
+            _invalidation_thread = pubsub.run_in_thread(sleep_time=1, daemon=True,
+                                                        exception_handler=_invalidation_error)
+
+
+def save_token(shop, access_token):
+    """Сохраняет токен магазина в Redis Cloud с TTL и сбрасывает его кэш во всех процессах"""
+    token_key = f"shopify_token:{shop}"
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.set(token_key, access_token, ex=2592000)  # 30 дней TTL
+    pipe.sadd(SHOPS_KEY, shop)  # Реестр установленных магазинов
+    pipe.publish(TOKEN_UPDATES_CHANNEL, shop)
+    stored, _, _ = pipe.execute()
+    token_cache.invalidate(shop)
+
+    if stored:
+        logger.info(f"✅ Токен сохранён в Redis: {shop} → {access_token[:8]}*** (TTL: 2592000 сек)")
     else:
-        print(f"❌ Ошибка: токен НЕ сохранён в Redis!")
+        logger.error(f"❌ Ошибка: токен НЕ сохранён в Redis!")
 
 
 @app.route("/test_redis")
@@ -98,56 +398,63 @@ def test_redis():
 
 
 def get_token(shop):
-    """Получает токен магазина из Redis"""
+    """Получает токен магазина: из памяти процесса, иначе одним запросом GET+TTL к Redis"""
+    ensure_invalidation_listener()
+    found, token = token_cache.get(shop)
+    if found:
+        return token
+
     token_key = f"shopify_token:{shop}"
-    token = redis_client.get(token_key)
-    ttl = redis_client.ttl(token_key)  # Проверяем TTL
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.get(token_key)
+    pipe.ttl(token_key)  # Проверяем TTL
+    token, ttl = pipe.execute()
 
     if token:
         if ttl == -1:  # Если у токена нет TTL, устанавливаем его
             redis_client.expire(token_key, 2592000)  # 30 дней
-            print(f"🔄 Обновлён TTL токена для {shop} (30 дней)")
+            logger.info(f"🔄 Обновлён TTL токена для {shop} (30 дней)")
+            ttl = 2592000
 
-        print(f"📥 Токен из Redis для {shop}: {token[:8]}*** (TTL: {ttl} сек)")
+        token_cache.set(shop, token, ttl=min(TOKEN_CACHE_TTL, ttl))
         return token
     else:
-        print(f"❌ Токен не найден в Redis для {shop} (TTL: {ttl} сек)")
+        logger.error(f"❌ Токен не найден в Redis для {shop} (TTL: {ttl} сек)")
         return None
 
 
 @app.route("/")
 def home():
     shop = request.args.get("shop") or request.cookies.get("shop")
-    print(f"🛒 Получен запрос на / с параметром shop: {shop}")  # Логируем запрос
+    logger.info(f"🛒 Получен запрос на / с параметром shop: {shop}")  # Логируем запрос
 
     if not shop:
-        print("❌ Ошибка: отсутствует параметр 'shop'. Запрос:", request.args, request.cookies)
+        logger.error("❌ Ошибка: отсутствует параметр 'shop'. Запрос: %s %s", request.args, request.cookies)
         return "❌ Ошибка: отсутствует параметр 'shop'.", 400
 
     access_token = get_token(shop)
-    print(f"🔑 Токен для {shop}: {access_token}")
 
     if not access_token:
-        print(f"🔄 Перенаправление на /install?shop={shop}")
+        logger.info(f"🔄 Перенаправление на /install?shop={shop}")
         return redirect(f"/install?shop={shop}")
 
-    print(f"✅ Токен найден, перенаправление на /admin?shop={shop}")
+    logger.info(f"✅ Токен найден, перенаправление на /admin?shop={shop}")
     return redirect(f"/admin?shop={shop}")
 
 
 @app.route("/install")
 def install_app():
     shop = request.args.get("shop")
-    print(f"📦 Установка приложения для: {shop}")
+    logger.info(f"📦 Установка приложения для: {shop}")
 
     if not shop:
-        print("❌ Ошибка: параметр 'shop' отсутствует")
+        logger.error("❌ Ошибка: параметр 'shop' отсутствует")
         return "❌ Ошибка: укажите магазин Shopify", 400
 
     if redis_client.ping():
         session["shop"] = shop
     else:
-        print("⚠️ Redis не подключен. Пропускаем установку сессии.")
+        logger.warning("⚠️ Redis не подключен. Пропускаем установку сессии.")
     authorization_url = (
         f"https://{shop}/admin/oauth/authorize"
         f"?client_id={SHOPIFY_CLIENT_ID}"
@@ -155,7 +462,7 @@ def install_app():
         f"&redirect_uri={REDIRECT_URI}"
     )
 
-    print(f"🔗 Перенаправление на Shopify OAuth: {authorization_url}")
+    logger.info(f"🔗 Перенаправление на Shopify OAuth: {authorization_url}")
     return redirect(authorization_url)
 
 
@@ -164,12 +471,11 @@ def auth_callback():
     shop = request.args.get("shop")
     code = request.args.get("code")
 
-    print(f"📞 Вызван `auth_callback`")
-    print(f"🔍 Получен shop: {shop}")
-    print(f"🔍 Получен code: {code}")
+    logger.info(f"📞 Вызван `auth_callback`")
+    logger.info(f"🔍 Получен shop: {shop}")
 
     if not code or not shop:
-        print("❌ Ошибка: отсутствует `code` или `shop` в `auth_callback`.")
+        logger.error("❌ Ошибка: отсутствует `code` или `shop` в `auth_callback`.")
         return "❌ Ошибка авторизации: отсутствует `code` или `shop`", 400
 
     token_url = f"https://{shop}/admin/oauth/access_token"
@@ -179,41 +485,142 @@ def auth_callback():
         "code": code
     }
 
-    print(f"🔗 Отправляем запрос на {token_url} с данными: {data}")
+    logger.info(f"🔗 Запрашиваем токен {shop}: {token_url}")  # Без data: там client_secret и code
 
-    response = requests.post(token_url, json=data)
+    # Разовый запрос без пула: shop ещё не проверен, и заводить под него постоянную сессию нельзя
+    response = requests.post(token_url, json=data, timeout=SHOPIFY_HTTP_TIMEOUT)
 
-    print(f"📦 Ответ Shopify: {response.status_code} | {response.text}")
+    logger.info(f"📦 Ответ Shopify: {response.status_code}")
 
     if response.status_code != 200:
-        print(f"❌ Ошибка авторизации! Shopify вернул {response.status_code} | {response.text}")
+        logger.error(f"❌ Ошибка авторизации! Shopify вернул {response.status_code} | {response.text}")
         return f"❌ Ошибка авторизации: {response.status_code} - {response.text}", 400
 
     try:
         json_response = response.json()
         access_token = json_response.get("access_token")
         if not access_token:
-            print("❌ Ошибка: `access_token` отсутствует в ответе Shopify!")
+            logger.error("❌ Ошибка: `access_token` отсутствует в ответе Shopify!")
             return f"❌ Ошибка: `access_token` не найден в ответе Shopify: {json_response}", 400
 
-        print(f"✅ Shopify вернул токен: {access_token[:8]}***")
+        logger.info(f"✅ Shopify вернул токен: {access_token[:8]}***")
 
         # Сохраняем токен в Redis
         save_token(shop, access_token)
+        session["verified_shop"] = shop  # Обмен кода прошёл — магазин подтверждён Shopify
 
         response = make_response(redirect(f"/admin?shop={shop}"))
         response.set_cookie("shop", shop, httponly=True, samesite="None", secure=True)
 
         if redis_client.ping():
+            register_shopify_webhooks(shop, access_token)  # После переустановки старые подписки удалены
             start_sync_for_shop(shop, access_token)
         else:
-            print("⚠️ Redis не подключен. Синхронизация не запущена.")
+            logger.warning("⚠️ Redis не подключен. Синхронизация не запущена.")
 
     except Exception as e:
-        print(f"❌ Ошибка обработки JSON ответа Shopify: {e}")
+        logger.error(f"❌ Ошибка обработки JSON ответа Shopify: {e}")
         return f"❌ Ошибка обработки JSON ответа Shopify: {str(e)}", 400
 
 
+SESSION_TOKEN_LEEWAY = 10  # Допуск расхождения часов при проверке exp/nbf session token, сек
+
+
+def verify_shopify_session_token(token):
+    """Проверяет session token App Bridge (JWT HS256, подписан секретом приложения) и возвращает магазин.
+    None — подпись, получатель или срок действия не сходятся."""
+    if not SHOPIFY_API_SECRET:
+        return None
+    try:
+        header_b64, payload_b64, signature_b64 = token.split(".")
+        signing_input = f"{header_b64}.{payload_b64}".encode("ascii")
+        signature = base64.urlsafe_b64decode(signature_b64 + "=" * (-len(signature_b64) % 4))
+        header = json.loads(base64.urlsafe_b64decode(header_b64 + "=" * (-len(header_b64) % 4)))
+        payload = json.loads(base64.urlsafe_b64decode(payload_b64 + "=" * (-len(payload_b64) % 4)))
+    except (ValueError, UnicodeError):
+        return None
+    expected = hmac.new(SHOPIFY_API_SECRET.encode("utf-8"), signing_input, hashlib.sha256).digest()
+    if header.get("alg") != "HS256" or not hmac.compare_digest(expected, signature):
+        return None
+
+    now = time.time()
+    audience = payload.get("aud")
+    if (SHOPIFY_CLIENT_ID not in (audience if isinstance(audience, list) else [audience])
+            or float(payload.get("exp", 0)) < now - SESSION_TOKEN_LEEWAY
+            or float(payload.get("nbf", 0)) > now + SESSION_TOKEN_LEEWAY):
+        return None
+    shop = str(payload.get("dest", "")).removeprefix("https://")
+    if not shop or not str(payload.get("iss", "")).startswith(f"https://{shop}/"):
+        return None
+    return shop
+
+
+def authenticated_shop():
+    """Магазин текущего запроса, подтверждённый Shopify: из session token (Authorization: Bearer)
+    или из сессии, открытой после OAuth. Параметр ?shop= и cookie shop доказательством не считаются."""
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        return verify_shopify_session_token(authorization[len("Bearer "):])
+    return session.get("verified_shop")
+
+
+def shop_required(view):
+    """Маршрут данных магазина: магазин передаётся первым аргументом и берётся только из authenticated_shop().
+    Нет подтверждения — 401; в запросе явно указан другой магазин — 403."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        shop = authenticated_shop()
+        if not shop:
+            return jsonify({"status": "error", "message": "❌ Unauthorized"}), 401
+        requested = request.args.get("shop") or request.form.get("shop")
+        if requested and requested != shop:
+            logger.warning(f"🚫 Запрос к {requested} с подтверждением магазина {shop} отклонён.")
+            return jsonify({"status": "error", "message": "❌ Forbidden"}), 403
+        return view(shop, *args, **kwargs)
+    return wrapper
+
+
+# 🔹 Статика админки: имена с хэшем содержимого, поэтому браузер кэширует файлы надолго,
+# а после деплоя с изменёнными файлами сразу получает новые URL
+STATIC_ASSET_MAX_AGE = int(os.getenv("STATIC_ASSET_MAX_AGE", 31536000))  # 1 год
+
+
+def fingerprint_static_assets(folder):
+    """Возвращает {имя файла: имя с хэшем} для файлов статики, например admin.css → admin.1a2b3c4d5e.css"""
+    assets = {}
+    for name in os.listdir(folder):
+        with open(os.path.join(folder, name), "rb") as file:
+            digest = hashlib.sha256(file.read()).hexdigest()[:10]
+        stem, ext = os.path.splitext(name)
+        assets[name] = f"{stem}.{digest}{ext}"
+    return assets
+
+
+STATIC_ASSETS = fingerprint_static_assets(app.static_folder)
+_fingerprinted_assets = {fingerprinted: name for name, fingerprinted in STATIC_ASSETS.items()}
+
+
+@app.template_global()
+def asset_url(name):
+    return f"/assets/{STATIC_ASSETS[name]}"
+
+
+@app.route("/assets/<filename>")
+def static_asset(filename):
+    """Статика по имени с хэшем: содержимое под таким URL никогда не меняется"""
+    name = _fingerprinted_assets.get(filename)
+    if name is None:
+        return "Not found", 404
+    response = send_from_directory(app.static_folder, name, max_age=STATIC_ASSET_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# Шаблон компилируется один раз при запуске; на запрос подставляются только магазин и настройки
+admin_template = app.jinja_env.get_template("admin.html")
+
+
 @app.route("/admin")
 def admin():
     """Встраиваемое приложение в Shopify Admin"""
@@ -221,309 +628,554 @@ def admin():
     access_token = get_token(shop)
 
     if not shop or not access_token:
-        print(f"❌ Ошибка: Токен для {shop} не найден или истёк.")
+        logger.error(f"❌ Ошибка: Токен для {shop} не найден или истёк.")
         return redirect(f"/install?shop={shop}")
 
-    settings = load_settings()
-
-    return render_template_string(f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Shopify Embedded App</title>
-        <script src="https://unpkg.com/@shopify/app-bridge"></script>
-        <script src="https://unpkg.com/@shopify/app-bridge-utils"></script>
-        <script>
-            var AppBridge = window["app-bridge"];
-            var createApp = AppBridge.createApp;
-            var actions = AppBridge.actions;
-            var Redirect = actions.Redirect;
-
-            var app = createApp({{
-                apiKey: "{SHOPIFY_CLIENT_ID}",
-                shopOrigin: "{shop}",
-                forceRedirect: true
-            }});
-        </script>
-          <style>
-            body {{
-                display: flex;
-                justify-content: center;
-                align-items: center;
-                height: 100vh;
-                background-color: #f4f4f4;
-                margin: 0;
-            }}
+    settings = load_settings(shop)
 
-            .container {{
-                width: 40%;
-                background: white;
-                padding-left: 20px;
-                padding-right: 35px;
-                padding-bottom: 10px;
-                border-radius: 10px;
-                box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);
-                text-align: center;
-            }}
+    response = make_response(admin_template.render(shop=shop, api_key=SHOPIFY_CLIENT_ID, settings=settings))
+    response.headers["Cache-Control"] = "no-cache, private"  # Настройки меняются — страницу всегда перепроверяем
+    return response
 
-            .form-group {{
-                margin-bottom: 15px;
-            }}
 
-            label {{
-                font-weight: bold;
-                display: block;
-                margin-bottom: 5px;
-            }}
+# 🔹 Типы записей: декодируются сразу из JSON, храним только используемые поля
+class PowerBodyProduct(msgspec.Struct, gc=False):
+    """Товар из dropshipping.getProductList"""
+    sku: Union[str, int, None] = None
+    product_id: Union[int, str, None] = None
+    name: Optional[str] = None
+    price: Union[float, str, None] = None
+    retail_price: Union[float, str, None, UnsetType] = UNSET  # UNSET — поля нет в ответе
+    qty: Union[float, str, None] = None
+    updated_at: Optional[str] = None
 
-            input {{
-                width: 100%;
-                padding: 8px;
-                border: 1px solid #ccc;
-                border-radius: 5px;
-                font-size: 16px;
-            }}
 
-            button {{
-                background-color: #007bff;
-                color: white;
-                padding: 10px 15px;
-                border: none;
-                border-radius: 5px;
-                font-size: 16px;
-                cursor: pointer;
-                margin-top: 10px;
-            }}
+class ProductInfo(msgspec.Struct, gc=False):
+    """Поля dropshipping.getProductInfo, попадающие в отчёт"""
+    manufacturer: Any = None
+    name: Any = ""
+    weight: Any = 0
+    ean: Any = None
 
-            button:hover {{
-                background-color: #0056b3;
-            }}
 
-            #message {{
-                margin-top: 15px;
-                padding: 10px;
-                border-radius: 5px;
-                display: none;
-                font-weight: bold;
-                font-size: 16px;
-            }}
+class ProductInfoCacheEntry(msgspec.Struct, gc=False):
+    """Запись кэша getProductInfo в Redis: отпечаток из getProductList и нужные поля"""
+    fingerprint: str
+    info: ProductInfo
 
-            .success {{
-                background-color: #d4edda;
-                color: #155724;
-                border: 1px solid #c3e6cb;
-            }}
 
-            .error {{
-                background-color: #f8d7da;
-                color: #721c24;
-                border: 1px solid #f5c6cb;
-            }}
-        </style>
-    </head>
-
-    <body>
-        <div class="container">
-                <h2>Pricing settings</h2>
-                <form id="settingsForm">
-                    <div class="form-group">
-                        <label>VAT (%):</label>
-                        <input type="number" name="vat" value="{settings["vat"]}" step="0.01">
-                    </div>
-                    <div class="form-group">
-                        <label>PayPal Fees (%):</label>
-                        <input type="number" name="paypal_fees" value="{settings["paypal_fees"]}" step="0.01">
-                    </div>
-                    <div class="form-group">
-                        <label>Second PayPal Fees (£):</label>
-                        <input type="number" name="second_paypal_fees" value="{settings["second_paypal_fees"]}" step="0.01">
-                    </div>
-                    <div class="form-group">
-                        <label>Profit Margin (%):</label>
-                        <input type="number" name="profit" value="{settings["profit"]}" step="0.01">
-                    </div>
-                    <button type="submit">Update</button>
-                    <button id="downloadCSV" type="button">Download CSV</button>
-                </form>
-                <p id="message"></p>
-            </div>
-
-
-        <script>
-                document.addEventListener("DOMContentLoaded", function() {{
-                    // Обработчик формы
-                    var settingsForm = document.getElementById('settingsForm');
-                    if (settingsForm) {{
-                        settingsForm.addEventListener('submit', function(event) {{
-                            event.preventDefault();
-                            var formData = new FormData(this);
-
-                            fetch('/update_settings', {{
-                                method: 'POST',
-                                body: formData
-                            }})
-                            .then(response => response.json())
-                            .then(data => {{
-                                let messageElement = document.getElementById('message');
-                                if (messageElement) {{
-                                    messageElement.innerText = data.message;
-                                    messageElement.style.display = 'block';
-                                    setTimeout(() => {{
-                                        messageElement.style.display = 'none';
-                                    }}, 3000);
-                                }}
-                            }})
-                            .catch(error => console.error('Ошибка:', error));
-                        }});
-                    }} else {{
-                        console.error("❌ Форма 'settingsForm' не найдена!");
-                    }}
-
-                    // Обработчик кнопки скачивания CSV
-                        var downloadBtn = document.getElementById('downloadCSV');
-                        if (downloadBtn) {{
-                            downloadBtn.addEventListener('click', function(event) {{
-                                event.preventDefault();
-                                window.location.href = '/download_csv';
-                            }});
-                        }} else {{
-                            console.error("❌ Кнопка 'Download CSV' не найдена!");
-                        }}
-                }});
-        </script>
-    </body>
-    </html>
-    """)
+class CatalogProduct(msgspec.Struct, gc=False, array_like=True):
+    """Товар общего каталога PowerBody (в Redis хранится JSON-массивом)"""
+    sku: Union[str, int]
+    product_id: str
+    price: float
+    qty: Optional[int]
+    fingerprint: str
+    info: Optional[ProductInfo]
 
 
-# 🔄 Получение товаров из PowerBody API
-def fetch_powerbody_products():
-    print("🔄 Запрос товаров из PowerBody API...")
+class PowerBodyCatalog(msgspec.Struct, gc=False):
+    version: str
+    created_at: float
+    products: list[CatalogProduct]
+
+
+class ShopifyVariant(msgspec.Struct, gc=False, array_like=True):
+    """Значение SKU-карты магазина (в зеркале Redis хранится компактным JSON-массивом)"""
+    variant_id: int
+    inventory_item_id: Optional[int]
+    price: Optional[str]
+    quantity: Optional[int]
+    product_id: Optional[int]
+
+
+class ShopifyRestVariant(msgspec.Struct, gc=False):
+    id: int
+    sku: Optional[str] = None
+    price: Optional[str] = None
+    inventory_item_id: Optional[int] = None
+    inventory_quantity: Optional[int] = None
+
+
+class ShopifyRestProduct(msgspec.Struct, gc=False):
+    id: int
+    variants: list[ShopifyRestVariant] = []
+    updated_at: Optional[str] = None
+
+
+class ShopifyInventoryLevel(msgspec.Struct, gc=False):
+    """Тело вебхука inventory_levels/update"""
+    inventory_item_id: int
+    location_id: int
+    available: Optional[int] = None
+    updated_at: Optional[str] = None
+
+
+class ShopifyProductsPage(msgspec.Struct, gc=False):
+    products: list[ShopifyRestProduct] = []
+
+
+class ShopifyGid(msgspec.Struct, gc=False):
+    id: str
+
+
+class ShopifyBulkVariant(msgspec.Struct, gc=False):
+    """Строка JSONL bulk-экспорта productVariants"""
+    id: str
+    sku: Optional[str] = None
+    price: Optional[str] = None
+    inventoryQuantity: Optional[int] = None
+    product: Optional[ShopifyGid] = None
+    inventoryItem: Optional[ShopifyGid] = None
+
+
+powerbody_products_decoder = msgspec.json.Decoder(list[PowerBodyProduct])
+shopify_page_decoder = msgspec.json.Decoder(ShopifyProductsPage)
+shopify_bulk_variant_decoder = msgspec.json.Decoder(ShopifyBulkVariant)
+catalog_decoder = msgspec.json.Decoder(PowerBodyCatalog)
+shopify_product_decoder = msgspec.json.Decoder(ShopifyRestProduct)
+shopify_inventory_level_decoder = msgspec.json.Decoder(ShopifyInventoryLevel)
+shopify_variant_decoder = msgspec.json.Decoder(ShopifyVariant)
+product_info_decoder = msgspec.json.Decoder(ProductInfo)
+product_info_cache_decoder = msgspec.json.Decoder(ProductInfoCacheEntry)
+
+
+def decode_powerbody_products(response):
+    """Ответ getProductList (строка JSON или уже разобранный список) → list[PowerBodyProduct].
+    Если в списке попались не-объекты, они пропускаются, а не ломают всю загрузку."""
     try:
-        client = Client(WSDL_URL)
-        session = client.service.login(USERNAME, PASSWORD)
-        response = client.service.call(session, "dropshipping.getProductList", [])
+        if isinstance(response, (str, bytes)):
+            return powerbody_products_decoder.decode(response)
+        return msgspec.convert(response, list[PowerBodyProduct])
+    except msgspec.ValidationError:
+        items = json.loads(response) if isinstance(response, (str, bytes)) else response
+        if not isinstance(items, list):
+            return []
+        products = []
+        for item in items:
+            try:
+                products.append(msgspec.convert(item, PowerBodyProduct))
+            except msgspec.ValidationError:
+                continue
+        return products
+
+
+def base_price_of(pb_product):
+    """retail_price, если поле есть в ответе, иначе price"""
+    price = pb_product.price if pb_product.retail_price is UNSET else pb_product.retail_price
+    return float(price or 0.00)
+
+
+class PowerBodyClient:
+    """Долгоживущий SOAP-клиент PowerBody: WSDL кэшируется на диске, сессии переиспользуются из пула"""
+
+    def __init__(self, wsdl_url, username, password, pool_size=4, session_ttl=1800):
+        self.wsdl_url = wsdl_url
+        self.username = username
+        self.password = password
+        self.session_ttl = session_ttl
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._idle_sessions = queue.LifoQueue()  # (session_id, время логина)
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    @property
+    def client(self):
+        """Создаёт zeep-клиент один раз; WSDL берётся из дискового кэша"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    logger.info(f"🔄 Загрузка WSDL PowerBody (кэш: {POWERBODY_WSDL_CACHE})...")
+                    cache = SqliteCache(path=POWERBODY_WSDL_CACHE, timeout=POWERBODY_WSDL_CACHE_TTL)
+                    self._client = Client(self.wsdl_url, transport=Transport(cache=cache))
+        return self._client
+
+    def _login(self):
+        session_id = self.client.service.login(self.username, self.password)
+        logger.info("🔑 Открыта новая сессия PowerBody")
+        return session_id, time.monotonic()
+
+    def _end_session(self, session_id):
+        try:
+            self.client.service.endSession(session_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось закрыть сессию PowerBody: {e}")
 
-        if isinstance(response, str):
+    def _checkout(self):
+        """Берёт свободную живую сессию из пула или логинится заново"""
+        while True:
+            try:
+                session_id, created = self._idle_sessions.get_nowait()
+            except queue.Empty:
+                return self._login()
+            if time.monotonic() - created < self.session_ttl:
+                return session_id, created
+            self._end_session(session_id)  # Сессия устарела — закрываем и берём следующую
+
+    @staticmethod
+    def _is_session_expired(error):
+        return isinstance(error, Fault) and (
+            str(error.code) == "5" or "session expired" in str(error).lower()
+        )
+
+    def call(self, method, params=None):
+        """Вызывает метод API на сессии из пула; при истёкшей сессии логинится повторно"""
+        with self._slots:
+            session = self._checkout()
+            try:
+                try:
+                    return self.client.service.call(session[0], method, params)
+                except Fault as e:
+                    if not self._is_session_expired(e):
+                        raise
+                    logger.info(f"🔄 Сессия PowerBody истекла во время `{method}`. Повторный логин...")
+                    session = self._login()
+                    return self.client.service.call(session[0], method, params)
+            finally:
+                self._idle_sessions.put(session)
+
+    def close(self):
+        """Закрывает все сессии пула"""
+        if self._client is None:
+            return
+        while True:
             try:
-                response = json.loads(response)
-            except json.JSONDecodeError:
-                print("❌ Ошибка декодирования JSON")
-                return []
+                session_id, _ = self._idle_sessions.get_nowait()
+            except queue.Empty:
+                break
+            self._end_session(session_id)
 
-        if not isinstance(response, list):
-            return []
 
-        print(f"✅ Загружено товаров: {len(response)}")
-        client.service.endSession(session)
-        # 🔹 Проверка структуры первого товара
-        if response:
-            print(f"🔍 Пример товара: {json.dumps(response[0], indent=4, ensure_ascii=False)}")
+# 🔹 Единый клиент PowerBody для всех запросов
+powerbody = PowerBodyClient(WSDL_URL, USERNAME, PASSWORD, POWERBODY_POOL_SIZE, POWERBODY_SESSION_TTL)
+atexit.register(powerbody.close)
 
-        return response
 
+# 🔄 Получение товаров из PowerBody API
+def fetch_powerbody_products():
+    logger.info("🔄 Запрос товаров из PowerBody API...")
+    try:
+        response = powerbody.call("dropshipping.getProductList", [])
+        products = decode_powerbody_products(response)
+        logger.info(f"✅ Загружено товаров: {len(products)}")
+        return products
+
+    except (msgspec.DecodeError, json.JSONDecodeError):
+        logger.error("❌ Ошибка декодирования JSON")
+        return []
     except Exception as e:
-        print(f"❌ Ошибка получения товаров: {e}")
+        logger.error(f"❌ Ошибка получения товаров: {e}")
         return []
 
 
 def fetch_product_info(product_id):
-    """Запрос информации о товаре через dropshipping.getProductInfo с обработкой ошибки 403"""
-    print(f"🔄 Запрос информации о товаре {product_id}...")
+    """Запрос информации о товаре через dropshipping.getProductInfo с обработкой ошибок 403/503"""
+    sku_logger.debug("🔄 Запрос информации о товаре %s...", product_id)
 
-    client = None  # ✅ Инициализируем client заранее
-    session = None
-    max_retries = 3  # Количество попыток повторного подключения
-    delay = 15  # Начальная задержка перед повтором
+    max_retries = 3  # Количество повторных попыток
+    delay = POWERBODY_RETRY_DELAY  # Начальная задержка перед повтором
+    params = json.dumps({"id": str(product_id)})  # Преобразуем в строку JSON
 
     for attempt in range(max_retries):
         try:
-            print(f"🔄 Попытка {attempt + 1} подключения к WSDL...")
-            client = Client(WSDL_URL)  # 🛠️ Попытка создать клиента SOAP
-            session = client.service.login(USERNAME, PASSWORD)
-            break  # Если успех — выходим из цикла
-
+            response = powerbody.call("dropshipping.getProductInfo", params)
         except Exception as e:
-            print(f"⚠️ Ошибка при подключении к WSDL: {e}")
-            if "403" in str(e):
-                print(f"⚠️ Ошибка 403. Ждём {delay} сек перед повторной попыткой...")
+            if "403" in str(e) or "503" in str(e):
+                logger.warning(f"⚠️ Ошибка {e} для товара {product_id} (попытка {attempt + 1}). Ждём {delay} сек перед повтором...")
+                POWERBODY_RETRIES_TOTAL.labels("403" if "403" in str(e) else "503").inc()
+                BACKOFF_SLEEP_SECONDS_TOTAL.labels("powerbody").inc(delay)
                 time.sleep(delay)
                 delay *= 2  # Увеличиваем задержку
-            else:
-                return None  # Прекращаем выполнение при других ошибках
+                continue
 
-    if not client or not session:
-        print(f"❌ Не удалось подключиться к API PowerBody. Пропускаем товар {product_id}.")
-        return None
+            logger.error(f"❌ Ошибка получения информации о товаре {product_id}: {e}")
+            return None
 
-    try:
-        params = json.dumps({"id": str(product_id)})  # Преобразуем в строку JSON
-        response = client.service.call(session, "dropshipping.getProductInfo", params)
+        try:
+            if isinstance(response, (str, bytes)):
+                return product_info_decoder.decode(response)
+            return msgspec.convert(response, ProductInfo)
+        except (msgspec.DecodeError, msgspec.ValidationError) as e:
+            logger.error(f"❌ Ошибка декодирования ответа getProductInfo для товара {product_id}: {e}")
+            return None
+
+    logger.error(f"❌ Не удалось получить информацию о товаре {product_id} после {max_retries} попыток. Пропускаем.")
+    return None
 
-        if isinstance(response, str):
-            try:
-                response = json.loads(response)
-            except json.JSONDecodeError:
-                print(f"❌ Ошибка декодирования JSON для товара {product_id}")
-                return None
 
-        client.service.endSession(session)
-        return response
+# 🔹 Кэш dropshipping.getProductInfo в Redis
+PRODUCT_INFO_KEY = "powerbody_product_info:{}"
 
-    except Exception as e:
-        # 🛑 Если ошибка 403, пытаемся сделать повторный запрос
-        if "403" in str(e):
-            print(f"❌ Ошибка 403: Доступ запрещен для товара {product_id}. Логируем полный ответ...")
 
+def product_list_fingerprint(pb_product):
+    """Отпечаток метаданных товара из getProductList (без цены и остатка, которые меняются постоянно)"""
+    metadata = (pb_product.sku, pb_product.product_id, pb_product.name, pb_product.updated_at)
+    return hashlib.sha1(msgspec.json.encode(metadata)).hexdigest()[:16]
+
+
+def load_cached_product_info(fingerprints):
+    """Достаёт из Redis закэшированную информацию о товарах: {product_id: fingerprint} → {product_id: info}.
+    Запись, у которой отпечаток из getProductList изменился, считается устаревшей и удаляется."""
+    product_ids = list(fingerprints)
+    cached = {}
+    stale_keys = []
+
+    for i in range(0, len(product_ids), 500):
+        chunk = product_ids[i:i + 500]
+        values = redis_client.mget([PRODUCT_INFO_KEY.format(pid) for pid in chunk])
+        for pid, value in zip(chunk, values):
+            if not value:
+                continue
             try:
-                response = client.service.call(session, "dropshipping.getProductInfo", {"id": str(product_id)})
-                print(json.dumps(response, indent=4, ensure_ascii=False))
-            except Exception as err:
-                print(f"⚠️ Ошибка при повторном запросе для логирования: {err}")
+                entry = product_info_cache_decoder.decode(value)
+            except (msgspec.DecodeError, msgspec.ValidationError):
+                entry = None
+            if entry is not None and entry.fingerprint == fingerprints[pid]:
+                cached[pid] = entry.info
+            else:
+                stale_keys.append(PRODUCT_INFO_KEY.format(pid))
 
-        if "503" in str(e):
-            print(f"⚠️ Ошибка 503 (Сервис недоступен). Ждём {delay} сек перед повтором...")
-            time.sleep(delay)
-            delay *= 2
+    if stale_keys:
+        redis_client.delete(*stale_keys)
+        logger.info(f"🔄 Метаданные изменились у {len(stale_keys)} товаров — кэш getProductInfo сброшен")
+
+    logger.info(f"📦 Кэш getProductInfo: {len(cached)} из {len(product_ids)} товаров")
+    return cached
 
-        else:
-            print(f"❌ Ошибка получения информации о товаре {product_id}: {e}")
 
+def fetch_and_cache_product_info(product_id, fingerprint):
+    """Запрашивает getProductInfo и сохраняет нужные поля в Redis"""
+    product_info = fetch_product_info(product_id)
+    if product_info is None:
         return None
 
+    entry = ProductInfoCacheEntry(fingerprint=fingerprint, info=product_info)
+    redis_client.set(PRODUCT_INFO_KEY.format(product_id), msgspec.json.encode(entry), ex=PRODUCT_INFO_CACHE_TTL)
+    return product_info
+
+
+def enrich_products(matched_products):
+    """Дополняет товары информацией из getProductInfo и отдаёт их по мере готовности.
+    matched_products — список (pb_product, sku, product_id, fingerprint); выдаёт (item, product_info).
+    Закэшированные товары отдаются сразу, остальные запрашиваются параллельно, не более POWERBODY_CONCURRENCY."""
+    cached_product_info = load_cached_product_info({item[2]: item[3] for item in matched_products})
+
+    missing = []
+    for item in matched_products:
+        product_info = cached_product_info.get(item[2])
+        if product_info is None:
+            missing.append(item)
+        else:
+            yield item, product_info
+
+    if not missing:
+        return
+
+    logger.info(f"🔄 Запрос getProductInfo для {len(missing)} товаров (потоков: {POWERBODY_CONCURRENCY})...")
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=POWERBODY_CONCURRENCY, thread_name_prefix="powerbody")
+    pending_items = iter(missing)
+    futures = {}
+    try:
+        # В очереди пула держим не больше окна: новые запросы подаются по мере завершения предыдущих
+        for item in itertools.islice(pending_items, POWERBODY_CONCURRENCY * 2):
+            futures[pool.submit(fetch_and_cache_product_info, item[2], item[3])] = item
+        while futures:
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                item = futures.pop(future)
+                next_item = next(pending_items, None)
+                if next_item is not None:
+                    futures[pool.submit(fetch_and_cache_product_info, next_item[2], next_item[3])] = next_item
+                try:
+                    product_info = future.result()
+                except Exception as e:
+                    logger.error(f"❌ Ошибка получения информации о товаре {item[2]}: {e}")
+                    product_info = None
+                yield item, product_info
+    finally:
+        # Если синхронизация прервана — отменяем ещё не начатые запросы окна и не ждём уже идущие
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ShopifyRateLimiter:
+    """Leaky bucket для одного магазина, общий для всех потоков.
+    REST: уровень корзины берётся из X-Shopify-Shop-Api-Call-Limit и утекает со скоростью SHOPIFY_REST_LEAK_RATE.
+    GraphQL: бюджет баллов берётся из extensions.cost.throttleStatus.
+    Retry-After и THROTTLED останавливают все потоки магазина до указанного момента."""
+
+    def __init__(self, rest_capacity=40, rest_leak_rate=SHOPIFY_REST_LEAK_RATE):
+        self._lock = threading.Lock()
+        self.rest_capacity = rest_capacity
+        self.rest_leak_rate = rest_leak_rate
+        self.rest_level = 0.0
+        self.rest_updated = time.monotonic()
+        self.graphql_maximum = 1000.0
+        self.graphql_available = 1000.0
+        self.graphql_restore_rate = 50.0
+        self.graphql_updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _leak(self, now):
+        self.rest_level = max(0.0, self.rest_level - (now - self.rest_updated) * self.rest_leak_rate)
+        self.rest_updated = now
+        self.graphql_available = min(self.graphql_maximum,
+                                     self.graphql_available + (now - self.graphql_updated) * self.graphql_restore_rate)
+        self.graphql_updated = now
+
+    def acquire_rest(self):
+        """Резервирует место под один REST-запрос; ждёт ровно столько, сколько нужно корзине"""
+        with self._lock:
+            now = time.monotonic()
+            self._leak(now)
+            wait = max(0.0, self.paused_until - now)
+            overflow = self.rest_level + 1 - self.rest_capacity
+            if overflow > 0:
+                wait = max(wait, overflow / self.rest_leak_rate)
+            self.rest_level += 1  # Резерв: следующие потоки увидят уже занятое место
+        if wait > 0:
+            BACKOFF_SLEEP_SECONDS_TOTAL.labels("shopify_rest").inc(wait)
+            time.sleep(wait)
+
+    def acquire_graphql(self, cost):
+        """Резервирует баллы под GraphQL-запрос с ожидаемой стоимостью cost"""
+        with self._lock:
+            now = time.monotonic()
+            self._leak(now)
+            wait = max(0.0, self.paused_until - now)
+            cost = min(cost, self.graphql_maximum)
+            if self.graphql_available < cost:
+                wait = max(wait, (cost - self.graphql_available) / self.graphql_restore_rate)
+            self.graphql_available -= cost
+        if wait > 0:
+            BACKOFF_SLEEP_SECONDS_TOTAL.labels("shopify_graphql").inc(wait)
+            time.sleep(wait)
+
+    def update_rest(self, response):
+        """Синхронизирует уровень корзины с ответом Shopify"""
+        api_limit = response.headers.get("X-Shopify-Shop-Api-Call-Limit")
+        if not api_limit:
+            return
+        try:
+            current_calls, max_calls = map(int, api_limit.split("/"))
+        except ValueError:
+            return
+        with self._lock:
+            self.rest_capacity = max_calls
+            self.rest_level = float(current_calls)
+            self.rest_updated = time.monotonic()
+
+    def update_graphql(self, body):
+        throttle = (((body or {}).get("extensions") or {}).get("cost") or {}).get("throttleStatus")
+        if not throttle:
+            return
+        with self._lock:
+            self.graphql_maximum = float(throttle.get("maximumAvailable", self.graphql_maximum))
+            self.graphql_available = float(throttle.get("currentlyAvailable", self.graphql_available))
+            self.graphql_restore_rate = float(throttle.get("restoreRate", self.graphql_restore_rate))
+            self.graphql_updated = time.monotonic()
+
+    def available_graphql(self):
+        with self._lock:
+            self._leak(time.monotonic())
+            return self.graphql_available
+
+    def pause(self, seconds):
+        """Останавливает все запросы магазина (429 / Retry-After / THROTTLED)"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.rest_level = self.rest_capacity  # После 429 корзина точно полна
+
+
+class ShopifySession(requests.Session):
+    """requests.Session с пулом keep-alive соединений, общими заголовками и таймаутом по умолчанию"""
+
+    def __init__(self, pool_size=SHOPIFY_HTTP_POOL_SIZE, timeout=SHOPIFY_HTTP_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+        self.headers.update({"Content-Type": "application/json", "Accept": "application/json"})
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+_shopify_sessions = {}
+_shopify_sessions_lock = threading.Lock()
+
+
+def get_shopify_session(shop):
+    """Одна HTTP-сессия на магазин: переиспользуется всей синхронизацией и всеми потоками планировщика"""
+    with _shopify_sessions_lock:
+        http = _shopify_sessions.get(shop)
+        if http is None:
+            http = _shopify_sessions[shop] = ShopifySession()
+        return http
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(shop):
+    """Один лимитер на магазин для всех потоков"""
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(shop)
+        if limiter is None:
+            limiter = _rate_limiters[shop] = ShopifyRateLimiter()
+        return limiter
+
+
+def shopify_admin_url(shop, resource):
+    """URL ресурса Admin API магазина, например products.json"""
+    return f"{SHOPIFY_ADMIN_URL.format(shop=shop)}/admin/api/{SHOPIFY_API_VERSION}/{resource}"
+
+
+def shopify_request(shop, access_token, method, url, max_retries=SHOPIFY_MAX_RETRIES, **kwargs):
+    """REST-запрос к Shopify через лимитер магазина; при 429 ждёт Retry-After и повторяет"""
+    limiter = get_rate_limiter(shop)
+    http = get_shopify_session(shop)
+    headers = {"X-Shopify-Access-Token": access_token}
+    response = None
+
+    for attempt in range(max_retries):
+        limiter.acquire_rest()
+        response = http.request(method, url, headers=headers, **kwargs)
+        limiter.update_rest(response)
+
+        if response.status_code != 429:
+            return response
+
+        retry_after = float(response.headers.get("Retry-After", 2 ** (attempt + 1)))
+        SHOPIFY_THROTTLED_TOTAL.labels("rest").inc()
+        logger.warning(f"⚠️ Ошибка 429 (Too Many Requests) {method} {url}. Ждём {retry_after} секунд...")
+        limiter.pause(retry_after)
+
+    logger.error("🚨 Превышено количество повторных попыток запроса.")
+    return response
+
+
 def fetch_all_shopify_products(shop, access_token):
-    print("🔄 Запрос товаров из Shopify API...")
-    shopify_url = f"https://{shop}/admin/api/2024-01/products.json"
-    headers = {"Content-Type": "application/json", "X-Shopify-Access-Token": access_token}
+    """Все товары магазина постранично. None — если какую-то страницу получить не удалось:
+    неполный список нельзя выдавать за весь магазин."""
+    logger.info("🔄 Запрос товаров из Shopify API...")
+    shopify_url = shopify_admin_url(shop, "products.json")
     params = {"fields": "id,variants", "limit": 250}
     all_products = []
 
     while True:
-        time.sleep(0.6)  # ⏳ Shopify API ограничение: не более 2 запросов в секунду
-        response = requests.get(shopify_url, headers=headers, params=params)
-
-        if response.status_code == 429:  # Ошибка Too Many Requests
-            retry_after = float(response.headers.get("Retry-After", 5))  # Исправлено: используем float
-            print(f"⚠️ Ошибка 429 (Too Many Requests). Ждём {retry_after} секунд...")
-            time.sleep(retry_after)  # Ждём перед повторной отправкой
-            continue  # Повторяем запрос
+        # ⏳ Темп задаёт лимитер магазина по X-Shopify-Shop-Api-Call-Limit
+        response = shopify_request(shop, access_token, "GET", shopify_url, params=params)
 
         if response.status_code != 200:
-            print(f"❌ Ошибка Shopify API: {response.status_code} | {response.text}")
-            break
+            logger.error(f"❌ Ошибка Shopify API: {response.status_code} | {response.text}")
+            return None
 
-        products = response.json().get("products", [])
+        products = shopify_page_decoder.decode(response.content).products
         all_products.extend(products)
-        print(f"📦 Получено товаров: {len(products)}, всего: {len(all_products)}")
-
-        # 🛑 Проверка лимитов API
-        api_limit = response.headers.get("X-Shopify-Shop-Api-Call-Limit", "0/40")
-        current_calls, max_calls = map(int, api_limit.split("/"))
-        print(f"📊 Лимит API: {current_calls}/{max_calls}")
-
-        if current_calls > max_calls * 0.8:  # Если загрузка API более 80%
-            print(f"⚠️ API загружен ({current_calls}/{max_calls}). Ждём 2 сек...")
-            time.sleep(2)  # Дополнительная пауза
+        logger.info(f"📦 Получено товаров: {len(products)}, всего: {len(all_products)}")
 
         # Проверяем, есть ли следующая страница
         link_header = response.headers.get("Link")
@@ -532,17 +1184,431 @@ def fetch_all_shopify_products(shop, access_token):
                 next_page_info = [l.split(";")[0].strip("<>") for l in link_header.split(",") if 'rel="next"' in l][0]
                 params["page_info"] = next_page_info.split("page_info=")[1]
             except Exception as e:
-                print(f"❌ Ошибка парсинга page_info: {e}")
-                break
+                logger.error(f"❌ Ошибка парсинга page_info: {e}")
+                return None
         else:
             break  # Если нет следующей страницы, выходим
 
-    print(f"✅ Всего товаров в Shopify: {len(all_products)}")
+    logger.info(f"✅ Всего товаров в Shopify: {len(all_products)}")
     return all_products
 
 
 
 
+def shopify_graphql(shop, access_token, query, variables=None, cost=SHOPIFY_MUTATION_COST,
+                    max_retries=SHOPIFY_MAX_RETRIES):
+    """Выполняет GraphQL-запрос к Shopify Admin API через лимитер магазина.
+    cost — ожидаемая стоимость запроса в баллах; при 429 и THROTTLED запрос повторяется."""
+    url = shopify_admin_url(shop, "graphql.json")
+    headers = {"X-Shopify-Access-Token": access_token}
+    limiter = get_rate_limiter(shop)
+    http = get_shopify_session(shop)
+
+    for attempt in range(max_retries):
+        limiter.acquire_graphql(cost)
+        response = http.post(url, headers=headers, json={"query": query, "variables": variables or {}})
+
+        if response.status_code == 429:
+            retry_after = float(response.headers.get("Retry-After", 2 ** (attempt + 1)))
+            SHOPIFY_THROTTLED_TOTAL.labels("graphql").inc()
+            logger.warning(f"⚠️ Ошибка 429 (Too Many Requests) GraphQL. Ждём {retry_after} секунд...")
+            limiter.pause(retry_after)
+            continue
+
+        if response.status_code != 200:
+            logger.error(f"❌ Ошибка Shopify GraphQL: {response.status_code} | {response.text}")
+            return None
+
+        body = response.json()
+        limiter.update_graphql(body)
+        errors = body.get("errors") or []
+        if any((e.get("extensions") or {}).get("code") == "THROTTLED" for e in errors):
+            throttle = ((body.get("extensions") or {}).get("cost") or {}).get("throttleStatus") or {}
+            restore_rate = float(throttle.get("restoreRate") or 50)
+            wait = max(1.0, (cost - float(throttle.get("currentlyAvailable", 0))) / restore_rate)
+            SHOPIFY_THROTTLED_TOTAL.labels("graphql").inc()
+            logger.warning(f"⚠️ GraphQL THROTTLED. Повтор через {wait:.1f} секунд...")
+            limiter.pause(wait)
+            continue
+
+        if errors:
+            logger.error(f"❌ Ошибка Shopify GraphQL: {errors}")
+        return body
+
+    logger.error("🚨 Превышено количество повторных попыток GraphQL-запроса.")
+    return None
+
+
+def shopify_gid_to_id(gid):
+    """gid://shopify/ProductVariant/123 → 123"""
+    return int(gid.rsplit("/", 1)[-1]) if gid else None
+
+
+SHOPIFY_BULK_VARIANTS_QUERY = """
+mutation {
+  bulkOperationRunQuery(query: \"\"\"
+    {
+      productVariants {
+        edges {
+          node { id sku price inventoryQuantity product { id } inventoryItem { id } }
+        }
+      }
+    }
+  \"\"\") {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+SHOPIFY_BULK_STATUS_QUERY = """
+{ currentBulkOperation { id status errorCode objectCount url } }
+"""
+
+
+def run_shopify_bulk_export(shop, access_token):
+    """Запускает bulk-экспорт вариантов и ждёт его завершения. Возвращает URL JSONL-файла ("" если вариантов нет)"""
+    body = shopify_graphql(shop, access_token, SHOPIFY_BULK_VARIANTS_QUERY)
+    result = ((body or {}).get("data") or {}).get("bulkOperationRunQuery") or {}
+    if not result.get("bulkOperation"):
+        logger.error(f"❌ Не удалось запустить bulk-экспорт для {shop}: {result.get('userErrors') or body}")
+        return None
+
+    operation_id = result["bulkOperation"]["id"]
+    logger.info(f"🔄 Bulk-экспорт вариантов запущен для {shop}: {operation_id}")
+
+    delay = 1
+    deadline = time.monotonic() + SHOPIFY_BULK_POLL_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 10)  # Опрашиваем всё реже, но не реже раза в 10 сек
+
+        body = shopify_graphql(shop, access_token, SHOPIFY_BULK_STATUS_QUERY)
+        operation = ((body or {}).get("data") or {}).get("currentBulkOperation") or {}
+        if operation.get("id") != operation_id:
+            continue
+
+        status = operation.get("status")
+        if status == "COMPLETED":
+            logger.info(f"✅ Bulk-экспорт завершён: {operation.get('objectCount')} объектов")
+            return operation.get("url") or ""
+        if status in ("FAILED", "CANCELED", "EXPIRED"):
+            logger.error(f"❌ Bulk-экспорт {status} для {shop}: {operation.get('errorCode')}")
+            return None
+
+    logger.error(f"❌ Bulk-экспорт для {shop} не завершился за {SHOPIFY_BULK_POLL_TIMEOUT} сек")
+    return None
+
+
+def fetch_shopify_sku_map_bulk(shop, access_token):
+    """Строит SKU-карту по bulk-экспорту: JSONL читается потоково, построчно"""
+    url = run_shopify_bulk_export(shop, access_token)
+    if url is None:
+        return None
+
+    sku_map = {}
+    if not url:
+        return sku_map
+
+    try:
+        with get_shopify_session(shop).get(url, stream=True, timeout=300) as response:
+            if response.status_code != 200:
+                logger.error(f"❌ Ошибка загрузки результата bulk-экспорта: {response.status_code}")
+                return None
+
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                variant = shopify_bulk_variant_decoder.decode(line)
+                if not variant.sku:
+                    continue
+                sku_map[variant.sku] = ShopifyVariant(
+                    shopify_gid_to_id(variant.id),
+                    shopify_gid_to_id(variant.inventoryItem.id) if variant.inventoryItem else None,
+                    variant.price,
+                    variant.inventoryQuantity,
+                    shopify_gid_to_id(variant.product.id) if variant.product else None,
+                )
+    except (requests.RequestException, msgspec.DecodeError) as e:
+        # Обрыв загрузки или недокачанная строка — неполная карта хуже, чем никакой
+        logger.error(f"❌ Результат bulk-экспорта {shop} загружен не полностью: {e}")
+        return None
+
+    logger.info(f"✅ Всего SKU в Shopify (bulk): {len(sku_map)}")
+    return sku_map
+
+
+def fetch_shopify_sku_map(shop, access_token):
+    """SKU → ShopifyVariant для всех вариантов магазина. None — если выгрузить магазин целиком не удалось"""
+    if SHOPIFY_FETCH_MODE == "bulk":
+        sku_map = fetch_shopify_sku_map_bulk(shop, access_token)
+        if sku_map is not None:
+            return sku_map
+        logger.warning("⚠️ Bulk-экспорт недоступен. Загружаем товары через REST...")
+
+    shopify_products = fetch_all_shopify_products(shop, access_token)
+    if shopify_products is None:
+        return None
+    return {
+        v.sku: ShopifyVariant(v.id, v.inventory_item_id, v.price, v.inventory_quantity, p.id)
+        for p in shopify_products for v in p.variants if v.sku
+    }
+
+
+# 🔹 Зеркало вариантов Shopify в Redis: держится актуальным вебхуками, периодически сверяется полностью
+SHOPIFY_MIRROR_KEY = "shopify_mirror:{}"  # SKU → ShopifyVariant
+SHOPIFY_MIRROR_ITEMS_KEY = "shopify_mirror:{}:items"  # inventory_item_id → SKU
+SHOPIFY_MIRROR_PRODUCTS_KEY = "shopify_mirror:{}:products"  # product_id → JSON-список SKU
+SHOPIFY_MIRROR_META_KEY = "shopify_mirror:{}:meta"  # reconciled_at, webhooks
+SHOPIFY_MIRROR_LOCK_KEY = "shopify_mirror:{}:lock"
+SHOPIFY_MIRROR_UPDATED_KEY = "shopify_mirror:{}:updated_at"  # product:<id> / item:<id> → updated_at последнего вебхука
+SHOPIFY_WEBHOOK_SEEN_KEY = "shopify_webhook_seen:{}"  # X-Shopify-Webhook-Id — защита от повторной доставки
+
+# Сравнение с сохранённым updated_at и запись нового — одним скриптом, чтобы два одновременных вебхука
+# одного товара не прошли проверку оба (KEYS: хэш updated_at; ARGV: поле, время в секундах)
+CLAIM_WEBHOOK_UPDATE_SCRIPT = redis_client.register_script("""
+local stored = redis.call("HGET", KEYS[1], ARGV[1])
+if stored and tonumber(stored) > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+return 1
+""")
+
+
+def mirror_keys(shop):
+    return (SHOPIFY_MIRROR_KEY.format(shop), SHOPIFY_MIRROR_ITEMS_KEY.format(shop),
+            SHOPIFY_MIRROR_PRODUCTS_KEY.format(shop))
+
+
+def mirror_is_fresh(shop):
+    """Зеркалу можно верить: вебхуки подписаны и полная сверка была недавно"""
+    reconciled_at, webhooks = redis_client.hmget(SHOPIFY_MIRROR_META_KEY.format(shop), "reconciled_at", "webhooks")
+    return (bool(webhooks) and bool(reconciled_at)
+            and time.time() - float(reconciled_at) < SHOPIFY_MIRROR_RECONCILE_MINUTES * 60)
+
+
+def load_shopify_mirror(shop):
+    """Вся SKU-карта магазина из зеркала одним HGETALL"""
+    raw = redis_client.hgetall(SHOPIFY_MIRROR_KEY.format(shop))
+    return {sku: shopify_variant_decoder.decode(value) for sku, value in raw.items()}
+
+
+def reconcile_shopify_mirror(shop, access_token):
+    """Полностью перестраивает зеркало по выгрузке из Shopify. Новые хэши собираются под временными
+    ключами и подменяют старые одним RENAME, так что читатели не видят полупустое зеркало.
+    Если выгрузка не удалась, зеркало и отметка сверки остаются прежними."""
+    sku_map = fetch_shopify_sku_map(shop, access_token)
+    if sku_map is None:
+        logger.error(f"❌ Сверка зеркала {shop} не удалась. Зеркало не тронуто.")
+        return None
+
+    skus_by_product = {}
+    for sku, variant in sku_map.items():
+        skus_by_product.setdefault(variant.product_id, []).append(sku)
+
+    keys = mirror_keys(shop)
+    temp_keys = [f"{key}:rebuild" for key in keys]
+    mappings = (
+        [(sku, msgspec.json.encode(variant)) for sku, variant in sku_map.items()],
+        [(variant.inventory_item_id, sku) for sku, variant in sku_map.items() if variant.inventory_item_id],
+        [(product_id, json.dumps(skus)) for product_id, skus in skus_by_product.items() if product_id],
+    )
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.delete(*temp_keys)
+    for temp_key, items in zip(temp_keys, mappings):
+        for i in range(0, len(items), 1000):
+            pipe.hset(temp_key, mapping=dict(items[i:i + 1000]))
+    pipe.execute()
+
+    pipe = redis_client.pipeline()
+    for key, temp_key, items in zip(keys, temp_keys, mappings):
+        if items:
+            pipe.rename(temp_key, key)
+        else:
+            pipe.delete(key)
+    pipe.hset(SHOPIFY_MIRROR_META_KEY.format(shop), "reconciled_at", time.time())
+    pipe.execute()
+
+    logger.info(f"🪞 Зеркало Shopify для {shop} сверено: {len(sku_map)} SKU")
+    return sku_map
+
+
+def get_shopify_sku_map(shop, access_token):
+    """SKU-карта магазина для синхронизации: из зеркала, а если оно устарело — после полной сверки.
+    None — карту получить не удалось (синхронизацию нужно отложить, а не считать магазин пустым)."""
+    if mirror_is_fresh(shop):
+        return load_shopify_mirror(shop)
+
+    lock = redis_client.lock(SHOPIFY_MIRROR_LOCK_KEY.format(shop), timeout=SHOPIFY_BULK_POLL_TIMEOUT + 600,
+                             blocking_timeout=SHOPIFY_BULK_POLL_TIMEOUT + 600)
+    if not lock.acquire():
+        logger.warning(f"⚠️ Не дождались сверки зеркала {shop}. Загружаем товары напрямую.")
+        return fetch_shopify_sku_map(shop, access_token)
+    try:
+        if mirror_is_fresh(shop):  # Пока ждали, зеркало мог сверить другой процесс
+            return load_shopify_mirror(shop)
+        return reconcile_shopify_mirror(shop, access_token)
+    finally:
+        lock.release()
+
+
+def update_shopify_mirror(shop, changes):
+    """Переносит в зеркало изменения, которые Shopify принял: {sku: {"price": ..., "quantity": ...}}.
+    Иначе до вебхука или сверки следующая синхронизация видела бы старые значения и отправляла их снова."""
+    if not changes:
+        return
+    mirror_key = SHOPIFY_MIRROR_KEY.format(shop)
+    skus = list(changes)
+    updates = {}
+    for sku, raw in zip(skus, redis_client.hmget(mirror_key, skus)):
+        if not raw:
+            continue  # Варианта нет в зеркале — подтянется вебхуком или сверкой
+        variant = shopify_variant_decoder.decode(raw)
+        fields = changes[sku]
+        if "price" in fields:
+            variant.price = fields["price"]
+        if "quantity" in fields:
+            variant.quantity = fields["quantity"]
+        updates[sku] = msgspec.json.encode(variant)
+    if updates:
+        redis_client.hset(mirror_key, mapping=updates)
+
+
+def claim_webhook_update(shop, field, updated_at):
+    """True, если вебхук не старше уже применённого к тому же объекту (Shopify не гарантирует порядок доставки)"""
+    if not updated_at:
+        return True
+    try:
+        timestamp = datetime.fromisoformat(updated_at).timestamp()
+    except ValueError:
+        return True
+    return bool(CLAIM_WEBHOOK_UPDATE_SCRIPT(keys=[SHOPIFY_MIRROR_UPDATED_KEY.format(shop)], args=[field, timestamp]))
+
+
+def apply_product_webhook(shop, product):
+    """products/create и products/update: заменяет все варианты товара в зеркале"""
+    if not claim_webhook_update(shop, f"product:{product.id}", product.updated_at):
+        logger.info(f"⏭️ Устаревший вебхук товара {product.id} от {shop} ({product.updated_at}) пропущен")
+        return
+    mirror_key, items_key, products_key = mirror_keys(shop)
+    old_skus = json.loads(redis_client.hget(products_key, product.id) or "[]")
+    variants = {v.sku: v for v in product.variants if v.sku}
+
+    pipe = redis_client.pipeline()
+    removed = [sku for sku in old_skus if sku not in variants]
+    if removed:
+        pipe.hdel(mirror_key, *removed)
+    for sku, v in variants.items():
+        pipe.hset(mirror_key, sku, msgspec.json.encode(
+            ShopifyVariant(v.id, v.inventory_item_id, v.price, v.inventory_quantity, product.id)))
+        if v.inventory_item_id:
+            pipe.hset(items_key, v.inventory_item_id, sku)
+    if variants:
+        pipe.hset(products_key, product.id, json.dumps(list(variants)))
+    else:
+        pipe.hdel(products_key, product.id)
+    pipe.execute()
+
+
+def apply_product_delete_webhook(shop, product):
+    """products/delete: убирает из зеркала все SKU товара"""
+    mirror_key, items_key, products_key = mirror_keys(shop)
+    old_skus = json.loads(redis_client.hget(products_key, product.id) or "[]")
+    pipe = redis_client.pipeline()
+    if old_skus:
+        pipe.hdel(mirror_key, *old_skus)
+    pipe.hdel(products_key, product.id)
+    pipe.execute()
+
+
+def apply_inventory_webhook(shop, level):
+    """inventory_levels/update: меняет остаток варианта (только для нашей локации)"""
+    if level.location_id != SHOPIFY_LOCATION_ID:
+        return
+    if not claim_webhook_update(shop, f"item:{level.inventory_item_id}", level.updated_at):
+        logger.info(f"⏭️ Устаревший вебхук остатка {level.inventory_item_id} от {shop} ({level.updated_at}) пропущен")
+        return
+    mirror_key, items_key, _ = mirror_keys(shop)
+    sku = redis_client.hget(items_key, level.inventory_item_id)
+    raw = redis_client.hget(mirror_key, sku) if sku else None
+    if not raw:
+        return  # Вариант ещё не в зеркале — подтянется вебхуком товара или сверкой
+    variant = shopify_variant_decoder.decode(raw)
+    variant.quantity = level.available
+    redis_client.hset(mirror_key, sku, msgspec.json.encode(variant))
+
+
+def verify_shopify_webhook(body, hmac_header):
+    """Проверяет X-Shopify-Hmac-Sha256: base64(HMAC-SHA256(секрет приложения, тело запроса))"""
+    if not hmac_header or not SHOPIFY_API_SECRET:
+        return False
+    digest = hmac.new(SHOPIFY_API_SECRET.encode("utf-8"), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode(), hmac_header)
+
+
+@app.route("/webhooks", methods=["POST"])
+def shopify_webhook():
+    """Приёмник вебхуков Shopify: обновляет зеркало вариантов магазина"""
+    body = request.get_data()
+    if not verify_shopify_webhook(body, request.headers.get("X-Shopify-Hmac-Sha256")):
+        logger.error("❌ Вебхук с неверной подписью отклонён.")
+        return "Unauthorized", 401
+
+    shop = request.headers.get("X-Shopify-Shop-Domain")
+    topic = request.headers.get("X-Shopify-Topic")
+    webhook_id = request.headers.get("X-Shopify-Webhook-Id")
+    seen_key = SHOPIFY_WEBHOOK_SEEN_KEY.format(webhook_id)
+    # Отмечаем атомарно до применения: из одновременных доставок одного вебхука применит только одна
+    if webhook_id and not redis_client.set(seen_key, 1, nx=True, ex=86400):
+        return "", 200  # Повторная доставка — уже применили или применяем
+
+    try:
+        if topic in ("products/create", "products/update"):
+            apply_product_webhook(shop, shopify_product_decoder.decode(body))
+        elif topic == "products/delete":
+            apply_product_delete_webhook(shop, shopify_product_decoder.decode(body))
+        elif topic == "inventory_levels/update":
+            apply_inventory_webhook(shop, shopify_inventory_level_decoder.decode(body))
+    except msgspec.ValidationError as e:
+        logger.warning(f"⚠️ Не удалось разобрать вебхук {topic} от {shop}: {e}")
+    except Exception:
+        # Запись в зеркало упала — снимаем отметку, чтобы Shopify доставил вебхук повторно
+        if webhook_id:
+            redis_client.delete(seen_key)
+        raise
+    return "", 200
+
+
+def register_shopify_webhooks(shop, access_token):
+    """Подписывает магазин на вебхуки зеркала (уже существующие подписки не дублируются)"""
+    address = f"{APP_URL}/webhooks"
+    url = shopify_admin_url(shop, "webhooks.json")
+    response = shopify_request(shop, access_token, "GET", url, params={"limit": 250})
+    if response.status_code != 200:
+        logger.error(f"❌ Не удалось получить вебхуки {shop}: {response.status_code} | {response.text}")
+        return False
+
+    registered = {w.get("topic") for w in response.json().get("webhooks", []) if w.get("address") == address}
+    ok = True
+    for topic in SHOPIFY_WEBHOOK_TOPICS:
+        if topic in registered:
+            continue
+        response = shopify_request(shop, access_token, "POST", url,
+                                   json={"webhook": {"topic": topic, "address": address, "format": "json"}})
+        if response.status_code not in (200, 201):
+            logger.error(f"❌ Не удалось подписаться на {topic} для {shop}: {response.status_code} | {response.text}")
+            ok = False
+
+    meta_key = SHOPIFY_MIRROR_META_KEY.format(shop)
+    if ok:
+        redis_client.hset(meta_key, "webhooks", 1)
+        logger.info(f"🔔 Вебхуки зеркала подписаны для {shop}")
+    else:
+        redis_client.hdel(meta_key, "webhooks")  # Без вебхуков зеркало не обновится — читаем Shopify напрямую
+    return ok
+
+
 def calculate_final_price(base_price, vat, paypal_fees, second_paypal_fees, profit):
     """Рассчитывает финальную цену по введенным данным"""
     if base_price is None or base_price == 0:
@@ -556,327 +1622,839 @@ def calculate_final_price(base_price, vat, paypal_fees, second_paypal_fees, prof
     return round(final_price, 2)
 
 
+def calculate_final_prices(base_prices, vat, paypal_fees, second_paypal_fees, profit):
+    """Векторная версия calculate_final_price для массива базовых цен; NaN там, где скалярная вернула бы None.
+    Операции идут в том же порядке, поэтому результат совпадает со скалярной версией до бита."""
+    base = np.asarray(base_prices, dtype=np.float64)
+    raw = base + base * (vat / 100) + base * (paypal_fees / 100) + second_paypal_fees + base * (profit / 100)
+    final = np.round(raw, 2)
+    # np.round округляет через x * 100 и на половинках может разойтись с round() — их досчитываем точно
+    scaled = raw * 100
+    for i in np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6):
+        final[i] = round(float(raw[i]), 2)
+    final[(base == 0) | np.isnan(base)] = np.nan
+    return final
+
+
+
+
+# 🔹 Словари для разбора вкуса — собираются в FlavorMatcher один раз при импорте
+FLAVOR_PACKAGING_KEYWORDS = [
+    "pack", "caps", "grams", "ml", "softgels", "tabs", "vcaps", "servings",
+    "g", "kg", "lb", "tablets", "capsules", "Small", "scoops", "Medium", "Mega Tabs", "x", "100 softgel",
+    "Large", "Extra Large", "Grey", "Black", "White"  # 👈 добавил сюда явные "non-flavors"
+]
+
+POSSIBLE_FLAVORS = [
+    "Almond & Chocolate", "Apple", "Apple & Cinnamon", "Apple Cherry",
+    "Apple Crumble", "Apple Fresh", "Apple Lemonade", "Apple Limeade",
+    "Apple-Pear", "Apricot & Orange", "Baby Pink Cookies", "Baklava",
+    "Banana", "Banana & Strawberry", "Banana + Strawberry", "Banana Cream",
+    "Banana Creme", "Banana Milkshake", "Banana With Dark Chocolate", "Berry",
+    "Berry Blast", "Berry Lemonade", "Berry Punch", "Big Cherries",
+    "Big Juicy Melons", "Biscuit Spread", "Black Biscuit", "Black Cherry",
+    "Blackberry", "Blackcurrant", "Blackcurrant Blast", "Blue Bears",
+    "Blue Berry Pancakes", "Blue Grape", "Blue Lagoon", "Blue Raspberry",
+    "Blue Raz", "Blue Razz Bon Bons", "Blue Razz Riot", "Blue Razz Watermelon",
+    "Blue Sharkberry", "Blueberry", "Blueberry & Banana With Chia",
+    "Blueberry & Mint", "Blueberry & Strawberry", "Blueberry Apple",
+    "Blueberry Lemonade", "Blueberry Madness", "Blueberry Muffin",
+    "Blueberry-Lime", "Brownie", "Bubbalicious", "Bubblegum", "Bubblegum & Blueberry",
+    "Burst", "Caffe Latte", "Candy Bubblegum", "Candy Ice", "Candy Ice Blast",
+    "Candy Icy Blast", "Caramel", "Caramel Biscuit", "Caramel Latte", "Caribbean Cola",
+    "Carrot Cake", "Cereal Crunch", "Cereal Milk", "Cheescake", "Cheese And Onion",
+    "Cherry", "Cherry & Almond", "Cherry & Apple", "Cherry & Lime", "Cherry + Orange",
+    "Cherry Bakewell", "Cherry Berry", "Cherry Berry Bomb", "Cherry Bomb", "Cherry Chocolate Flavour",
+    "Cherry Cola", "Cherry Cola Bottles", "Cherry Limeade", "Cherry Mango Margarita",
+    "Chewable Orange", "Chews Orange", "Chips Barbecue", "Chips Pizza",
+    "Chocamel Cups", "Choco  Hazelnut", "Choco Bueno", "Choco Peanut", "Chocolate",
+    "Chocolate & Cinnamon", "Chocolate & Nuts", "Chocolate & Raspberry", "Chocolate + Cocoa",
+    "Chocolate + Coconut", "Chocolate Brownies", "Chocolate Caramel", "Chocolate Caramel Biscuit",
+    "Chocolate Coconut", "Chocolate Cookie Chip", "Chocolate Cookie Peanut",
+    "Chocolate Cream", "Chocolate Cream White", "Chocolate Dessert", "Chocolate Fudge",
+    "Chocolate Fudge Brownie", "Chocolate Fudge Cake", "Chocolate Hazelnut",
+    "Chocolate Milkshake", "Chocolate Orange", "Chocolate Peanut", "Chocolate Peanut Butter",
+    "Chocolate Raspberry Ripple", "Chocolate Salted Caramel", "Chocolate-Cranberry",
+    "Cinnamon Apple Pie", "Cinnamon Bun", "Cinnamon Crunch", "Cinnamon Vanilla", "Citrus",
+    "Citrus Lime", "Citrus Punch", "Citrus Twist", "Cloudy Lemonade", "Coco Crunch",
+    "Cocoa", "Cocoa Heaven", "Coconut", "Coconut Cookie And Caramel", "Coconut Cookie Caramel Peanut",
+    "Coconut Cream", "Coconut With Dark Chocolate", "Coffee", "Coffee Delight", "Cola",
+    "Cola Bottles", "Cola Lime", "Colada", "Cookie & Coffee", "Cookie Double Chocolate",
+    "Cookie Peanut Butter Raspberry Jelly", "Cookie White Choco Cream", "Cookie White Creamy Peanut",
+    "Cookies & Cream", "Cookies 'N' Cream", "Cookies Cream", "Cosmic Rainbow", "Cotton Candy",
+    "Cranberry", "Cranberry & Pomegranate", "Cranberry Juice", "Cream Crunch",
+    "Cream Soda", "Cream With Chocolate Flakes", "Creamy Vanilla", "Custard",
+    "Custard Cream", "Dark Chocolate", "Dippin' Dots  Ice Cream", "Double Chocolate",
+    "Double Chocolate Brownie", "Double Rich Chocolate", "Dough-Lightful",
+    "Dutch Chocolate", "English Toffee", "Exotic", "Exotic Peach", "Exotic Peach Mango",
+    "Fizzy Bubblegum Bottles", "Fizzy Candy Crush", "Fizzy Cola Bottles",
+    "Fizzy Peach Sweets", "Forest Berries", "Forest Burst", "Forest Fruits",
+    "French Vanilla", "Fresh Apple", "Fresh Mint", "Fresh Orange", "Fruit",
+    "Fruit Burst", "Fruit Candy", "Fruit Kaboom", "Fruit Punch", "Fruit Punch Blast",
+    "Fruit Salad", "Fruity Cereal", "Fuzzy Peach", "Georgia Peach", "Ginger & Turmerones"
+    , "Gold Cream", "Gold Double Rich", "Gold Rush", "Golden Syrup", "Grandma'S Maple Syrup",
+    "Grape", "Grape Cooler", "Grape Juiced", "Grape Kola Kraken", "Grape Soda", "Grapefruit",
+    "Grapefruit-Kiwi", "Green Apple", "Green Gummy Machine", "Green Lemonade",
+    "Green Tea Ice Cream", "Gummy Candies", "Gummy Dummy", "Happy Cookie",
+    "Hawthorn Berry", "Hazelnut", "Hazelnut Choco", "Hibiscus Pear", "Honey  Vanilla",
+    "Honey & Cinnamon", "Honey Chamomile", "Ice Peach Tea", "Iced Blue Slush",
+    "Iced Lemonade", "Iced Mocha Coffee", "Icy Blue Raspberry", "Icy Blue Raz",
+    "Icy Mojito", "In Dark Milk And White Chocolate", "Island Breeze", "Italian Lemon Ice",
+    "Jam Roly-Poly", "Jelly Bean", "Juicy Fruit", "Juicy Melons", "Juicy Watermelon", "Kiwi", "Kiwi & Strawberry",
+    "Kiwi Strawberry", "Latte Macchiato", "Lemon", "Lemon & Lime", "Lemon Apple",
+    "Lemon Cheesecake", "Lemon Ice", "Lemon Ice Tea", "Lemon Lime", "Lemon Raspberry",
+    "Lemon Twist", "Lemon-Green Tea", "Lemon-Orange", "Lemone & Lime", "Lemongrass",
+    "Life Is Peachy", "Lime Crime Mint", "Lime Papaya", "Mandarin Orange", "Mango",
+    "Mango & Passion Fruit", "Mango & Passionfrui", "Mango & Passionfruit",
+    "Mango & Pineapple", "Mango + Orange", "Mango + Vanilla", "Mango Passion Fruit",
+    "Mango Pineapple", "Mango Strawberry", "Maqui Berry Extract", "Margarita Strawberry",
+    "Marshmallow Milk", "Melon Candy", "Merry Berry Punch", "Miami", "Miami Vice",
+    "Milk  Caramel", "Milk Chocolate", "Milk Chocolate Peanut", "Milky Choc", "Milky Chocolate",
+    "Milky With Coconut", "Millions Blackcurrant", "Millions Bubblegum", "Millions Strawberry",
+    "Mocha", "Mojito", "Muffin", "Muffin White", "Multifruit", "Natural Fruit Flavor",
+    "Neutral", "Nuts Almonds In  Milk Chocolate And Cinnamon", "Oatmeal Cookie",
+    "Orange", "Orange & Mango", "Orange Burst", "Orange Cherry", "Orange Cooler",
+    "Orange Juice", "Orange Juiced", "Orange Lemon", "Orange Mango", "Orange Squash",
+    "Orange-Mango", "Orange/Mango", "Original - Banana", "Original - Vanilla",
+    "Original Bubblegum", "Original Citrus Berry", "Original Cola", "Original Cookies 'N' Cream",
+    "Original Flavor", "Original Orange", "Original Sour Batch Bros", "Original Strawberry",
+    "Original White Choco Bueno", "Passionfruit Guava", "Peach", "Peach Ice Tea", "Peach-Ice Tea",
+    "Peanut Butter", "Peanut Butter Cookie", "Peanut Butter N' Honey", "Pear",
+    "Pear Kiwi", "Pina Colada", "Pineapple", "Pineapple  + Coconut", "Pineapple Coconut",
+    "Pineapple Mango", "Pink Lemonade", "Pistachio", "Pistachio Marzipan",
+    "Pistachio White Chocolate", "Pomegranate", "Pomegranate Blueberry", "Purple Haze",
+    "Push Pop", "Raging Cola", "Rainbow Dust", "Raspberry", "Raspberry & Cranberry",
+    "Raspberry & White Chocolate", "Raspberry Chocolate Flavour", "Raspberry Lemon",
+    "Raspberry Lemonade", "Raspberry Wild", "Raspberry Wild Strawberry", "Red Berry",
+    "Red Berry Yuzu", "Red Fresh", "Red Kola", "Red Orange", "Roadside Lemonade", "Rocket Pop", "Salted Caramel",
+    "Salted Caramel  & Chocolate Chip", "Salted Caramel Sauce", "Shake Coco Crunch", "Smash Apple", "Sour Candy", "Sour Cherry With Dark Chocolate", "Sour Citrus Punch", "Sour Grape", "Sour Green Apple", "Sour Gummy Bear", "Sour Gummy Bears", "Sour Jellies",
+    "Sour Lemonade", "Southern Sweet Tea", "Spearmint Flavor", "Splash Grape", "Sticky Toffee Pudding", "Strawberry", "Strawberry & Kiwi", "Strawberry & Lime", "Strawberry & Raspberry", "Strawberry & Raspberry With Chia", "Strawberry Banana", "Strawberry Cream", "Strawberry Creme", "Strawberry Fit", "Strawberry Ice Cream", "Strawberry Kiwi", "Strawberry Laces", "Strawberry Lemon", "Strawberry Lemonade", "Strawberry Limeade",
+    "Strawberry Mango", "Strawberry Margarita", "Strawberry Milkshake", "Strawberry Pineapple", "Strawberry Raspberry", "Strawberry Soda", "Strawberry Watermelon", "Strawberry-Banana", "Strawberry-Cranberry", "Strawberry-Kiwi", "Super-Colour Sweeties", "Sweet Coffee", "Sweet Iced Tea", "Sweet Paprika", "Sweet Potato Pie", "Sweet Tea", "Swizzels Drumstick Squashies", "Tangy Orange", "The Biscuit One", "The Glazed One", "The Jammy One", "Toffee", "Toffee Biscuit", "Toffee Chocolate", "Toffee Popcorn", "Toffee Pudding", "Triple Chocolate", "Triple Chocolate Brownie", "Tropic Blue", "Tropic Thunderburst", "Tropical", "Tropical Candy",
+    "Tropical Citrus Punch", "Tropical Fruits", "Tropical Punch", "Tropical Thunder", "Tropical Vibes", "Tropical-Orange", "Tube Apricot", "Tube Blueberry", "Tutti Frutti", "Twirler Ice Cream", "Unflavored", "Unflavoured", "Vanilla", "Vanilla  Strawberry", "Vanilla & Pineapple", "Vanilla & Sour Cherry", "Vanilla Bean", "Vanilla Bean Ice Cream", "Vanilla Cake", "Vanilla Caramel", "Vanilla Cheesecake", "Vanilla Cream", "Vanilla Ice Cream", "Vanilla Milkshake", "Vanilla Pudding", "Vanilla Toffee", "Vanilla-Cinnamon", "Water Rocket Ice Lolly", "Watermelon", "Watermelon Blast", "Watermelon Juicy", "White Cherry  Frost", "White Choc Lemon Drizzle",
+    "White Choc Pistachio", "White Choco Bueno", "White Choco Peanut", "White Choco Raspberry", "White Chocolate", "White Chocolate  & Coconut", "White Chocolate Biscuit Spread", "White Chocolate Caramel", "White Chocolate Caramel Biscuit", "White Chocolate Cookies & Cream", "White Chocolate Hazelnut", "White Chocolate Raspberry", "White Chocolate-Cranberry", "White Peanut Choco", "Wild Berry", "Wild Berry Punch", "Wild Fruits", "Wild Strawberry", "Wildberry", "Winter Apple", "Yoghurt & Blackcurrant", "Yummy Cookie", "Yummy Tutti Frutti Taste", "Yuzu & Apricot"
+    "Chocolate Brownie",  "Sour Apple", "Bubblegum Crush", "Grape Splash", "Tropical Fruit",
+    "Peanut Butter Strawberry Jelly", "Professional White Chocolate & Raspberry", "White Chocolate Coconut", "Chocolate Cookies & Cream",
+    "Nuts Hazelnuts In Dark Milk And White Chocolate", "Nuts Almonds In White Chocolate & Cinnamon",
+    "Nuts Almonds In White Chocolate & Coconut", "Ice Fresh", "Fruit Wild", "Strawberry Banana Twist",
+    "Nuts Peanuts In White Chocolate", "Salted Caramel & Chocolate Chip", "White Chocolate + Coconut",
+    "Professional Chocolate Mint", "French Vanilla Cream", "Vanilla Custard Cream", "Vanilla Very Berry",
+    "Peach Mango", "Passion Fruit Lemon", "Dragon  Fruit  Yuzu", "Cherry Mango", "Chocolate & Hazelnut",
+    "Cinnamon Apple Crumble", "Cinnamon Cereal Crunch", "Cookies And Cream", "Bubblegum Crush", "Strawberry Orange",
+    "Raspberry Cheesecake", "Caramel Peanut Coconut", "Caramel Cappuccino", "Strawberry Summer",
+    "White Choco Cream", "Rocket Ice Lolly", "Strawberry Yuzu", "Blackberry & Lime", "Chocolate Brownie",
+    "Strawberry With Mint", "Strawberry Banana", "Apple Crumble", "Brutal Cola", "Strawberry & Kiwi",
+    "Peanut Butter", "Milk Chocolate Caramel", "Vanilla Cheesecake", "Chocolate Cookies", "Vanilla Cream",
+    "Cookies 'N' Cream", "Coffee & Cream", "Vanilla Bean", "Peanut", "Peanuts",
+    "Cherry Apple", "Cherry Sour", "Cherry Bakewell", "Cherry Mango", "Red Hawaiian",
+    "Redcurrant", "Disco Biscuit", "Bourbon Vanilla", "Tropical Mango", "Tropical Fruit",
+    "Tropical Burst", "Tropical Candy", "Rainbow Candy", "Grapefruit With Eucalyptus", "Dragon Fruit",
+    "Miami Peach", "Mango Lime", "Orange & Passion Fruit", "Bubble Gum", "Crunch",
+    "Crispy Cookie", "Cinnamon Cookie", "Cinnamon Crunch", "Coconut Milk", "Cool Mint",
+    "Fizzy Bubble Sweets", "Frozen Bombsicle", "Raspberry Strawberry", "Sour Batch Bros", "Sour Apple",
+    "Ruby Berry", "Tigers Blood", "Blue Razz Freeze", "Blue Ice", "Black Currant",
+    "White Cherry Frost", "Apple Burst", "Apple Pie", "Banana Peach", "Banana Nut Bread",
+    "Juicy Nectar", "Juicy Fruit", "Strawberry", "Mango", "Lemonade",
+    "Lime", "Lemon Cheescake", "Choco Hazelnut", "Choco Bueno", "Chocolate Chip",
+    "Chocolate Mint", "Chocolate Hazelnut", "Chocolate Caramel", "Caramel Peanut", "Carrot Cake",
+    "Baddy Berry", "Butterscotch", "Syrup Sponge", "Edelweiss & Pomegranate", "Pomegranate Grapefruit",
+    "Citrus Berry", "Cola", "Cookies", "Cookie", "White Grape", "White Creamy Peanut",
+
+]
+
+
+class FlavorMatcher:
+    """Скомпилированный словарь вкусов.
+    Вкусы проверяются в том же порядке, что и раньше (сначала длинные), но регулярка запускается
+    только для вкусов, чьё первое слово встречается в названии товара."""
+
+    WORD_RE = re.compile(r"\w+")
+
+    def __init__(self, flavors, packaging_keywords):
+        ordered = sorted(flavors, key=len, reverse=True)
+        self.flavor_set = frozenset(flavors)
+        self.packaging_keywords = frozenset(k.lower() for k in packaging_keywords)
+        self.prefix_re = re.compile("|".join(re.escape(f.lower()) for f in ordered))
+
+        self.patterns = []  # (flavor, pattern) в порядке проверки
+        self.by_first_word = {}  # первое слово вкуса → индексы в self.patterns
+        seen = set()
+        for flavor in ordered:
+            if flavor in seen or flavor.lower() in self.packaging_keywords:
+                continue
+            seen.add(flavor)
+            self.by_first_word.setdefault(self.WORD_RE.search(flavor).group().casefold(), []).append(len(self.patterns))
+            self.patterns.append((flavor, re.compile(rf"\b{re.escape(flavor)}\b", re.IGNORECASE)))
+
+    def starts_with_flavor(self, product_name):
+        return self.prefix_re.match(product_name.strip().lower()) is not None
+
+    def candidates(self, product_name):
+        """Вкусы, которые могут встретиться в названии, в порядке проверки"""
+        if not product_name.isascii():
+            return self.patterns  # Для не-ASCII регистр сравнивается сложнее — проверяем всё
+        indexes = set()
+        for word in self.WORD_RE.findall(product_name):
+            indexes.update(self.by_first_word.get(word.casefold(), ()))
+        return [self.patterns[i] for i in sorted(indexes)]
+
+
+flavor_matcher = FlavorMatcher(POSSIBLE_FLAVORS, FLAVOR_PACKAGING_KEYWORDS)
+FLAVOR_COMBO_RE = re.compile(r"(\b\w+\b)\s*(?:[-,&])\s*(\b\w+\b)")
+FLAVOR_WITH_RE = re.compile(r"(.+?)\s+with\s+(.+)", re.IGNORECASE)
+FLAVOR_AFTER_DOSE_RE = re.compile(r"(.+?)\s+(\d+mg)\s+(.+)")
+FLAVOR_TAIL_RE = re.compile(r"(.+?)[,\-]\s*([\w\s&]+)$")
+DIGIT_RE = re.compile(r"\d")
 
 
+@functools.lru_cache(maxsize=FLAVOR_CACHE_SIZE)
 def extract_flavor_advanced(product_name):
     if not product_name:
         return None, product_name
 
-    packaging_keywords = [
-        "pack", "caps", "grams", "ml", "softgels", "tabs", "vcaps", "servings",
-        "g", "kg", "lb", "tablets", "capsules", "Small", "scoops", "Medium", "Mega Tabs", "x", "100 softgel",
-        "Large", "Extra Large", "Grey", "Black", "White"  # 👈 добавил сюда явные "non-flavors"
-    ]
-
-    possible_flavors = [
-        "Almond & Chocolate", "Apple", "Apple & Cinnamon", "Apple Cherry",
-        "Apple Crumble", "Apple Fresh", "Apple Lemonade", "Apple Limeade",
-        "Apple-Pear", "Apricot & Orange", "Baby Pink Cookies", "Baklava",
-        "Banana", "Banana & Strawberry", "Banana + Strawberry", "Banana Cream",
-        "Banana Creme", "Banana Milkshake", "Banana With Dark Chocolate", "Berry",
-        "Berry Blast", "Berry Lemonade", "Berry Punch", "Big Cherries",
-        "Big Juicy Melons", "Biscuit Spread", "Black Biscuit", "Black Cherry",
-        "Blackberry", "Blackcurrant", "Blackcurrant Blast", "Blue Bears",
-        "Blue Berry Pancakes", "Blue Grape", "Blue Lagoon", "Blue Raspberry",
-        "Blue Raz", "Blue Razz Bon Bons", "Blue Razz Riot", "Blue Razz Watermelon",
-        "Blue Sharkberry", "Blueberry", "Blueberry & Banana With Chia",
-        "Blueberry & Mint", "Blueberry & Strawberry", "Blueberry Apple",
-        "Blueberry Lemonade", "Blueberry Madness", "Blueberry Muffin",
-        "Blueberry-Lime", "Brownie", "Bubbalicious", "Bubblegum", "Bubblegum & Blueberry",
-        "Burst", "Caffe Latte", "Candy Bubblegum", "Candy Ice", "Candy Ice Blast",
-        "Candy Icy Blast", "Caramel", "Caramel Biscuit", "Caramel Latte", "Caribbean Cola",
-        "Carrot Cake", "Cereal Crunch", "Cereal Milk", "Cheescake", "Cheese And Onion",
-        "Cherry", "Cherry & Almond", "Cherry & Apple", "Cherry & Lime", "Cherry + Orange",
-        "Cherry Bakewell", "Cherry Berry", "Cherry Berry Bomb", "Cherry Bomb", "Cherry Chocolate Flavour",
-        "Cherry Cola", "Cherry Cola Bottles", "Cherry Limeade", "Cherry Mango Margarita",
-        "Chewable Orange", "Chews Orange", "Chips Barbecue", "Chips Pizza",
-        "Chocamel Cups", "Choco  Hazelnut", "Choco Bueno", "Choco Peanut", "Chocolate",
-        "Chocolate & Cinnamon", "Chocolate & Nuts", "Chocolate & Raspberry", "Chocolate + Cocoa",
-        "Chocolate + Coconut", "Chocolate Brownies", "Chocolate Caramel", "Chocolate Caramel Biscuit",
-        "Chocolate Coconut", "Chocolate Cookie Chip", "Chocolate Cookie Peanut",
-        "Chocolate Cream", "Chocolate Cream White", "Chocolate Dessert", "Chocolate Fudge",
-        "Chocolate Fudge Brownie", "Chocolate Fudge Cake", "Chocolate Hazelnut",
-        "Chocolate Milkshake", "Chocolate Orange", "Chocolate Peanut", "Chocolate Peanut Butter",
-        "Chocolate Raspberry Ripple", "Chocolate Salted Caramel", "Chocolate-Cranberry",
-        "Cinnamon Apple Pie", "Cinnamon Bun", "Cinnamon Crunch", "Cinnamon Vanilla", "Citrus",
-        "Citrus Lime", "Citrus Punch", "Citrus Twist", "Cloudy Lemonade", "Coco Crunch",
-        "Cocoa", "Cocoa Heaven", "Coconut", "Coconut Cookie And Caramel", "Coconut Cookie Caramel Peanut",
-        "Coconut Cream", "Coconut With Dark Chocolate", "Coffee", "Coffee Delight", "Cola",
-        "Cola Bottles", "Cola Lime", "Colada", "Cookie & Coffee", "Cookie Double Chocolate",
-        "Cookie Peanut Butter Raspberry Jelly", "Cookie White Choco Cream", "Cookie White Creamy Peanut",
-        "Cookies & Cream", "Cookies 'N' Cream", "Cookies Cream", "Cosmic Rainbow", "Cotton Candy",
-        "Cranberry", "Cranberry & Pomegranate", "Cranberry Juice", "Cream Crunch",
-        "Cream Soda", "Cream With Chocolate Flakes", "Creamy Vanilla", "Custard",
-        "Custard Cream", "Dark Chocolate", "Dippin' Dots  Ice Cream", "Double Chocolate",
-        "Double Chocolate Brownie", "Double Rich Chocolate", "Dough-Lightful",
-        "Dutch Chocolate", "English Toffee", "Exotic", "Exotic Peach", "Exotic Peach Mango",
-        "Fizzy Bubblegum Bottles", "Fizzy Candy Crush", "Fizzy Cola Bottles",
-        "Fizzy Peach Sweets", "Forest Berries", "Forest Burst", "Forest Fruits",
-        "French Vanilla", "Fresh Apple", "Fresh Mint", "Fresh Orange", "Fruit",
-        "Fruit Burst", "Fruit Candy", "Fruit Kaboom", "Fruit Punch", "Fruit Punch Blast",
-        "Fruit Salad", "Fruity Cereal", "Fuzzy Peach", "Georgia Peach", "Ginger & Turmerones"
-        , "Gold Cream", "Gold Double Rich", "Gold Rush", "Golden Syrup", "Grandma'S Maple Syrup",
-        "Grape", "Grape Cooler", "Grape Juiced", "Grape Kola Kraken", "Grape Soda", "Grapefruit",
-        "Grapefruit-Kiwi", "Green Apple", "Green Gummy Machine", "Green Lemonade",
-        "Green Tea Ice Cream", "Gummy Candies", "Gummy Dummy", "Happy Cookie",
-        "Hawthorn Berry", "Hazelnut", "Hazelnut Choco", "Hibiscus Pear", "Honey  Vanilla",
-        "Honey & Cinnamon", "Honey Chamomile", "Ice Peach Tea", "Iced Blue Slush",
-        "Iced Lemonade", "Iced Mocha Coffee", "Icy Blue Raspberry", "Icy Blue Raz",
-        "Icy Mojito", "In Dark Milk And White Chocolate", "Island Breeze", "Italian Lemon Ice",
-        "Jam Roly-Poly", "Jelly Bean", "Juicy Fruit", "Juicy Melons", "Juicy Watermelon", "Kiwi", "Kiwi & Strawberry",
-        "Kiwi Strawberry", "Latte Macchiato", "Lemon", "Lemon & Lime", "Lemon Apple",
-        "Lemon Cheesecake", "Lemon Ice", "Lemon Ice Tea", "Lemon Lime", "Lemon Raspberry",
-        "Lemon Twist", "Lemon-Green Tea", "Lemon-Orange", "Lemone & Lime", "Lemongrass",
-        "Life Is Peachy", "Lime Crime Mint", "Lime Papaya", "Mandarin Orange", "Mango",
-        "Mango & Passion Fruit", "Mango & Passionfrui", "Mango & Passionfruit",
-        "Mango & Pineapple", "Mango + Orange", "Mango + Vanilla", "Mango Passion Fruit",
-        "Mango Pineapple", "Mango Strawberry", "Maqui Berry Extract", "Margarita Strawberry",
-        "Marshmallow Milk", "Melon Candy", "Merry Berry Punch", "Miami", "Miami Vice",
-        "Milk  Caramel", "Milk Chocolate", "Milk Chocolate Peanut", "Milky Choc", "Milky Chocolate",
-        "Milky With Coconut", "Millions Blackcurrant", "Millions Bubblegum", "Millions Strawberry",
-        "Mocha", "Mojito", "Muffin", "Muffin White", "Multifruit", "Natural Fruit Flavor",
-        "Neutral", "Nuts Almonds In  Milk Chocolate And Cinnamon", "Oatmeal Cookie",
-        "Orange", "Orange & Mango", "Orange Burst", "Orange Cherry", "Orange Cooler",
-        "Orange Juice", "Orange Juiced", "Orange Lemon", "Orange Mango", "Orange Squash",
-        "Orange-Mango", "Orange/Mango", "Original - Banana", "Original - Vanilla",
-        "Original Bubblegum", "Original Citrus Berry", "Original Cola", "Original Cookies 'N' Cream",
-        "Original Flavor", "Original Orange", "Original Sour Batch Bros", "Original Strawberry",
-        "Original White Choco Bueno", "Passionfruit Guava", "Peach", "Peach Ice Tea", "Peach-Ice Tea",
-        "Peanut Butter", "Peanut Butter Cookie", "Peanut Butter N' Honey", "Pear",
-        "Pear Kiwi", "Pina Colada", "Pineapple", "Pineapple  + Coconut", "Pineapple Coconut",
-        "Pineapple Mango", "Pink Lemonade", "Pistachio", "Pistachio Marzipan",
-        "Pistachio White Chocolate", "Pomegranate", "Pomegranate Blueberry", "Purple Haze",
-        "Push Pop", "Raging Cola", "Rainbow Dust", "Raspberry", "Raspberry & Cranberry",
-        "Raspberry & White Chocolate", "Raspberry Chocolate Flavour", "Raspberry Lemon",
-        "Raspberry Lemonade", "Raspberry Wild", "Raspberry Wild Strawberry", "Red Berry",
-        "Red Berry Yuzu", "Red Fresh", "Red Kola", "Red Orange", "Roadside Lemonade", "Rocket Pop", "Salted Caramel",
-        "Salted Caramel  & Chocolate Chip", "Salted Caramel Sauce", "Shake Coco Crunch", "Smash Apple", "Sour Candy", "Sour Cherry With Dark Chocolate", "Sour Citrus Punch", "Sour Grape", "Sour Green Apple", "Sour Gummy Bear", "Sour Gummy Bears", "Sour Jellies",
-        "Sour Lemonade", "Southern Sweet Tea", "Spearmint Flavor", "Splash Grape", "Sticky Toffee Pudding", "Strawberry", "Strawberry & Kiwi", "Strawberry & Lime", "Strawberry & Raspberry", "Strawberry & Raspberry With Chia", "Strawberry Banana", "Strawberry Cream", "Strawberry Creme", "Strawberry Fit", "Strawberry Ice Cream", "Strawberry Kiwi", "Strawberry Laces", "Strawberry Lemon", "Strawberry Lemonade", "Strawberry Limeade",
-        "Strawberry Mango", "Strawberry Margarita", "Strawberry Milkshake", "Strawberry Pineapple", "Strawberry Raspberry", "Strawberry Soda", "Strawberry Watermelon", "Strawberry-Banana", "Strawberry-Cranberry", "Strawberry-Kiwi", "Super-Colour Sweeties", "Sweet Coffee", "Sweet Iced Tea", "Sweet Paprika", "Sweet Potato Pie", "Sweet Tea", "Swizzels Drumstick Squashies", "Tangy Orange", "The Biscuit One", "The Glazed One", "The Jammy One", "Toffee", "Toffee Biscuit", "Toffee Chocolate", "Toffee Popcorn", "Toffee Pudding", "Triple Chocolate", "Triple Chocolate Brownie", "Tropic Blue", "Tropic Thunderburst", "Tropical", "Tropical Candy",
-        "Tropical Citrus Punch", "Tropical Fruits", "Tropical Punch", "Tropical Thunder", "Tropical Vibes", "Tropical-Orange", "Tube Apricot", "Tube Blueberry", "Tutti Frutti", "Twirler Ice Cream", "Unflavored", "Unflavoured", "Vanilla", "Vanilla  Strawberry", "Vanilla & Pineapple", "Vanilla & Sour Cherry", "Vanilla Bean", "Vanilla Bean Ice Cream", "Vanilla Cake", "Vanilla Caramel", "Vanilla Cheesecake", "Vanilla Cream", "Vanilla Ice Cream", "Vanilla Milkshake", "Vanilla Pudding", "Vanilla Toffee", "Vanilla-Cinnamon", "Water Rocket Ice Lolly", "Watermelon", "Watermelon Blast", "Watermelon Juicy", "White Cherry  Frost", "White Choc Lemon Drizzle",
-        "White Choc Pistachio", "White Choco Bueno", "White Choco Peanut", "White Choco Raspberry", "White Chocolate", "White Chocolate  & Coconut", "White Chocolate Biscuit Spread", "White Chocolate Caramel", "White Chocolate Caramel Biscuit", "White Chocolate Cookies & Cream", "White Chocolate Hazelnut", "White Chocolate Raspberry", "White Chocolate-Cranberry", "White Peanut Choco", "Wild Berry", "Wild Berry Punch", "Wild Fruits", "Wild Strawberry", "Wildberry", "Winter Apple", "Yoghurt & Blackcurrant", "Yummy Cookie", "Yummy Tutti Frutti Taste", "Yuzu & Apricot"
-        "Chocolate Brownie",  "Sour Apple", "Bubblegum Crush", "Grape Splash", "Tropical Fruit",
-        "Peanut Butter Strawberry Jelly", "Professional White Chocolate & Raspberry", "White Chocolate Coconut", "Chocolate Cookies & Cream",
-        "Nuts Hazelnuts In Dark Milk And White Chocolate", "Nuts Almonds In White Chocolate & Cinnamon",
-        "Nuts Almonds In White Chocolate & Coconut", "Ice Fresh", "Fruit Wild", "Strawberry Banana Twist",
-        "Nuts Peanuts In White Chocolate", "Salted Caramel & Chocolate Chip", "White Chocolate + Coconut",
-        "Professional Chocolate Mint", "French Vanilla Cream", "Vanilla Custard Cream", "Vanilla Very Berry",
-        "Peach Mango", "Passion Fruit Lemon", "Dragon  Fruit  Yuzu", "Cherry Mango", "Chocolate & Hazelnut",
-        "Cinnamon Apple Crumble", "Cinnamon Cereal Crunch", "Cookies And Cream", "Bubblegum Crush", "Strawberry Orange",
-        "Raspberry Cheesecake", "Caramel Peanut Coconut", "Caramel Cappuccino", "Strawberry Summer",
-        "White Choco Cream", "Rocket Ice Lolly", "Strawberry Yuzu", "Blackberry & Lime", "Chocolate Brownie",
-        "Strawberry With Mint", "Strawberry Banana", "Apple Crumble", "Brutal Cola", "Strawberry & Kiwi",
-        "Peanut Butter", "Milk Chocolate Caramel", "Vanilla Cheesecake", "Chocolate Cookies", "Vanilla Cream",
-        "Cookies 'N' Cream", "Coffee & Cream", "Vanilla Bean", "Peanut", "Peanuts",
-        "Cherry Apple", "Cherry Sour", "Cherry Bakewell", "Cherry Mango", "Red Hawaiian",
-        "Redcurrant", "Disco Biscuit", "Bourbon Vanilla", "Tropical Mango", "Tropical Fruit",
-        "Tropical Burst", "Tropical Candy", "Rainbow Candy", "Grapefruit With Eucalyptus", "Dragon Fruit",
-        "Miami Peach", "Mango Lime", "Orange & Passion Fruit", "Bubble Gum", "Crunch",
-        "Crispy Cookie", "Cinnamon Cookie", "Cinnamon Crunch", "Coconut Milk", "Cool Mint",
-        "Fizzy Bubble Sweets", "Frozen Bombsicle", "Raspberry Strawberry", "Sour Batch Bros", "Sour Apple",
-        "Ruby Berry", "Tigers Blood", "Blue Razz Freeze", "Blue Ice", "Black Currant",
-        "White Cherry Frost", "Apple Burst", "Apple Pie", "Banana Peach", "Banana Nut Bread",
-        "Juicy Nectar", "Juicy Fruit", "Strawberry", "Mango", "Lemonade",
-        "Lime", "Lemon Cheescake", "Choco Hazelnut", "Choco Bueno", "Chocolate Chip",
-        "Chocolate Mint", "Chocolate Hazelnut", "Chocolate Caramel", "Caramel Peanut", "Carrot Cake",
-        "Baddy Berry", "Butterscotch", "Syrup Sponge", "Edelweiss & Pomegranate", "Pomegranate Grapefruit",
-        "Citrus Berry", "Cola", "Cookies", "Cookie", "White Grape", "White Creamy Peanut",
-
-    ]
-
-
-    possible_flavors.sort(key=len, reverse=True)
-    packaging_keywords_lower = set(k.lower() for k in packaging_keywords)
-
-    for flavor in possible_flavors:
-        if product_name.strip().lower().startswith(flavor.lower()):
-            return None, product_name.rstrip(",").strip()
-
-    for flavor in possible_flavors:
-        if flavor.lower() in packaging_keywords_lower:
-            continue  # ❌ Пропускаем упаковочные слова
-
-        match = re.search(rf"\b{re.escape(flavor)}\b", product_name, re.IGNORECASE)
+    packaging_keywords_lower = flavor_matcher.packaging_keywords
+
+    if flavor_matcher.starts_with_flavor(product_name):
+        return None, product_name.rstrip(",").strip()
+
+    for flavor, pattern in flavor_matcher.candidates(product_name):
+        match = pattern.search(product_name)
         if match:
             after_match_pos = match.end()
             remainder = product_name[after_match_pos:].strip().lower()
             if remainder.startswith("oil"):
                 continue
 
-            item_name = re.sub(rf"\b{re.escape(flavor)}\b", "", product_name, flags=re.IGNORECASE).strip()
+            item_name = pattern.sub("", product_name).strip()
             item_name = item_name.rstrip(",").strip()
             return flavor, item_name
 
-    match_combo = re.search(r"(\b\w+\b)\s*(?:[-,&])\s*(\b\w+\b)", product_name)
+    match_combo = FLAVOR_COMBO_RE.search(product_name)
     if match_combo:
         part1 = match_combo.group(1)
         part2 = match_combo.group(2)
         combined = f"{part1} {part2}"
-        if combined in possible_flavors and combined.lower() not in packaging_keywords_lower:
+        if combined in flavor_matcher.flavor_set and combined.lower() not in packaging_keywords_lower:
             item_name = product_name.replace(match_combo.group(0), "").strip(" ,-")
             return combined, item_name
 
-    match_with = re.search(r"(.+?)\s+with\s+(.+)", product_name, re.IGNORECASE)
+    match_with = FLAVOR_WITH_RE.search(product_name)
     if match_with:
         item_name = match_with.group(1).strip()
         possible_flavor = match_with.group(2).strip()
-        if not re.search(r"\d", possible_flavor) and possible_flavor.lower() not in packaging_keywords_lower:
+        if not DIGIT_RE.search(possible_flavor) and possible_flavor.lower() not in packaging_keywords_lower:
             return possible_flavor, item_name
 
-    match_digit_flavor = re.search(r"(.+?)\s+(\d+mg)\s+(.+)", product_name)
+    match_digit_flavor = FLAVOR_AFTER_DOSE_RE.search(product_name)
     if match_digit_flavor:
         item_name = match_digit_flavor.group(1).strip()
         possible_flavor = match_digit_flavor.group(3).strip()
-        if not re.search(r"\d", possible_flavor) and possible_flavor.lower() not in packaging_keywords_lower:
+        if not DIGIT_RE.search(possible_flavor) and possible_flavor.lower() not in packaging_keywords_lower:
             return possible_flavor, item_name
 
-    match = re.search(r"(.+?)[,\-]\s*([\w\s&]+)$", product_name)
+    match = FLAVOR_TAIL_RE.search(product_name)
     if match:
         item_name = match.group(1).strip()
         possible_flavor = match.group(2).strip()
-        if not re.search(r"\d", possible_flavor) and possible_flavor.lower() not in packaging_keywords_lower:
+        if not DIGIT_RE.search(possible_flavor) and possible_flavor.lower() not in packaging_keywords_lower:
             return possible_flavor, item_name
 
     return None, product_name.rstrip(",").strip()
 
 
 
-def make_request_with_retries(url, headers, data, method="PUT", max_retries=5):
-    """Функция для повторных попыток запроса в случае ошибки 429"""
-    delay = 2
-    for attempt in range(max_retries):
-        response = requests.put(url, headers=headers, json=data) if method == "PUT" else requests.post(url,
-                                                                                                       headers=headers,
-                                                                                                       json=data)
+class ShopifyBatchWriter:
+    """Копит изменения цен и остатков и отправляет их пачками:
+    цены — через productVariantsBulkUpdate (несколько товаров в одном запросе), остатки — через inventorySetQuantities.
+    flush() возвращает {sku: [ошибки]}; пустой список — изменение применено."""
+
+    def __init__(self, shop, access_token, location_id=SHOPIFY_LOCATION_ID):
+        self.shop = shop
+        self.access_token = access_token
+        self.location_id = location_id
+        self.price_changes = {}  # product_id → [(sku, variant_id, price)]
+        self.inventory_changes = []  # (sku, inventory_item_id, quantity)
+        self.limiter = get_rate_limiter(shop)
+
+    def add(self, sku, product_id, variant_id, inventory_item_id, price=None, quantity=None):
+        if price is not None:
+            self.price_changes.setdefault(product_id, []).append((sku, variant_id, price))
+        if quantity is not None:
+            self.inventory_changes.append((sku, inventory_item_id, quantity))
+
+    def pending_count(self):
+        return sum(len(v) for v in self.price_changes.values()) + len(self.inventory_changes)
+
+    def is_full(self):
+        """Пора отправлять: набралось на полный запрос"""
+        return (len(self.price_changes) >= SHOPIFY_MAX_MUTATIONS_PER_CALL
+                or len(self.inventory_changes) >= SHOPIFY_MAX_INVENTORY_PER_CALL)
+
+    def _mutations_per_call(self):
+        """Сколько мутаций влезает в запрос при текущем остатке бюджета"""
+        available = self.limiter.available_graphql()
+        return max(1, min(SHOPIFY_MAX_MUTATIONS_PER_CALL, int(available // SHOPIFY_MUTATION_COST)))
+
+    @staticmethod
+    def _error_index(error, list_field):
+        """Номер элемента, к которому относится userError: field = [..., list_field, "3", ...]"""
+        field = error.get("field") or []
+        if list_field in field:
+            position = field.index(list_field) + 1
+            if position < len(field) and str(field[position]).isdigit():
+                return int(field[position])
+        return None
 
-        if response.status_code == 200:
-            return response
-        elif response.status_code == 429:
-            print(f"⚠️ Error 429 (Too Many Requests). Send request again {delay} sec...")
-            time.sleep(delay)
-            delay *= 2
-        else:
-            print(f"❌ Ошибка {response.status_code} | {response.text}")
-            return response
-    print("🚨 Превышено количество повторных попыток запроса.")
-    return response
+    def _flush_prices(self, results):
+        products = list(self.price_changes.items())
+        self.price_changes = {}
+
+        while products:
+            batch = products[:self._mutations_per_call()]
+            products = products[len(batch):]
+
+            declarations = []
+            fields = []
+            variables = {}
+            for i, (product_id, variants) in enumerate(batch):
+                declarations.append(f"$p{i}: ID!, $v{i}: [ProductVariantsBulkInput!]!")
+                fields.append(f"m{i}: productVariantsBulkUpdate(productId: $p{i}, variants: $v{i}) "
+                              "{ userErrors { field message } }")
+                variables[f"p{i}"] = f"gid://shopify/Product/{product_id}"
+                variables[f"v{i}"] = [{"id": f"gid://shopify/ProductVariant/{variant_id}", "price": f"{price:.2f}"}
+                                      for _, variant_id, price in variants]
+
+            query = f"mutation({', '.join(declarations)}) {{ {' '.join(fields)} }}"
+            body = shopify_graphql(self.shop, self.access_token, query, variables,
+                                   cost=len(batch) * SHOPIFY_MUTATION_COST)
+            data = (body or {}).get("data") or {}
+
+            for i, (product_id, variants) in enumerate(batch):
+                result = data.get(f"m{i}")
+                if result is None:
+                    for sku, _, _ in variants:
+                        results.setdefault(sku, []).append("price: запрос не выполнен")
+                    continue
+
+                for sku, _, _ in variants:
+                    results.setdefault(sku, [])
+                for error in result.get("userErrors") or []:
+                    index = self._error_index(error, "variants")
+                    targets = [variants[index]] if index is not None and index < len(variants) else variants
+                    for sku, _, _ in targets:
+                        results[sku].append(f"price: {error.get('message')}")
+
+    def _flush_inventory(self, results):
+        changes = self.inventory_changes
+        self.inventory_changes = []
+        query = """
+        mutation($input: InventorySetQuantitiesInput!) {
+          inventorySetQuantities(input: $input) { userErrors { field message } }
+        }
+        """
+
+        for start in range(0, len(changes), SHOPIFY_MAX_INVENTORY_PER_CALL):
+            batch = changes[start:start + SHOPIFY_MAX_INVENTORY_PER_CALL]
+            variables = {"input": {
+                "name": "available",
+                "reason": "correction",
+                "ignoreCompareQuantity": True,
+                "quantities": [{
+                    "inventoryItemId": f"gid://shopify/InventoryItem/{inventory_item_id}",
+                    "locationId": f"gid://shopify/Location/{self.location_id}",
+                    "quantity": int(float(quantity)),
+                } for _, inventory_item_id, quantity in batch],
+            }}
+            body = shopify_graphql(self.shop, self.access_token, query, variables)
+            result = ((body or {}).get("data") or {}).get("inventorySetQuantities")
 
+            if result is None:
+                for sku, _, _ in batch:
+                    results.setdefault(sku, []).append("quantity: запрос не выполнен")
+                continue
 
-def update_shopify_variant(shop, access_token, variant_id, inventory_item_id, new_price, new_quantity, sku):
-    headers = {"Content-Type": "application/json", "X-Shopify-Access-Token": access_token}
+            for sku, _, _ in batch:
+                results.setdefault(sku, [])
+            for error in result.get("userErrors") or []:
+                index = self._error_index(error, "quantities")
+                targets = [batch[index]] if index is not None and index < len(batch) else batch
+                for sku, _, _ in targets:
+                    results[sku].append(f"quantity: {error.get('message')}")
+
+    def sent_values(self):
+        """Значения, которые уйдут в Shopify при flush(): {sku: {"price": "12.34", "quantity": 5}}"""
+        sent = {}
+        for variants in self.price_changes.values():
+            for sku, _, price in variants:
+                sent.setdefault(sku, {})["price"] = f"{price:.2f}"
+        for sku, _, quantity in self.inventory_changes:
+            sent.setdefault(sku, {})["quantity"] = int(float(quantity))
+        return sent
+
+    def flush(self):
+        """Отправляет всё накопленное, а принятые значения переносит в зеркало. Возвращает {sku: [ошибки]}"""
+        sent = self.sent_values()
+        results = {}
+        if self.price_changes:
+            self._flush_prices(results)
+        if self.inventory_changes:
+            self._flush_inventory(results)
+
+        failed = sum(1 for errors in results.values() if errors)
+        if results:
+            logger.debug("📤 Отправлено изменений в Shopify: %s SKU, ошибок: %s", len(results), failed)
+        for sku, errors in results.items():
+            if errors:
+                sku_logger.error("❌ Ошибка обновления SKU `%s`: %s", sku, "; ".join(errors))
+
+        accepted = {}  # Цена и остаток принимаются отдельно: ошибка одного не отменяет другое
+        for sku, errors in results.items():
+            fields = {name: value for name, value in sent.get(sku, {}).items()
+                      if not any(error.startswith(f"{name}:") for error in errors)}
+            if fields:
+                accepted[sku] = fields
+        update_shopify_mirror(self.shop, accepted)
+        return results
+
+
+# 🔹 Общий каталог PowerBody: загружается и дополняется один раз за цикл, магазины читают готовый снимок
+CATALOG_KEY = "powerbody_catalog:{}"
+CATALOG_CURRENT_KEY = "powerbody_catalog:current"
+CATALOG_LOCK_KEY = "powerbody_catalog:lock"
+CATALOG_LOCK_TIMEOUT = 3 * 3600  # Сколько максимум может длиться обновление каталога, сек
+_catalog_lock = threading.Lock()
+_loaded_catalog = None  # Последний прочитанный снимок — чтобы не качать его заново для каждого магазина
+
+
+def installed_shop_skus():
+    """SKU, которые продаёт хоть один установленный магазин: ключи зеркал Shopify и снимков синхронизации"""
+    shops = list(load_installed_shops())
+    pipe = redis_client.pipeline(transaction=False)
+    for shop in shops:
+        pipe.hkeys(SHOPIFY_MIRROR_KEY.format(shop))
+        pipe.hkeys(SYNC_SNAPSHOT_KEY.format(shop))
+    skus = set()
+    for keys in pipe.execute():
+        skus.update(keys)
+    return skus
+
+
+def refresh_powerbody_catalog():
+    """Загружает getProductList, дополняет getProductInfo товары установленных магазинов и публикует новую
+    версию каталога. Остальные товары попадают в каталог без info — их дополнит по требованию sync_products."""
+    logger.info("🔄 Обновление общего каталога PowerBody...")
+    with SYNC_STAGE_SECONDS.labels("powerbody_list").time():  # Этап каталога; список для остатков — stock_list
+        powerbody_products = fetch_powerbody_products()
+    if not powerbody_products:
+        logger.error("❌ PowerBody не вернул товары. Каталог не обновлён.")
+        return None
 
-    print(f"🔄 Обновляем variant {variant_id} (SKU: {sku}): Цена {new_price}, Количество {new_quantity}")
+    wanted_skus = installed_shop_skus()
+    items = []
+    unsold = []  # Товары, которых нет ни в одном магазине: getProductInfo для них не запрашиваем
+    for pb_product in powerbody_products:
+        product_id = str(pb_product.product_id or "").strip()
+        if pb_product.sku and product_id:
+            item = (pb_product, pb_product.sku, product_id, product_list_fingerprint(pb_product))
+            (items if str(pb_product.sku) in wanted_skus else unsold).append(item)
+    del powerbody_products
+    logger.info(f"📦 Товаров установленных магазинов: {len(items)}, без getProductInfo: {len(unsold)}")
+
+    records = []
+    product_info_started = time.perf_counter()
+    enriched = itertools.chain(enrich_products(items), ((item, None) for item in unsold))
+    for (pb_product, sku, product_id, fingerprint), product_info in enriched:
+        records.append(CatalogProduct(
+            sku=sku,
+            product_id=product_id,
+            price=base_price_of(pb_product),
+            qty=parse_quantity(pb_product.qty),
+            fingerprint=fingerprint,
+            info=product_info,
+        ))
+    SYNC_STAGE_SECONDS.labels("product_info").observe(time.perf_counter() - product_info_started)
+
+    version = datetime.now().strftime("%Y%m%d%H%M%S")
+    catalog = PowerBodyCatalog(version=version, created_at=time.time(), products=records)
+    pipe = redis_client.pipeline()
+    pipe.set(CATALOG_KEY.format(version), msgspec.json.encode(catalog),
+             ex=2 * CATALOG_REFRESH_MINUTES * 60 + CATALOG_MAX_AGE_MINUTES * 60)
+    pipe.set(CATALOG_CURRENT_KEY, version)
+    pipe.execute()
+
+    logger.info(f"✅ Каталог PowerBody {version} опубликован: {len(records)} товаров")
+    return catalog
+
+
+def load_powerbody_catalog(version=None):
+    """Текущая (или указанная) версия каталога из Redis (повторное чтение той же версии берётся из памяти)"""
+    global _loaded_catalog
+    version = version or redis_client.get(CATALOG_CURRENT_KEY)
+    if not version:
+        return None
+    if _loaded_catalog and _loaded_catalog.version == version:
+        return _loaded_catalog
 
-    update_variant_url = f"https://{shop}/admin/api/2024-01/variants/{variant_id}.json"
-    variant_data = {"variant": {"id": variant_id, "price": f"{new_price:.2f}"}}
+    raw = redis_client.get(CATALOG_KEY.format(version))
+    if not raw:
+        return None
+    _loaded_catalog = catalog_decoder.decode(raw)
+    return _loaded_catalog
 
-    max_retries = 5
-    delay = 2  # Начальная задержка в секундах
 
-    for attempt in range(max_retries):
-        response = requests.put(update_variant_url, headers=headers, json=variant_data)
-
-        if response.status_code == 200:
-            print(f"✅ Успешно обновлена цена для variant {variant_id} (SKU: {sku}): {new_price}")
-            break  # Выходим из цикла, если обновление прошло успешно
-        elif response.status_code == 429:
-            print(f"⚠️ Ошибка 429 (Too Many Requests) при обновлении цены {sku}. Повтор через {delay} секунд...")
-            time.sleep(delay)
-            delay *= 2  # Увеличиваем задержку в 2 раза
-        else:
-            print(
-                f"❌ Ошибка обновления цены для variant {variant_id} (SKU: {sku}): {response.status_code} - {response.text}")
-            break  # Прерываем цикл при других ошибках
+def catalog_is_fresh(catalog):
+    return bool(catalog) and time.time() - catalog.created_at < CATALOG_MAX_AGE_MINUTES * 60
 
-    # Обновление количества товара
-    update_inventory_url = f"https://{shop}/admin/api/2024-01/inventory_levels/set.json"
-    inventory_data = {"location_id": 85726363936, "inventory_item_id": inventory_item_id, "available": new_quantity}
 
-    delay = 2  # Сбрасываем задержку перед обновлением количества
+def get_powerbody_catalog():
+    """Свежий каталог для синхронизации магазина. Если он устарел — обновляет его ровно один процесс,
+    остальные ждут и читают результат."""
+    catalog = load_powerbody_catalog()
+    if catalog_is_fresh(catalog):
+        return catalog
 
-    for attempt in range(max_retries):
-        response = requests.post(update_inventory_url, headers=headers, json=inventory_data)
-
-        if response.status_code == 200:
-            print(f"✅ Количество обновлено для variant {variant_id} (SKU: {sku}): {new_quantity}")
-            break
-        elif response.status_code == 429:
-            print(f"⚠️ Ошибка 429 (Too Many Requests) при обновлении количества {sku}. Повтор через {delay} секунд...")
-            time.sleep(delay)
-            delay *= 2  # Увеличиваем задержку
-        else:
-            print(
-                f"❌ Ошибка обновления количества для variant {variant_id} (SKU: {sku}): {response.status_code} - {response.text}")
-            break
+    with _catalog_lock:
+        lock = redis_client.lock(CATALOG_LOCK_KEY, timeout=CATALOG_LOCK_TIMEOUT, blocking_timeout=CATALOG_LOCK_TIMEOUT)
+        if not lock.acquire():
+            logger.warning("⚠️ Не дождались обновления каталога. Используем последнюю версию.")
+            return catalog
+        try:
+            catalog = load_powerbody_catalog()  # Пока ждали блокировку, каталог мог обновить другой процесс
+            if catalog_is_fresh(catalog):
+                return catalog
+            return refresh_powerbody_catalog() or catalog
+        finally:
+            lock.release()
+
+
+def refresh_powerbody_catalog_job():
+    """Плановое обновление каталога; если его уже обновляет другой процесс — пропускаем.
+    Возвращает версию нового каталога, "skipped" или None, если обновить не удалось."""
+    lock = redis_client.lock(CATALOG_LOCK_KEY, timeout=CATALOG_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.info("⏭️ Каталог PowerBody уже обновляется другим процессом.")
+        return "skipped"
+    try:
+        catalog = refresh_powerbody_catalog()
+        return catalog.version if catalog else None
+    finally:
+        lock.release()
 
 
+STOCK_LIST_KEY = "powerbody_stock_list"  # Свежий getProductList для синхронизации остатков
+STOCK_LIST_LOCK_KEY = "powerbody_stock_list:lock"
+
+
+def get_powerbody_stock_list():
+    """getProductList для синхронизации остатков. Остатки всех магазинов синхронизируются почти одновременно,
+    поэтому список запрашивается у PowerBody один раз и живёт в Redis STOCK_LIST_CACHE_SECONDS секунд."""
+    raw = redis_client.get(STOCK_LIST_KEY)
+    if raw:
+        return powerbody_products_decoder.decode(raw)
+
+    lock = redis_client.lock(STOCK_LIST_LOCK_KEY, timeout=300, blocking_timeout=300)
+    if not lock.acquire():
+        logger.warning("⚠️ Не дождались загрузки списка товаров PowerBody. Запрашиваем сами.")
+        return fetch_powerbody_products()
+    try:
+        raw = redis_client.get(STOCK_LIST_KEY)  # Пока ждали, список мог загрузить другой процесс
+        if raw:
+            return powerbody_products_decoder.decode(raw)
+        with SYNC_STAGE_SECONDS.labels("stock_list").time():
+            products = fetch_powerbody_products()
+        if products:
+            redis_client.set(STOCK_LIST_KEY, msgspec.json.encode(products), ex=STOCK_LIST_CACHE_SECONDS)
+        return products
+    finally:
+        lock.release()
+
+
+# 🔹 Снимок последней синхронизации: SKU → [base_price, qty, final_price, fingerprint, поля отчёта...]
+SYNC_SNAPSHOT_KEY = "sync_snapshot:{}"
+SNAPSHOT_ROW_FIELDS = slice(4, 9)  # Brand Name, Item Name, Flavor, Weight (grams), EAN
+
+
+def parse_quantity(qty):
+    """Количество из PowerBody приходит строкой или числом — приводим к int"""
+    try:
+        return int(float(qty)) if qty is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def prices_differ(shopify_price, final_price):
+    """Shopify отдаёт цену строкой ("12.90"), мы считаем float — сравниваем по копейкам"""
+    if shopify_price is None or final_price is None:
+        return shopify_price != final_price
+    return round(float(shopify_price), 2) != round(final_price, 2)
+
+
+def make_snapshot_entry(base_price, quantity, final_price, fingerprint, row):
+    return [base_price, quantity, final_price, fingerprint, *row[1:6]]
+
+
+def snapshot_unchanged(entry, base_price, quantity, final_price, fingerprint, shopify_variant):
+    """SKU можно пропустить: данные PowerBody, цена и остаток в Shopify совпадают со снимком"""
+    return (entry[0] == base_price and entry[1] == quantity and entry[2] == final_price and entry[3] == fingerprint
+            and not prices_differ(shopify_variant.price, final_price) and shopify_variant.quantity == quantity)
+
+
+def load_sync_snapshot(shop):
+    """Читает весь снимок одним HGETALL"""
+    raw = redis_client.hgetall(SYNC_SNAPSHOT_KEY.format(shop))
+    snapshot = {sku: json.loads(value) for sku, value in raw.items()}
+    logger.info(f"📥 Снимок прошлой синхронизации для {shop}: {len(snapshot)} SKU")
+    return snapshot
+
+
+def queue_snapshot_writes(pipe, shop, updates, stale_skus=()):
+    """Добавляет в pipeline запись изменившихся SKU и удаление пропавших; возвращает их количество"""
+    key = SYNC_SNAPSHOT_KEY.format(shop)
+    items = [(sku, json.dumps(entry, separators=(",", ":"))) for sku, entry in updates.items()]
+    for i in range(0, len(items), 1000):
+        pipe.hset(key, mapping=dict(items[i:i + 1000]))
+    stale_skus = list(stale_skus)
+    for i in range(0, len(stale_skus), 1000):
+        pipe.hdel(key, *stale_skus[i:i + 1000])
+    return len(items), len(stale_skus)
+
+
+def save_sync_snapshot(shop, updates, stale_skus=()):
+    """Сохраняет изменившиеся SKU и удаляет пропавшие из каталога"""
+    pipe = redis_client.pipeline(transaction=False)
+    written, removed = queue_snapshot_writes(pipe, shop, updates, stale_skus)
+    pipe.execute()
+    logger.info(f"💾 Снимок обновлён для {shop}: {written} SKU записано, {removed} удалено")
+
+
+# 🔹 Чекпоинт полной синхронизации: позиция в каталоге, счётчики и готовая часть отчёта.
+# Изменения в Shopify перед чекпоинтом отправляются, так что незавершённых записей в нём нет.
+SYNC_CHECKPOINT_KEY = "sync_checkpoint:{}"
+SYNC_CHECKPOINT_ROWS_KEY = "sync_checkpoint:{}:rows"  # CSV-фрагменты отчёта по порядку
+SYNC_CHECKPOINT_TTL = 2 * 86400
+
+
+def load_sync_checkpoint(shop):
+    checkpoint = redis_client.hgetall(SYNC_CHECKPOINT_KEY.format(shop))
+    if not checkpoint:
+        return None
+    checkpoint["position"] = int(checkpoint["position"])
+    checkpoint["counters"] = json.loads(checkpoint["counters"])
+    return checkpoint
+
+
+def save_sync_checkpoint(shop, catalog_version, timestamp, position, counters, report_chunk, snapshot_updates):
+    """Одной транзакцией: фрагмент отчёта, изменения снимка и новая позиция — после сбоя они не разойдутся"""
+    key, rows_key = SYNC_CHECKPOINT_KEY.format(shop), SYNC_CHECKPOINT_ROWS_KEY.format(shop)
+    pipe = redis_client.pipeline()
+    if report_chunk:
+        pipe.rpush(rows_key, report_chunk)
+    queue_snapshot_writes(pipe, shop, snapshot_updates)
+    pipe.hset(key, mapping={"catalog": catalog_version, "timestamp": timestamp, "position": position,
+                            "counters": json.dumps(counters), "updated_at": time.time()})
+    pipe.expire(key, SYNC_CHECKPOINT_TTL)
+    pipe.expire(rows_key, SYNC_CHECKPOINT_TTL)
+    pipe.execute()
+
+
+def clear_sync_checkpoint(shop):
+    redis_client.delete(SYNC_CHECKPOINT_KEY.format(shop), SYNC_CHECKPOINT_ROWS_KEY.format(shop))
+
+
+SYNC_LOCK_KEY = "sync_lock:{}"
+
+
+def exclusive_shop_sync(func):
+    """Не даёт двум синхронизациям одного магазина (полной и/или остатков) идти одновременно —
+    ни в одном процессе, ни на разных хостах. Занято — прогон пропускается и возвращается "skipped"
+    (None от самой синхронизации означает, что она не удалась)."""
+    @functools.wraps(func)
+    def wrapper(shop, *args, **kwargs):
+        lease = RedisLease(SYNC_LOCK_KEY.format(shop), SYNC_LOCK_SECONDS)
+        if not lease.acquire():
+            logger.info(f"⏭️ Для {shop} уже идёт синхронизация. {func.__name__} пропущен.")
+            return "skipped"
+        try:
+            return func(shop, *args, **kwargs)
+        finally:
+            lease.release()
+            enqueue_pending_reprice(shop)
+    return wrapper
+
+
+@exclusive_shop_sync
 def sync_products(shop):
     """Полная синхронизация товаров с немедленной записью в CSV (с использованием временного файла)"""
     access_token = get_token(shop)
     if not access_token:
-        print(f"❌ Ошибка: Токен для {shop} не найден. Пропускаем синхронизацию.")
+        logger.error(f"❌ Ошибка: Токен для {shop} не найден. Пропускаем синхронизацию.")
         return
 
-    print(f"🔄 Начинаем синхронизацию для {shop}...")
+    logger.info(f"🔄 Начинаем синхронизацию для {shop}...")
+    started_at = time.monotonic()
 
     # Загружаем настройки
-    settings = load_settings()
+    settings = load_settings(shop)
     vat = settings["vat"]
     paypal_fees = settings["paypal_fees"]
     second_paypal_fees = settings["second_paypal_fees"]
     profit = settings["profit"]
 
-    powerbody_products = fetch_powerbody_products()
-    shopify_products = fetch_all_shopify_products(shop, access_token)
-    in_progress_flag = os.path.join(CSV_DIR, ".sync_in_progress")
-    open(in_progress_flag, "w").close()  # создаём пустой файл-флаг
-    final_filename = None
-    try:
-        shopify_sku_map = {
-            v.get("sku"): (v["id"], v.get("inventory_item_id"), v.get("price"), v.get("inventory_quantity"))
-            for p in shopify_products for v in p["variants"] if v.get("sku")
-        }
+    # ⏯️ Прерванный прогон продолжаем с чекпоинта — на той же версии каталога
+    checkpoint = load_sync_checkpoint(shop)
+    catalog = load_powerbody_catalog(checkpoint["catalog"]) if checkpoint else None
+    if checkpoint and not catalog:
+        logger.warning(f"⚠️ Каталог {checkpoint['catalog']} из чекпоинта {shop} больше недоступен. Начинаем заново.")
+        clear_sync_checkpoint(shop)
+        checkpoint = None
+    if not catalog:
+        catalog = get_powerbody_catalog()
+    if not catalog:
+        logger.error(f"❌ Каталог PowerBody недоступен. Пропускаем синхронизацию {shop}.")
+        return
+    logger.info(f"📦 Каталог PowerBody {catalog.version}: {len(catalog.products)} товаров")
+
+    with SYNC_STAGE_SECONDS.labels("shopify_fetch").time():  # Только полная синхронизация, не остатки и не пересчёт
+        shopify_sku_map = get_shopify_sku_map(shop, access_token)
+    if shopify_sku_map is None:
+        # Чекпоинт и снимок не трогаем: следующий прогон продолжит с того же места
+        logger.error(f"❌ Товары Shopify для {shop} недоступны. Синхронизация отложена.")
+        return None
 
-        synced_count = 0
+    if checkpoint:
+        start = checkpoint["position"]
+        timestamp = checkpoint["timestamp"]
+        synced_count, failed_count, unchanged_count, missing_count, no_info_count = checkpoint["counters"]
+        logger.info(f"⏯️ Продолжаем синхронизацию {shop} с позиции {start} из {len(catalog.products)}")
+    else:
+        start = 0
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        temp_filename = os.path.join(CSV_DIR, f"~sync_temp_{timestamp}.csv")
-        final_filename = os.path.join(CSV_DIR, f"sync_report_{timestamp}.csv")
-
-        # Создаём временный CSV-файл и записываем заголовки
-        with open(temp_filename, "w", newline="", encoding="utf-8") as file:
-            writer = csv.writer(file)
-            header = ["SKU", "Brand Name", "Item Name", "Flavor", "Weight (grams)", "EAN", "Price API", "Price Shopify",
-                      "Quantity"]
-            writer.writerow(header)
-
-            for pb_product in powerbody_products:
-                if not isinstance(pb_product, dict):
-                    continue
+        synced_count = failed_count = unchanged_count = missing_count = no_info_count = 0
+
+    # 🔄 Товары магазина, которых при сборке каталога не было ни в одном магазине, дополняем по требованию
+    on_demand = [(record, record.sku, record.product_id, record.fingerprint)
+                 for record in catalog.products[start:]
+                 if record.info is None and record.sku in shopify_sku_map]
+    on_demand_info = {}
+    if on_demand:
+        logger.info(f"🔄 {len(on_demand)} товаров {shop} нет в каталоге с getProductInfo — запрашиваем")
+        for (record, *_), product_info in enrich_products(on_demand):
+            if product_info is not None:
+                on_demand_info[record.sku] = product_info
+
+    reports_dir = shop_reports_dir(shop)
+    temp_filename = os.path.join(reports_dir, f"~sync_temp_{timestamp}.csv.gz")
+    final_filename = os.path.join(reports_dir, f"sync_report_{timestamp}.csv.gz")
+
+    batch_writer = ShopifyBatchWriter(shop, access_token)
+    pending_rows = {}  # SKU → строка CSV, ожидающая результата записи в Shopify
+    snapshot = load_sync_snapshot(shop)
+    snapshot_updates = {}  # SKU → новое состояние для снимка
+    pending_snapshot = {}  # SKU → состояние, которое запомним после успешной записи в Shopify
+    seen_skus = {r.sku for r in catalog.products[:start] if r.sku in shopify_sku_map}
+    timer = StageTimer("pricing", "csv_write", "variant_update")
+    pricing, csv_write = timer.stage("pricing"), timer.stage("csv_write")
+    variant_update = timer.stage("variant_update")
+
+    # Создаём временный CSV-файл и записываем заголовки (и уже готовую часть отчёта из чекпоинта).
+    # Строки копятся в памяти и дописываются в файл фрагментами — теми же, что уходят в чекпоинт.
+    with gzip.open(temp_filename, "wt", newline="", encoding="utf-8", compresslevel=6) as file:
+        report = io.StringIO(newline="")
+        writer = csv.writer(report)
+        header = ["SKU", "Brand Name", "Item Name", "Flavor", "Weight (grams)", "EAN", "Price API", "Price Shopify",
+                  "Quantity", "Shopify Update"]
 
-                sku = pb_product.get("sku")
-                product_id = str(pb_product.get("product_id") or "").strip()
+        def take_report_chunk():
+            """Переносит накопленные строки в файл и возвращает их"""
+            with csv_write:
+                chunk = report.getvalue()
+                file.write(chunk)
+                report.seek(0)
+                report.truncate()
+            return chunk
 
-                if not product_id or not sku or sku not in shopify_sku_map:
-                    print(f"⚠️ Пропущен товар SKU `{sku}`, product_id: `{product_id}`")
-                    continue
+        writer.writerow(header)
+        take_report_chunk()
+        if checkpoint:
+            for chunk in redis_client.lrange(SYNC_CHECKPOINT_ROWS_KEY.format(shop), 0, -1):
+                file.write(chunk)
+
+        def save_checkpoint(position):
+            """Отправляет накопленные изменения и запоминает, докуда дошли"""
+            flush_updates()
+            chunk = take_report_chunk()
+            save_sync_checkpoint(shop, catalog.version, timestamp, position,
+                                 [synced_count, failed_count, unchanged_count, missing_count, no_info_count],
+                                 chunk, snapshot_updates)
+            snapshot_updates.clear()
+
+        def flush_updates():
+            """Отправляет накопленные изменения и дописывает в CSV строки с результатом"""
+            nonlocal synced_count, failed_count
+            with variant_update:
+                results = batch_writer.flush()
+            with csv_write:
+                for updated_sku, errors in results.items():
+                    row = pending_rows.pop(updated_sku, None)
+                    if errors:
+                        status = "failed: " + "; ".join(errors)
+                        pending_snapshot.pop(updated_sku, None)  # Не запоминаем — повторим в следующий раз
+                        failed_count += 1
+                    else:
+                        status = "updated"
+                        synced_count += 1
+                    if row is not None:
+                        writer.writerow(row + [status])
+                for row in pending_rows.values():  # Нечего было отправлять (нет цены и количества)
+                    writer.writerow(row + ["skipped"])
+            pending_rows.clear()
+            snapshot_updates.update(pending_snapshot)
+            pending_snapshot.clear()
+
+        for position in range(start, len(catalog.products)):
+            if position > start and position % SYNC_CHECKPOINT_EVERY == 0:
+                save_checkpoint(position)
+            record = catalog.products[position]
+            sku = record.sku
+            product_id = record.product_id
+
+            if sku not in shopify_sku_map:
+                sku_logger.debug("⚠️ Пропущен товар SKU `%s`, product_id: `%s`", sku, product_id)
+                missing_count += 1
+                continue
 
-                print(f"🔄 Запрос информации о товаре `{product_id}` для SKU `{sku}`...")
-                product_info = fetch_product_info(product_id)
+            seen_skus.add(sku)
+            fingerprint = record.fingerprint
+            base_price = record.price
+            new_quantity = record.qty
+            # 🛒 Рассчитываем новую цену
+            with pricing:
+                final_price = calculate_final_price(base_price, vat, paypal_fees, second_paypal_fees, profit)
 
-                if not product_info:
-                    print(f"⚠️ Не удалось получить информацию о товаре `{product_id}`. Пропускаем.")
-                    continue
+            # ⏭️ Ничего не изменилось с прошлой синхронизации — ни сети, ни пересчёта
+            entry = snapshot.get(sku)
+            if entry and snapshot_unchanged(entry, base_price, new_quantity, final_price, fingerprint,
+                                            shopify_sku_map[sku]):
+                with csv_write:
+                    writer.writerow([sku, *entry[SNAPSHOT_ROW_FIELDS], base_price, final_price, new_quantity,
+                                     "unchanged"])
+                unchanged_count += 1
+                continue
 
-                base_price = float(pb_product.get("retail_price", pb_product.get("price", "0.00")) or 0.00)
-                new_quantity = pb_product.get("qty")
+            product_info = record.info or on_demand_info.get(sku)
+            if not product_info:
+                sku_logger.debug("⚠️ Не удалось получить информацию о товаре `%s`. Пропускаем.", product_id)
+                no_info_count += 1
+                continue
 
-                variant_id, inventory_item_id, old_price, old_quantity = shopify_sku_map[sku]
+            variant = shopify_sku_map[sku]
+            old_price, old_quantity = variant.price, variant.quantity
 
-                brand_name = product_info.get("manufacturer")
-                name = product_info.get("name", "")
-                weight = product_info.get("weight", 0)
-                ean = product_info.get("ean")
+            brand_name = product_info.manufacturer
+            name = product_info.name
+            weight = product_info.weight
+            ean = product_info.ean
 
+            with pricing:  # Сюда же относим подготовку полей отчёта
                 # 🆕 Определяем `Flavor` и корректируем `Item Name`
                 flavor, item_name = extract_flavor_advanced(name)
 
@@ -887,68 +2465,278 @@ def sync_products(shop):
                 # 🆕 Переводим вес в граммы
                 weight_grams = int(float(weight) * 1000) if weight else None
 
-                # 🛒 Рассчитываем новую цену
-                final_price = calculate_final_price(base_price, vat, paypal_fees, second_paypal_fees, profit)
-
-                # 💾 Записываем в CSV сразу!
                 clean_item_name = re.sub(r"\s*,\s*", " ", item_name).strip() if item_name else None
-                row = [sku, brand_name, clean_item_name, flavor, weight_grams, ean, base_price, final_price, new_quantity]
-                writer.writerow(row)
-                print(f"📦 Полное имя из PowerBody: {name}")
-                print(f"✅ Записано в CSV: {row}")
-
-                # 🔄 Проверяем, нужно ли обновлять товар
-                if old_price != final_price or old_quantity != new_quantity:
-                    print(f"🔄 Обновляем SKU `{sku}`: Цена API `{base_price}` → Shopify `{final_price}`, Количество: `{old_quantity}` → `{new_quantity}`")
-                    update_shopify_variant(shop, access_token, variant_id, inventory_item_id, final_price, new_quantity, sku)
-                    synced_count += 1
-                    time.sleep(0.6)  # 🛑 Shopify API лимит - не более 2 запросов в секунду
-
-        # ✅ Переименовываем временный файл в финальный только после успешной записи
-        os.rename(temp_filename, final_filename)
-        print(f"✅ Синхронизация завершена! Обновлено товаров: {synced_count}")
-        print(f"📂 CSV-файл окончательно сохранён: `{final_filename}`")
-    finally:
-        if os.path.exists(in_progress_flag):
-            os.remove(in_progress_flag)
+                row = [sku, brand_name, clean_item_name, flavor, weight_grams, ean, base_price, final_price,
+                       new_quantity]
+                entry = make_snapshot_entry(base_price, new_quantity, final_price, fingerprint, row)
+            sku_logger.debug("📦 Полное имя из PowerBody: %s", name)
+
+            # 🔄 Проверяем, нужно ли обновлять товар
+            price_changed = prices_differ(old_price, final_price)
+            quantity_changed = old_quantity != new_quantity
+            if price_changed or quantity_changed:
+                sku_logger.debug("🔄 Обновляем SKU `%s`: Цена API `%s` → Shopify `%s`, Количество: `%s` → `%s`",
+                                 sku, base_price, final_price, old_quantity, new_quantity)
+                # 💾 Строка попадёт в CSV после ответа Shopify — с результатом обновления
+                pending_rows[sku] = row
+                pending_snapshot[sku] = entry
+                batch_writer.add(sku, variant.product_id, variant.variant_id, variant.inventory_item_id,
+                                 price=final_price if price_changed else None,
+                                 quantity=new_quantity if quantity_changed else None)
+                if batch_writer.is_full():
+                    flush_updates()
+            else:
+                # 💾 Записываем в CSV сразу!
+                with csv_write:
+                    writer.writerow(row + ["unchanged"])
+                snapshot_updates[sku] = entry
+                sku_logger.debug("✅ Записано в CSV: %s", row)
+
+        flush_updates()
+        take_report_chunk()
+
+    save_sync_snapshot(shop, snapshot_updates, stale_skus=set(snapshot) - seen_skus)
+
+    # ✅ Переименовываем временный файл в финальный только после успешной записи
+    publish_sync_report(shop, temp_filename, final_filename)
+    clear_sync_checkpoint(shop)
+    timer.observe()
+    for state, count in (("seen", len(seen_skus)), ("changed", synced_count), ("failed", failed_count),
+                         ("unchanged", unchanged_count), ("skipped", missing_count + no_info_count)):
+        SYNC_SKUS.labels(shop, state).set(count)
+    logger.info(f"✅ Синхронизация завершена! Обновлено товаров: {synced_count}", extra={
+        "event": "sync_summary", "shop": shop, "catalog": catalog.version, "seen": len(seen_skus),
+        "updated": synced_count, "failed": failed_count, "unchanged": unchanged_count,
+        "missing_in_shopify": missing_count, "no_product_info": no_info_count,
+        "duration_s": round(time.monotonic() - started_at, 1), "report": final_filename,
+    })
 
     return final_filename
 
 
 
 
+@exclusive_shop_sync
+def sync_stock(shop):
+    """Быстрая синхронизация только остатков: общий на все магазины getProductList → inventorySetQuantities.
+    Без getProductInfo, разбора вкусов, пересчёта цен и CSV."""
+    access_token = get_token(shop)
+    if not access_token:
+        logger.error(f"❌ Ошибка: Токен для {shop} не найден. Пропускаем синхронизацию остатков.")
+        return None
+
+    started_at = time.monotonic()
+    powerbody_products = get_powerbody_stock_list()
+    if not powerbody_products:
+        return None
+    shopify_sku_map = get_shopify_sku_map(shop, access_token)
+    if shopify_sku_map is None:
+        logger.error(f"❌ Товары Shopify для {shop} недоступны. Синхронизация остатков отложена.")
+        return None
+
+    batch_writer = ShopifyBatchWriter(shop, access_token)
+    updated_count = 0
+    for pb_product in powerbody_products:
+        sku = pb_product.sku
+        variant = shopify_sku_map.get(sku)
+        new_quantity = parse_quantity(pb_product.qty)
+        if not variant or new_quantity is None or variant.quantity == new_quantity:
+            continue
+        batch_writer.add(sku, variant.product_id, variant.variant_id, variant.inventory_item_id, quantity=new_quantity)
+        if batch_writer.is_full():
+            updated_count += update_snapshot_quantities(shop, batch_writer.flush(), powerbody_products)
+    updated_count += update_snapshot_quantities(shop, batch_writer.flush(), powerbody_products)
+
+    logger.info(f"✅ Синхронизация остатков для {shop} завершена. Обновлено SKU: {updated_count}", extra={
+        "event": "stock_sync_summary", "shop": shop, "updated": updated_count,
+        "duration_s": round(time.monotonic() - started_at, 1),
+    })
+    return updated_count
+
+
+def update_snapshot_quantities(shop, results, powerbody_products):
+    """Переносит новые остатки в снимок, чтобы полная синхронизация не считала эти SKU изменёнными"""
+    updated = [sku for sku, errors in results.items() if not errors]
+    if not updated:
+        return 0
+    quantities = {p.sku: parse_quantity(p.qty) for p in powerbody_products}
+    key = SYNC_SNAPSHOT_KEY.format(shop)
+    entries = {}
+    for sku, value in zip(updated, redis_client.hmget(key, updated)):
+        if value:
+            entry = json.loads(value)
+            entry[1] = quantities.get(sku)
+            entries[sku] = json.dumps(entry, separators=(",", ":"))
+    if entries:
+        redis_client.hset(key, mapping=entries)
+    return len(updated)
+
+
+# 🔹 Мгновенный пересчёт цен после смены настроек: по базовым ценам из снимка, без обращения к PowerBody
+REPRICE_PENDING_KEY = "reprice_pending:{}"  # Пересчёт отложен — магазин был занят синхронизацией
+
+
+def enqueue_pending_reprice(shop):
+    """После освобождения магазина ставит отложенный пересчёт: настройки сменились, пока магазин был занят"""
+    if redis_client.delete(REPRICE_PENDING_KEY.format(shop)):
+        enqueue_sync_job("reprice", shop)
+
+
+def reprice_shop(shop):
+    """Задание reprice. Если у магазина идёт синхронизация — откладывает пересчёт до её окончания"""
+    lease = RedisLease(SYNC_LOCK_KEY.format(shop), SYNC_LOCK_SECONDS)
+    if not lease.acquire():
+        redis_client.set(REPRICE_PENDING_KEY.format(shop), 1, ex=SYNC_JOB_TTL)
+        # Держатель мог освободить магазин до нашей отметки — тогда её уже никто не заберёт, пробуем ещё раз
+        if not lease.acquire():
+            logger.info(f"⏳ Для {shop} идёт синхронизация. Пересчёт цен выполнится после неё.")
+            return "deferred"
+        redis_client.delete(REPRICE_PENDING_KEY.format(shop))  # Пересчитаем сейчас сами
+    try:
+        return reprice_shop_prices(shop)
+    finally:
+        lease.release()
+        enqueue_pending_reprice(shop)  # Настройки могли смениться ещё раз, пока шёл этот пересчёт
+
+
+def reprice_shop_prices(shop):
+    """Пересчитывает цены всех SKU из снимка одним векторным проходом и отправляет в Shopify только изменившиеся"""
+    access_token = get_token(shop)
+    if not access_token:
+        logger.error(f"❌ Ошибка: Токен для {shop} не найден. Пропускаем пересчёт цен.")
+        return None
+
+    started_at = time.monotonic()
+    settings = load_settings(shop)
+    raw = redis_client.hgetall(SYNC_SNAPSHOT_KEY.format(shop))
+    if not raw:
+        logger.info(f"⏭️ Для {shop} ещё нет снимка синхронизации — пересчитывать нечего.")
+        return 0
+
+    skus = list(raw)
+    entries = [json.loads(raw[sku]) for sku in skus]
+    del raw
+    base_prices = np.fromiter((entry[0] or 0.0 for entry in entries), dtype=np.float64, count=len(entries))
+    final_prices = calculate_final_prices(base_prices, settings["vat"], settings["paypal_fees"],
+                                          settings["second_paypal_fees"], settings["profit"])
+
+    shopify_sku_map = get_shopify_sku_map(shop, access_token)
+    if shopify_sku_map is None:
+        logger.error(f"❌ Товары Shopify для {shop} недоступны. Пересчёт цен отложен.")
+        return None
+    variants = [shopify_sku_map.get(sku) for sku in skus]
+    current_prices = np.fromiter(
+        (float(v.price) if v is not None and v.price is not None else np.nan for v in variants),
+        dtype=np.float64, count=len(variants))
+    changed = ~np.isnan(final_prices) & (np.round(current_prices, 2) != final_prices)
+
+    # Снимок должен помнить новую цену, иначе следующая полная синхронизация сочтёт изменёнными все SKU
+    accepted = ~changed
+    batch_writer = ShopifyBatchWriter(shop, access_token)
+    index_of = {}
+    updated_count = failed_count = 0
+
+    def flush():
+        nonlocal updated_count, failed_count
+        for sku, errors in batch_writer.flush().items():
+            if errors:
+                failed_count += 1
+            else:
+                accepted[index_of[sku]] = True
+                updated_count += 1
+
+    for i in np.flatnonzero(changed):
+        variant = variants[i]
+        if variant is None:
+            continue
+        index_of[skus[i]] = i
+        batch_writer.add(skus[i], variant.product_id, variant.variant_id, variant.inventory_item_id,
+                         price=float(final_prices[i]))
+        if batch_writer.is_full():
+            flush()
+    flush()
+
+    updates = {}
+    for i in np.flatnonzero(accepted):
+        final_price = None if np.isnan(final_prices[i]) else float(final_prices[i])
+        if entries[i][2] != final_price:
+            entries[i][2] = final_price
+            updates[skus[i]] = entries[i]
+    if updates:
+        save_sync_snapshot(shop, updates)
+
+    logger.info(f"💱 Цены {shop} пересчитаны: изменено {updated_count} из {len(skus)} SKU", extra={
+        "event": "reprice_summary", "shop": shop, "skus": len(skus), "changed": int(changed.sum()),
+        "updated": updated_count, "failed": failed_count, "duration_s": round(time.monotonic() - started_at, 1),
+    })
+    return updated_count
+
+
 @app.route('/update_settings', methods=['POST'])
-def update_settings():
-    """Обновление настроек"""
+@shop_required
+def update_settings(shop):
+    """Обновление настроек магазина"""
     settings = {
         "vat": float(request.form.get("vat", 20)),
         "paypal_fees": float(request.form.get("paypal_fees", 3)),
         "second_paypal_fees": float(request.form.get("second_paypal_fees", 0.20)),
         "profit": float(request.form.get("profit", 30))
     }
-    save_settings(settings)
-    return jsonify({"status": "success", "message": "✅ Settings saved!"})
+    save_settings(shop, settings)
+    reprice_jobs = enqueue_sync_job("reprice", shop)  # Новые цены — сразу, не дожидаясь полной синхронизации
+    return jsonify({"status": "success", "message": "✅ Settings saved!", "reprice_jobs": reprice_jobs})
 
 
-def load_settings():
-    if os.path.exists(SETTINGS_FILE):
+def load_legacy_settings():
+    """Общие настройки из settings.json (до хранения в Redis) — начальные значения для магазина"""
+    if not os.path.exists(SETTINGS_FILE):
+        return dict(DEFAULT_SETTINGS)
+    try:
         with open(SETTINGS_FILE, "r") as file:
-            return json.load(file)
+            legacy = json.load(file)
+        return {name: float(legacy.get(name, default)) for name, default in DEFAULT_SETTINGS.items()}
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️ Не удалось прочитать {SETTINGS_FILE}: {e}")
+        return dict(DEFAULT_SETTINGS)
+
+
+def load_settings(shop):
+    """Настройки цен магазина: из памяти процесса, иначе одним HGETALL из Redis"""
+    ensure_invalidation_listener()
+    found, settings = settings_cache.get(shop)
+    if found:
+        return dict(settings)
+
+    raw = redis_client.hgetall(SETTINGS_KEY.format(shop))
+    if raw:
+        settings = {**DEFAULT_SETTINGS, **{name: float(value) for name, value in raw.items()}}
     else:
-        default_settings = {"vat": 20.0, "paypal_fees": 3.0, "second_paypal_fees": 0.20, "profit": 30.0}
-        save_settings(default_settings)
-        return default_settings
+        settings = load_legacy_settings()
+        # Только если ключа ещё нет — не затираем настройки, сохранённые параллельно
+        pipe = redis_client.pipeline(transaction=False)
+        for name, value in settings.items():
+            pipe.hsetnx(SETTINGS_KEY.format(shop), name, value)
+        pipe.execute()
+        logger.info(f"🆕 Настройки для {shop} заведены в Redis: {settings}")
 
+    settings_cache.set(shop, settings)
+    return dict(settings)
 
-def save_settings(settings):
-    with open(SETTINGS_FILE, "w") as file:
-        json.dump(settings, file, indent=4)
+
+def save_settings(shop, settings):
+    """Сохраняет настройки магазина в Redis и сбрасывает их кэш во всех процессах"""
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(SETTINGS_KEY.format(shop), mapping={name: float(settings[name]) for name in DEFAULT_SETTINGS})
+    pipe.publish(SETTINGS_UPDATES_CHANNEL, shop)
+    pipe.execute()
+    settings_cache.invalidate(shop)
+    logger.info(f"💾 Настройки цен сохранены для {shop}")
 
 
 def save_to_csv(data):
-    """Сохраняет данные в CSV с логированием каждой строки после записи."""
+    """Сохраняет данные в CSV (построчный лог — только на уровне DEBUG для SKU)."""
     if not data:
-        print("⚠️ Нет данных для сохранения в CSV.")
+        logger.warning("⚠️ Нет данных для сохранения в CSV.")
         return None  # Выход, если данных нет
 
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -960,78 +2748,358 @@ def save_to_csv(data):
                   "Quantity"]
         writer.writerow(header)
 
-        print("\n📌 **Начинаем сохранение CSV-отчёта...**")
-        print("------------------------------------------------------")
-        print("📝 Заголовки:", header)
-
         for row in data:
             writer.writerow(row)
-            print(f"✅ Добавлена запись в CSV: {row}")  # 🔥 Лог сразу после записи
+            sku_logger.debug("✅ Добавлена запись в CSV: %s", row)
 
-        print("------------------------------------------------------")
-        print(f"✅ CSV файл сохранён: `{filename}`")
+    logger.info(f"✅ CSV файл сохранён: `{filename}`", extra={"rows": len(data)})
+    return filename  # Возвращаем путь к файлу
 
-    # 🔍 Проверяем содержимое файла после сохранения
-    with open(filename, "r", encoding="utf-8") as file:
-        print("\n🔍 **Содержимое CSV-файла:**")
-        print(file.read())
 
-    return filename  # Возвращаем путь к файлу
+# 🔹 Индекс отчётов: sorted set путей по времени публикации — последний отчёт магазина находится за O(1)
+SYNC_REPORTS_KEY = "sync_reports:{}"
+
 
+def shop_reports_dir(shop):
+    path = os.path.abspath(os.path.join(CSV_DIR, re.sub(r"[^\w.-]", "_", shop)))
+    os.makedirs(path, exist_ok=True)
+    return path
 
-def get_latest_csv():
-    """Находит последний завершённый CSV-файл (не временный и не в процессе)."""
-    files = sorted(os.listdir(CSV_DIR), reverse=True)
-    for file in files:
-        if file.startswith("sync_report_") and file.endswith(".csv") and not file.startswith("~"):
-            return os.path.join(CSV_DIR, file)
+
+def publish_sync_report(shop, temp_filename, final_filename):
+    """Переименовывает готовый отчёт, добавляет его в индекс и удаляет отчёты сверх SYNC_REPORTS_KEEP"""
+    os.replace(temp_filename, final_filename)
+    key = SYNC_REPORTS_KEY.format(shop)
+    pipe = redis_client.pipeline()
+    pipe.zadd(key, {final_filename: time.time()})
+    pipe.zrange(key, 0, -SYNC_REPORTS_KEEP - 1)
+    pipe.zremrangebyrank(key, 0, -SYNC_REPORTS_KEEP - 1)
+    _, expired, _ = pipe.execute()
+    for path in expired:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    logger.info(f"📂 Отчёт сохранён: `{final_filename}`")
+
+
+def get_latest_csv(shop):
+    """Последний завершённый отчёт магазина из индекса (временные файлы в индекс не попадают)"""
+    latest = redis_client.zrange(SYNC_REPORTS_KEY.format(shop), -1, -1)
+    if latest and os.path.exists(latest[0]):
+        return latest[0]
     return None
 
 
-@app.route("/download_csv")
-def download_csv():
-    """Отправляет последний завершённый CSV-файл, даже если новая синхронизация в процессе."""
-    files = [f for f in os.listdir(CSV_DIR) if f.startswith("sync_report_") and not f.startswith("~")]
-    files.sort(reverse=True)
+@app.route("/metrics")
+def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
 
-    if not files:
+@app.route("/download_csv")
+@shop_required
+def download_csv(shop):
+    """Отправляет последний завершённый отчёт магазина, даже если новая синхронизация в процессе.
+    Клиенту с gzip отдаём файл как есть (Content-Encoding: gzip) с ETag/Last-Modified и Range —
+    повторная загрузка того же отчёта получает 304. Остальным — поток распакованного CSV."""
+    latest_file = get_latest_csv(shop)
+    if not latest_file:
         return "❌ No CSV files available.", 404
 
-    latest_file = os.path.join(CSV_DIR, files[0])
-    print(f"⬇️ Отправляем файл: {latest_file}")
-    return send_file(latest_file, as_attachment=True)
+    download_name = os.path.basename(latest_file)[:-len(".gz")]
+    logger.info(f"⬇️ Отправляем файл: {latest_file}")
+    if request.accept_encodings["gzip"]:
+        response = send_file(latest_file, mimetype="text/csv", as_attachment=True, download_name=download_name,
+                             conditional=True, max_age=0)
+        response.headers["Content-Encoding"] = "gzip"
+        response.vary.add("Accept-Encoding")
+        return response
+
+    def generate():
+        with gzip.open(latest_file, "rb") as file:
+            while chunk := file.read(64 * 1024):
+                yield chunk
+
+    return Response(generate(), mimetype="text/csv", headers={
+        "Content-Disposition": f"attachment; filename={download_name}",
+        "Vary": "Accept-Encoding",
+    })
+
+
+# 🔹 Очередь заданий синхронизации: веб-процесс и планировщик только ставят задания, выполняет их worker.py
+SYNC_QUEUE_KEY = "sync_jobs:queue"  # Список id заданий (FIFO)
+SYNC_PROCESSING_KEY = "sync_jobs:processing:{}"  # Задания, взятые воркером (по id воркера)
+SYNC_WORKER_KEY = "sync_worker:{}"  # Пульс воркера; пропал — его задания возвращаются в очередь
+SYNC_WORKERS_KEY = "sync_workers"  # Set id воркеров, у которых могут быть взятые задания
+SYNC_JOB_KEY = "sync_job:{}"  # Хэш задания: kind, shop, status, времена, результат
+SYNC_JOB_PENDING_KEY = "sync_job:pending:{}:{}"  # Одно ожидающее задание на вид и магазин
+SYNC_SHOP_JOBS_KEY = "sync_jobs:shop:{}"  # Последние задания магазина
+SYNC_JOB_TTL = 7 * 86400
+SYNC_JOB_KINDS = ("full", "stock", "catalog", "reprice")
+
+# Проверка «такое задание уже ждёт» и постановка в очередь — одним скриптом, чтобы ключ ожидания
+# не мог остаться без задания в очереди (KEYS: pending, задание, очередь, задания магазина)
+ENQUEUE_SYNC_JOB_SCRIPT = redis_client.register_script("""
+local existing = redis.call("GET", KEYS[1])
+if existing then
+    return existing
+end
+local job_id, ttl, shop = ARGV[1], ARGV[2], ARGV[4]
+redis.call("SET", KEYS[1], job_id, "EX", ttl)
+redis.call("HSET", KEYS[2], "id", job_id, "kind", ARGV[3], "shop", shop, "status", "queued", "enqueued_at", ARGV[5])
+redis.call("EXPIRE", KEYS[2], ttl)
+redis.call("RPUSH", KEYS[3], job_id)
+if shop ~= "" then
+    redis.call("LPUSH", KEYS[4], job_id)
+    redis.call("LTRIM", KEYS[4], 0, 19)
+    redis.call("EXPIRE", KEYS[4], ttl)
+end
+return job_id
+""")
+
+
+def enqueue_sync_job(kind, shop=None):
+    """Ставит задание в очередь и возвращает его id. Если такое же задание ещё ждёт — возвращает его id.
+    full/stock без магазина — по заданию на каждый установленный магазин (список id)."""
+    if kind not in SYNC_JOB_KINDS:
+        raise ValueError(f"Неизвестный вид синхронизации: {kind}")
+    if shop is None and kind != "catalog":
+        return [enqueue_sync_job(kind, s) for s, access_token in load_installed_shops().items() if access_token]
+
+    job_id = uuid.uuid4().hex
+    queued_id = ENQUEUE_SYNC_JOB_SCRIPT(
+        keys=[SYNC_JOB_PENDING_KEY.format(kind, shop or ""), SYNC_JOB_KEY.format(job_id), SYNC_QUEUE_KEY,
+              SYNC_SHOP_JOBS_KEY.format(shop or "")],
+        args=[job_id, SYNC_JOB_TTL, kind, shop or "", time.time()])
+    if queued_id != job_id:
+        return queued_id
+    logger.info(f"📨 Задание {kind} для {shop or 'всех'} поставлено в очередь: {job_id}")
+    return job_id
+
+
+def claim_sync_job(worker_id, timeout=5):
+    """Атомарно забирает следующее задание в список воркера (BLMOVE); None — очередь пуста"""
+    job_id = redis_client.blmove(SYNC_QUEUE_KEY, SYNC_PROCESSING_KEY.format(worker_id), timeout, "LEFT", "RIGHT")
+    if not job_id:
+        return None
+    job = redis_client.hgetall(SYNC_JOB_KEY.format(job_id))
+    pipe = redis_client.pipeline()
+    pipe.delete(SYNC_JOB_PENDING_KEY.format(job.get("kind"), job.get("shop", "")))  # Новые задания снова ставятся
+    pipe.hset(SYNC_JOB_KEY.format(job_id), mapping={"status": "running", "started_at": time.time(),
+                                                    "worker": worker_id})
+    pipe.execute()
+    job.update(id=job_id, status="running")
+    return job
+
+
+def finish_sync_job(worker_id, job_id, status, result=None, error=None):
+    pipe = redis_client.pipeline()
+    pipe.hset(SYNC_JOB_KEY.format(job_id), mapping={"status": status, "finished_at": time.time(),
+                                                    "result": json.dumps(result), "error": error or ""})
+    pipe.lrem(SYNC_PROCESSING_KEY.format(worker_id), 1, job_id)
+    pipe.execute()
+
+
+def requeue_orphaned_sync_jobs():
+    """Возвращает в начало очереди задания воркеров, у которых пропал пульс (процесс упал или убит).
+    Воркеры известны по set SYNC_WORKERS_KEY — без SCAN по всему keyspace."""
+    requeued = 0
+    for worker_id in redis_client.smembers(SYNC_WORKERS_KEY):
+        if redis_client.exists(SYNC_WORKER_KEY.format(worker_id)):
+            continue
+        processing_key = SYNC_PROCESSING_KEY.format(worker_id)
+        while True:
+            job_id = redis_client.lmove(processing_key, SYNC_QUEUE_KEY, "RIGHT", "LEFT")
+            if not job_id:
+                break
+            redis_client.hset(SYNC_JOB_KEY.format(job_id), "status", "queued")
+            requeued += 1
+        redis_client.srem(SYNC_WORKERS_KEY, worker_id)  # Если воркер всё-таки жив, следующий пульс вернёт его
+    if requeued:
+        logger.warning(f"⚠️ Возвращено в очередь заданий упавших воркеров: {requeued}")
+    return requeued
+
+
+def decode_sync_job(job):
+    if job.get("result"):
+        job["result"] = json.loads(job["result"])
+    return job
+
+
+def get_sync_job(job_id):
+    return decode_sync_job(redis_client.hgetall(SYNC_JOB_KEY.format(job_id))) or None
+
+
+def list_shop_sync_jobs(shop):
+    """Последние задания магазина, новые первыми"""
+    job_ids = redis_client.lrange(SYNC_SHOP_JOBS_KEY.format(shop), 0, -1)
+    pipe = redis_client.pipeline(transaction=False)
+    for job_id in job_ids:
+        pipe.hgetall(SYNC_JOB_KEY.format(job_id))
+    return [decode_sync_job(job) for job in pipe.execute() if job]
+
+
+@app.route("/sync", methods=["POST"])
+@shop_required
+def request_sync(shop):
+    """Ставит синхронизацию подтверждённого магазина в очередь воркеров"""
+    kind = request.args.get("kind") or request.form.get("kind") or "full"
+    if not get_token(shop):
+        return jsonify({"status": "error", "message": "❌ Unknown shop"}), 400
+    if kind not in ("full", "stock"):
+        return jsonify({"status": "error", "message": f"❌ Unknown sync kind: {kind}"}), 400
+    job_id = enqueue_sync_job(kind, shop)
+    return jsonify({"status": "queued", "job_id": job_id}), 202
+
+
+@app.route("/sync_status")
+@shop_required
+def sync_status(shop):
+    """Состояние задания (?job=) или последних заданий подтверждённого магазина"""
+    job_id = request.args.get("job")
+    if job_id:
+        job = get_sync_job(job_id)
+        if not job or job.get("shop") != shop:  # Чужие и общие (catalog) задания не показываем
+            return jsonify({"status": "error", "message": "❌ Job not found"}), 404
+        return jsonify(job), 200
+
+    return jsonify({"shop": shop, "queued": redis_client.llen(SYNC_QUEUE_KEY), "jobs": list_shop_sync_jobs(shop)})
 
 
 # 🔄 Запуск фоновой синхронизации
+def start_catalog_refresh():
+    if not scheduler.get_job("powerbody_catalog"):
+        logger.info(f"🕒 Обновление общего каталога PowerBody каждые {CATALOG_REFRESH_MINUTES} минут.")
+        scheduler.add_job(enqueue_sync_job, 'interval', minutes=CATALOG_REFRESH_MINUTES, args=["catalog"],
+                          id="powerbody_catalog", replace_existing=True)
+
+
 def start_sync_for_shop(shop, access_token):
+    start_catalog_refresh()
+    if not redis_client.hexists(SHOPIFY_MIRROR_META_KEY.format(shop), "webhooks"):
+        try:
+            register_shopify_webhooks(shop, access_token)
+        except requests.RequestException as e:
+            logger.warning(f"⚠️ Не удалось подписать вебхуки для {shop}: {e}")
     job_id = f"sync_{shop}"
     existing_job = scheduler.get_job(job_id)
 
     if not existing_job:
-        print(f"🕒 Запуск фоновой синхронизации для {shop} каждые 120 минут.")
-        scheduler.add_job(sync_products, 'interval', minutes=600, args=[shop], id=job_id, replace_existing=True)
+        logger.info(f"🕒 Запуск фоновой синхронизации для {shop} каждые {SYNC_INTERVAL_MINUTES} минут.")
+        scheduler.add_job(enqueue_sync_job, 'interval', minutes=SYNC_INTERVAL_MINUTES, args=["full", shop],
+                          id=job_id, replace_existing=True)
+
+    stock_job_id = f"stock_sync_{shop}"
+    if not scheduler.get_job(stock_job_id):
+        logger.info(f"🕒 Запуск синхронизации остатков для {shop} каждые {STOCK_SYNC_INTERVAL_MINUTES} минут.")
+        scheduler.add_job(enqueue_sync_job, 'interval', minutes=STOCK_SYNC_INTERVAL_MINUTES, args=["stock", shop],
+                          id=stock_job_id, replace_existing=True)
+
+
+def migrate_shop_registry():
+    """Однократно заполняет реестр магазинов из существующих ключей токенов (SCAN не блокирует Redis).
+    После первого прохода ставит отметку, чтобы пустой реестр не сканировался на каждом тике планировщика."""
+    if redis_client.exists(SHOPS_MIGRATED_KEY):
+        return []
+    shops = [key.split("shopify_token:")[-1] for key in redis_client.scan_iter(match="shopify_token:*", count=1000)]
+    pipe = redis_client.pipeline()
+    if shops:
+        pipe.sadd(SHOPS_KEY, *shops)
+    pipe.set(SHOPS_MIGRATED_KEY, int(time.time()))
+    pipe.execute()
+    if shops:
+        logger.info(f"🗂️ Реестр магазинов заполнен из токенов: {len(shops)}")
+    return shops
+
+
+def load_installed_shops():
+    """Все магазины и их токены: SSCAN по реестру и пакетный MGET токенов"""
+    migrate_shop_registry()  # Решает отметка, а не пустота реестра: в него мог уже попасть новый магазин
+    shops = list(redis_client.sscan_iter(SHOPS_KEY, count=1000))
+    tokens = {}
+    for i in range(0, len(shops), 1000):
+        chunk = shops[i:i + 1000]
+        tokens.update(zip(chunk, redis_client.mget([f"shopify_token:{shop}" for shop in chunk])))
+    return tokens
 
 
 # 🔄 Запуск фоновой синхронизации при старте сервера
 def schedule_sync():
-    """Запускает синхронизацию для всех магазинов, у которых сохранены токены в Redis."""
-    keys = redis_client.keys("shopify_token:*")  # Получаем все ключи с токенами
-    if not keys:
-        print("❌ Нет сохранённых токенов в Redis.")
+    """Запускает синхронизацию для всех магазинов из реестра установленных магазинов."""
+    tokens = load_installed_shops()
+    if not tokens:
+        logger.debug("❌ Нет сохранённых токенов в Redis.")
         return
 
-    for key in keys:
-        shop = key.split("shopify_token:")[-1]  # Извлекаем название магазина
-        access_token = redis_client.get(key)
-
+    expired = []
+    for shop, access_token in tokens.items():
         if access_token:
             start_sync_for_shop(shop, access_token)
-            print(f"🔄 Запущена синхронизация для {shop}")
         else:
-            print(f"⚠️ Токен для {shop} отсутствует в Redis.")
+            logger.warning(f"⚠️ Токен для {shop} отсутствует в Redis.")
+            expired.append(shop)
+
+    if expired:
+        redis_client.srem(SHOPS_KEY, *expired)  # Токен истёк — магазин больше не считаем установленным
+
+
+SCHEDULER_LEADER_KEY = "scheduler:leader"
+
+
+class SchedulerLeader:
+    """Выбор одного лидера среди всех процессов и хостов: планировщик работает только у владельца аренды
+    SCHEDULER_LEADER_KEY, у остальных он на паузе. Потерял аренду — ставит планировщик на паузу."""
+
+    def __init__(self):
+        self.lease = RedisLease(SCHEDULER_LEADER_KEY, SCHEDULER_LEASE_SECONDS, on_lost=self._demote)
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        return self.lease.held
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="scheduler-leader", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        if self.lease.held:
+            self.lease.release()
+            self._demote()
+
+    def _run(self):
+        while True:
+            try:
+                if not self.lease.held and self.lease.acquire():
+                    self._promote()
+            except redis.RedisError as e:
+                logger.warning(f"⚠️ Выбор лидера планировщика: {e}")
+            time.sleep(SCHEDULER_LEASE_SECONDS / 3)
+
+    def _promote(self):
+        logger.info(f"👑 Процесс {os.getpid()} стал лидером планировщика")
+        if not scheduler.get_job("discover_shops"):
+            scheduler.add_job(schedule_sync, 'interval', minutes=SHOP_DISCOVERY_MINUTES, id="discover_shops",
+                              next_run_time=datetime.now(), replace_existing=True)
+        scheduler.resume()
+
+    def _demote(self):
+        logger.warning(f"⚠️ Процесс {os.getpid()} больше не лидер планировщика. Планировщик на паузе.")
+        scheduler.pause()
+
+
+scheduler_leader = SchedulerLeader()
+if SCHEDULER_ENABLED:
+    scheduler_leader.start()
 
 
 if __name__ == "__main__":
-    print("🚀 Запуск фоновой синхронизации...")
-    schedule_sync()
+    logger.info("🚀 Запуск фоновой синхронизации...")
     app.run(host='0.0.0.0', port=80, debug=False)
@@ -0,0 +1,84 @@
+// Админка встроенного приложения. Магазин и ключ API приходят из data-атрибутов <body>,
+// поэтому файл одинаков для всех магазинов и кэшируется браузером надолго.
+(function() {
+    var config = document.body.dataset;
+
+    var AppBridge = window["app-bridge"];
+    var getSessionToken = window["app-bridge-utils"].getSessionToken;
+    var createApp = AppBridge.createApp;
+    var actions = AppBridge.actions;
+    var Redirect = actions.Redirect;
+
+    var app = createApp({
+        apiKey: config.apiKey,
+        shopOrigin: config.shop,
+        forceRedirect: true
+    });
+
+    // Магазин сервер берёт из session token App Bridge, а не из параметров запроса
+    function authorizedFetch(url, options) {
+        return getSessionToken(app).then(function(token) {
+            options = options || {};
+            options.headers = Object.assign({}, options.headers, {'Authorization': 'Bearer ' + token});
+            return fetch(url, options);
+        });
+    }
+
+    // Обработчик формы
+    var settingsForm = document.getElementById('settingsForm');
+    if (settingsForm) {
+        settingsForm.addEventListener('submit', function(event) {
+            event.preventDefault();
+            var formData = new FormData(this);
+
+            authorizedFetch('/update_settings', {
+                method: 'POST',
+                body: formData
+            })
+            .then(response => response.json())
+            .then(data => {
+                let messageElement = document.getElementById('message');
+                if (messageElement) {
+                    messageElement.innerText = data.message;
+                    messageElement.style.display = 'block';
+                    setTimeout(() => {
+                        messageElement.style.display = 'none';
+                    }, 3000);
+                }
+            })
+            .catch(error => console.error('Ошибка:', error));
+        });
+    } else {
+        console.error("❌ Форма 'settingsForm' не найдена!");
+    }
+
+    // Обработчик кнопки скачивания CSV
+    var downloadBtn = document.getElementById('downloadCSV');
+    if (downloadBtn) {
+        downloadBtn.addEventListener('click', function(event) {
+            event.preventDefault();
+            // Заголовок Authorization не передать через переход по ссылке — скачиваем fetch и сохраняем blob
+            authorizedFetch('/download_csv')
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('HTTP ' + response.status);
+                }
+                var disposition = response.headers.get('Content-Disposition') || '';
+                var match = disposition.match(/filename=([^;]+)/);
+                return response.blob().then(blob => ({blob: blob, name: match ? match[1] : 'sync_report.csv'}));
+            })
+            .then(file => {
+                var link = document.createElement('a');
+                link.href = URL.createObjectURL(file.blob);
+                link.download = file.name;
+                document.body.appendChild(link);
+                link.click();
+                link.remove();
+                URL.revokeObjectURL(link.href);
+            })
+            .catch(error => console.error('Ошибка:', error));
+        });
+    } else {
+        console.error("❌ Кнопка 'Download CSV' не найдена!");
+    }
+})();
@@ -0,0 +1,92 @@
+"""Локальный отправитель вебхуков Shopify: подписывает тело так же, как Shopify, и шлёт его в /webhooks.
+
+Примеры:
+    python tools/send_webhook.py products/update --product-id 1 --variant 11:SKU-1:12.90:5:111
+    python tools/send_webhook.py products/delete --product-id 1
+    python tools/send_webhook.py inventory_levels/update --inventory-item-id 111 --available 3
+    python tools/send_webhook.py products/update --file payload.json
+
+Секрет берётся из API_SECRET (как у приложения), адрес — из --url или APP_URL.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import uuid
+
+import requests
+
+
+def sign(body, secret):
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+def parse_variant(spec, product_id):
+    """id:sku:price:quantity:inventory_item_id"""
+    variant_id, sku, price, quantity, inventory_item_id = spec.split(":")
+    return {
+        "id": int(variant_id),
+        "product_id": product_id,
+        "sku": sku,
+        "price": price,
+        "inventory_quantity": int(quantity),
+        "inventory_item_id": int(inventory_item_id),
+    }
+
+
+def build_payload(args):
+    if args.file:
+        with open(args.file, "rb") as file:
+            return file.read()
+
+    if args.topic in ("products/create", "products/update"):
+        payload = {"id": args.product_id, "variants": [parse_variant(v, args.product_id) for v in args.variant]}
+    elif args.topic == "products/delete":
+        payload = {"id": args.product_id}
+    else:
+        payload = {
+            "inventory_item_id": args.inventory_item_id,
+            "location_id": args.location_id,
+            "available": args.available,
+        }
+    return json.dumps(payload).encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отправка подписанного вебхука Shopify на локальное приложение")
+    parser.add_argument("topic", choices=["products/create", "products/update", "products/delete",
+                                          "inventory_levels/update"])
+    parser.add_argument("--url", default=f"{os.getenv('APP_URL', 'http://localhost')}/webhooks")
+    parser.add_argument("--shop", default="test-shop.myshopify.com")
+    parser.add_argument("--secret", default=os.getenv("API_SECRET"))
+    parser.add_argument("--file", help="Готовое тело вебхука (JSON)")
+    parser.add_argument("--product-id", type=int, default=1)
+    parser.add_argument("--variant", action="append", default=[], help="id:sku:price:quantity:inventory_item_id")
+    parser.add_argument("--inventory-item-id", type=int)
+    parser.add_argument("--location-id", type=int, default=int(os.getenv("SHOPIFY_LOCATION_ID", 85726363936)))
+    parser.add_argument("--available", type=int)
+    parser.add_argument("--bad-signature", action="store_true", help="Проверить, что приложение отклонит подделку")
+    args = parser.parse_args()
+
+    if not args.secret:
+        parser.error("нужен --secret или переменная окружения API_SECRET")
+
+    body = build_payload(args)
+    signature = sign(body, args.secret + ("x" if args.bad_signature else ""))
+    response = requests.post(args.url, data=body, timeout=10, headers={
+        "Content-Type": "application/json",
+        "X-Shopify-Topic": args.topic,
+        "X-Shopify-Shop-Domain": args.shop,
+        "X-Shopify-Hmac-Sha256": signature,
+        "X-Shopify-Webhook-Id": str(uuid.uuid4()),
+    })
+    print(f"{args.topic} → {args.url}: {response.status_code} {response.text}")
+    return 0 if response.ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
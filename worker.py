@@ -0,0 +1,139 @@
+"""Воркер синхронизации: берёт задания из очереди Redis (full / stock / catalog / reprice) и выполняет их.
+
+Веб-процесс и планировщик только ставят задания (index.enqueue_sync_job), поэтому долгие синхронизации
+не делят GIL и память с админкой. Для роста пропускной способности достаточно запустить больше воркеров:
+    python worker.py --threads 2
+Остановка по SIGTERM/SIGINT: текущие задания дорабатываются, новые не берутся.
+
+Метрики синхронизации (sync_stage_seconds, shopify_throttled_total и т. д.) копятся в процессе воркера,
+а не веб-процесса, поэтому воркер отдаёт их сам: http://<хост>:WORKER_METRICS_PORT/metrics.
+Этот адрес нужно добавить в scrape-конфиг Prometheus; нескольким воркерам на одном хосте — разные порты:
+    python worker.py --metrics-port 9101
+"""
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+
+from prometheus_client import CollectorRegistry, multiprocess, start_http_server
+
+# Воркер только выполняет задания; ставит их по расписанию лидер среди веб-процессов.
+# Без этого import index включил бы воркер в выборы лидера планировщика
+os.environ["SCHEDULER_ENABLED"] = "0"
+
+import index  # noqa: E402
+from index import logger, redis_client  # noqa: E402
+
+SYNC_WORKER_THREADS = int(os.getenv("SYNC_WORKER_THREADS", 2))  # Одновременных заданий в одном процессе
+HEARTBEAT_SECONDS = index.SYNC_WORKER_HEARTBEAT_SECONDS
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9100))  # Порт /metrics воркера; 0 — не поднимать
+
+JOB_HANDLERS = {
+    "full": index.sync_products,
+    "stock": index.sync_stock,
+    "catalog": lambda shop: index.refresh_powerbody_catalog_job(),
+    "reprice": index.reprice_shop,
+}
+
+
+class SyncWorker:
+    def __init__(self, threads=SYNC_WORKER_THREADS, metrics_port=WORKER_METRICS_PORT):
+        self.id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.threads = threads
+        self.metrics_port = metrics_port
+        self.stopping = threading.Event()
+
+    def heartbeat(self):
+        """Пульс воркера; заодно возвращает в очередь задания упавших воркеров"""
+        while not self.stopping.is_set():
+            try:
+                pipe = redis_client.pipeline()
+                pipe.set(index.SYNC_WORKER_KEY.format(self.id), time.time(), ex=HEARTBEAT_SECONDS * 3)
+                pipe.sadd(index.SYNC_WORKERS_KEY, self.id)
+                pipe.execute()
+                index.requeue_orphaned_sync_jobs()
+            except index.redis.RedisError as e:
+                logger.warning(f"⚠️ Пульс воркера {self.id}: {e}")
+            self.stopping.wait(HEARTBEAT_SECONDS)
+
+    def run_job(self, job):
+        job_id, kind, shop = job["id"], job.get("kind"), job.get("shop") or None
+        handler = JOB_HANDLERS.get(kind)
+        if handler is None:
+            index.finish_sync_job(self.id, job_id, "failed", error=f"unknown kind {kind}")
+            return
+
+        logger.info(f"▶️ Воркер {self.id}: задание {kind} для {shop or 'всех'} ({job_id})")
+        started_at = time.monotonic()
+        try:
+            result = handler(shop)
+        except Exception as e:
+            logger.exception(f"❌ Задание {job_id} завершилось ошибкой: {e}")
+            index.finish_sync_job(self.id, job_id, "failed", error=str(e))
+            return
+        # "skipped" — у магазина уже идёт синхронизация (или каталог обновляет другой процесс),
+        # "deferred" — пересчёт цен отложен до её окончания, None — задание не удалось (подробности в журнале)
+        if result in ("skipped", "deferred"):
+            status = result
+        else:
+            status = "failed" if result is None else "done"
+        index.finish_sync_job(self.id, job_id, status, result=result,
+                              error="см. журнал воркера" if status == "failed" else None)
+        logger.info(f"⏹️ Задание {job_id}: {status} за {time.monotonic() - started_at:.1f} сек")
+
+    def serve_metrics(self):
+        """HTTP-сервер /metrics в фоновом потоке; с PROMETHEUS_MULTIPROC_DIR — сводка по всем процессам"""
+        registry = index.REGISTRY
+        if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        start_http_server(self.metrics_port, registry=registry)
+        logger.info(f"📈 Метрики воркера {self.id}: порт {self.metrics_port}")
+
+    def consume(self):
+        while not self.stopping.is_set():
+            try:
+                job = index.claim_sync_job(self.id)
+            except index.redis.RedisError as e:
+                logger.warning(f"⚠️ Очередь заданий недоступна: {e}")
+                self.stopping.wait(5)
+                continue
+            if job:
+                self.run_job(job)
+
+    def run(self):
+        logger.info(f"🚀 Воркер синхронизации {self.id}: потоков {self.threads}")
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: self.stopping.set())
+
+        if self.metrics_port:
+            self.serve_metrics()
+        threading.Thread(target=self.heartbeat, name="heartbeat", daemon=True).start()
+        consumers = [threading.Thread(target=self.consume, name=f"consumer-{i}") for i in range(self.threads)]
+        for thread in consumers:
+            thread.start()
+        for thread in consumers:
+            thread.join()
+        pipe = redis_client.pipeline()
+        pipe.delete(index.SYNC_WORKER_KEY.format(self.id))
+        pipe.srem(index.SYNC_WORKERS_KEY, self.id)
+        pipe.execute()
+        logger.info(f"👋 Воркер {self.id} остановлен")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воркер очереди синхронизации PowerBody → Shopify")
+    parser.add_argument("--threads", type=int, default=SYNC_WORKER_THREADS)
+    parser.add_argument("--metrics-port", type=int, default=WORKER_METRICS_PORT)
+    args = parser.parse_args()
+    if index.SYNC_LOCK_SECONDS >= HEARTBEAT_SECONDS * 2:
+        logger.warning(f"⚠️ SYNC_LOCK_SECONDS={index.SYNC_LOCK_SECONDS} не короче окна пульса "
+                       f"({HEARTBEAT_SECONDS * 2} сек): задания убитого воркера будут пропускаться")
+    SyncWorker(args.threads, args.metrics_port).run()
+
+
+if __name__ == "__main__":
+    main()